@@ -1,16 +1,68 @@
 import json
 import logging
 import numpy as np
+import os
 import os.path as osp
 import re
-from scipy.interpolate import interp1d
+import struct
+import zipfile
 import torch, torch.utils.data as D
 
+def _mmap_npz_member(fname, name):
+    """
+    Memory-map an array stored without compression in an .npz file. Returns None if the array is compressed.
+    """
+    with zipfile.ZipFile(fname) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(fname, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(fname, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=offset)
+
+def load_features(fname, mmap=False):
+    """
+    Load the features written by cvvdp.write_features_to_npz (.npz) or cvvdp.write_features_to_json (.json).
+    Returns a dict with 'Q_per_ch' - float32 array (channels x frames x bands), 'rho_band' and other statistics.
+    If mmap is True, Q_per_ch is memory-mapped from an .npz file instead of being read into memory.
+    """
+    if fname.endswith('.npz'):
+        with np.load(fname) as npz:
+            features = {key: npz[key] for key in npz.files if key != 'Q_per_ch'}
+            Q_per_ch = _mmap_npz_member(fname, 'Q_per_ch') if mmap else None
+            features['Q_per_ch'] = npz['Q_per_ch'] if Q_per_ch is None else Q_per_ch
+        return features
+
+    # JSON fallback
+    with open(fname, 'r') as json_file:
+        features = json.load(json_file)
+
+    f_keys = [k for k in features.keys() if re.match(r't\d+_b\d+', k)]
+    bands = len(set([k.split('_')[1].lstrip('b') for k in f_keys]))
+    temp_channels = len(set([k.split('_')[0].lstrip('t') for k in f_keys]))
+    frames = len(features['t0_b0'])
+    Q_per_ch = np.empty( (temp_channels,frames,bands), dtype=np.float32 )
+    for cc in range(temp_channels):
+        for bb in range(bands):
+            Q_per_ch[cc,:,bb] = features.pop(f't{cc}_b{bb}')
+    features['Q_per_ch'] = Q_per_ch
+    features['rho_band'] = np.array( features['rho_band'] )
+    return features
+
 class VideoDataset(D.Dataset):
     log_rho_min = -1
     log_rho_max = 6
 
-    def __init__(self, feature_dir, quality_table, split, resample):
+    def __init__(self, feature_dir, quality_table, split, resample, cache=True):
         super().__init__()
         logging.info(f'Loading dataset "{self.__class__.__name__}"')
         self.feature_dir = feature_dir
@@ -19,9 +71,101 @@ class VideoDataset(D.Dataset):
         self.split = split
         self.resample = resample
 
-        # Cache for faster training
+        # Cache for faster training: either a store of all features in a single memory-mapped file (shared by
+        # the DataLoader workers), or a per-process dictionary
+        self.store_fname = self.build_store() if cache else None
+        self._store = None
         self.Q_per_ch, self.base_rho_band = {}, {}
 
+    def __getstate__(self):
+        # The memory-mapped store is opened again in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
+
+    def get_id(self, index):
+        test_fname = self.quality_table.iloc[index]['test']
+        return osp.splitext(test_fname)[0].replace('/', '_')      # Unique ID for each row
+
+    def get_feature_fname(self, index):
+        id = self.get_id(index)
+        feat_fname = osp.join( self.feature_dir, self.split, f'{id}_fmap.npz' )
+        if not osp.isfile(feat_fname):
+            feat_fname = osp.join( self.feature_dir, self.split, f'{id}_fmap.json' ) # Features extracted in the JSON format
+        assert osp.isfile(feat_fname), f'Features missing for "{self.quality_table.iloc[index]["test"]}"'
+        return feat_fname
+
+    def resample_bands(self, qpc, rho_band):
+        """
+        Resample the features (cxfxb) at frequencies [64, 32, ..., 0.5] for all channels and frames at once. The bands 
+        are linearly interpolated, with the weights computed once per video, and the base band is appended at the end.
+        """
+        rho_band = np.asarray(rho_band, dtype=np.float64)
+        values = qpc
+        if max(rho_band) < 2**self.log_rho_max:
+            # Extrapolate to 0 at the highest frequency
+            rho_band = np.insert(rho_band, 0, 2**self.log_rho_max)
+            values = np.concatenate((np.zeros_like(qpc[...,:1]), qpc), axis=-1)
+
+        resampled_bands = self.log_rho_max - self.log_rho_min + 2   # Extra entry at the end to store base band
+        rho_q = 2**np.linspace(self.log_rho_max, self.log_rho_min, resampled_bands-1)
+        assert rho_q.min() >= rho_band.min(), f'Cannot resample the bands below {rho_band.min()} cpd'
+
+        # Interpolation matrix: W[kk] are the weights of the band kk for each resampled frequency
+        order = np.argsort(rho_band)
+        W = np.stack([np.interp(rho_q, rho_band[order], (order == kk).astype(np.float64)) for kk in range(len(rho_band))])
+
+        return np.concatenate((values @ W, qpc[...,-1:]), axis=-1).astype(np.float32)
+
+    def load(self, index):
+        """
+        Load the features of a row from the feature file (resampled if needed).
+        """
+        features = load_features(self.get_feature_fname(index))
+        qpc = np.asarray( features['Q_per_ch'], dtype=np.float32 )
+        rho_band = np.asarray( features['rho_band'] )
+        if self.resample:
+            qpc = self.resample_bands(qpc, rho_band)
+        return qpc, np.float32(rho_band[-1])
+
+    def build_store(self):
+        """
+        Store the (resampled) features of all rows in a single float32 file, which is memory-mapped when training, so 
+        the feature files are parsed and resampled only once. The store is rebuilt when the rows or the feature files change.
+        """
+        store_dir = osp.join(self.feature_dir, self.split)
+        store_fname = osp.join(store_dir, 'feature_store_resampled.bin' if self.resample else 'feature_store.bin')
+        index_fname = osp.splitext(store_fname)[0] + '_index.npz'
+
+        feat_fnames = [self.get_feature_fname(index) for index in range(len(self))]
+        signature = np.array([f'{osp.basename(ff)}:{os.stat(ff).st_mtime_ns}:{os.stat(ff).st_size}' for ff in feat_fnames])
+        if osp.isfile(index_fname) and osp.isfile(store_fname):
+            with np.load(index_fname) as index:
+                if np.array_equal(index['signature'], signature):
+                    self._set_index(index)
+                    return store_fname
+
+        logging.info(f'Building the feature store "{store_fname}"')
+        shapes = np.zeros((len(self), 3), dtype=np.int64)
+        base_rho_band = np.zeros((len(self),), dtype=np.float32)
+        tmp_fname = f'{store_fname}.{os.getpid()}.tmp'
+        with open(tmp_fname, 'wb') as f:
+            for index in range(len(self)):
+                qpc, base_rho_band[index] = self.load(index)
+                shapes[index] = qpc.shape
+                f.write(np.ascontiguousarray(qpc).tobytes())
+        offsets = np.concatenate(([0], np.cumsum(np.prod(shapes, axis=1))))
+        os.replace(tmp_fname, store_fname)
+
+        tmp_fname = f'{osp.splitext(store_fname)[0]}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_fname, signature=signature, shapes=shapes, offsets=offsets, base_rho_band=base_rho_band)
+        os.replace(tmp_fname, index_fname)
+        self.shapes, self.offsets, self.base_rho_bands = shapes, offsets, base_rho_band
+        return store_fname
+
+    def _set_index(self, index):
+        self.shapes, self.offsets, self.base_rho_bands = index['shapes'], index['offsets'], index['base_rho_band']
+
     def __getitem__(self, index):
         """
         Returns:
@@ -31,47 +175,21 @@ class VideoDataset(D.Dataset):
         """
         assert index in range(self.__len__()), f'{index} is out of range, len={self.__len__()}'
 
-        row = self.quality_table.iloc[index]
-        test_fname, quality = row[['test', 'jod']]
-        id = osp.splitext(test_fname)[0].replace('/', '_')      # Unique ID for each row
+        quality = self.quality_table.iloc[index]['jod']
 
-        if test_fname in self.Q_per_ch:
-            qpc, base_rho_band = self.Q_per_ch[id], self.base_rho_band[id]
+        if not self.store_fname is None:
+            if self._store is None:
+                self._store = np.memmap(self.store_fname, dtype=np.float32, mode='r')
+            qpc = np.array(self._store[self.offsets[index]:self.offsets[index+1]]).reshape(self.shapes[index])
+            base_rho_band = self.base_rho_bands[index]
         else:
-            feat_fname = osp.join( self.feature_dir, self.split, f'{id}_fmap.json' )
-            assert osp.isfile(feat_fname), f'Features missing for "{test_fname}"'
-            with open(feat_fname, "r") as json_file:
-                features = json.load(json_file)
-
-            f_keys = set([k for k in features.keys() if re.match('t\d+_b\d+', k)])
-            bands = len(set([k.split('_')[1].lstrip('b') for k in f_keys]))
-            temp_channels = len(set([k.split('_')[0].lstrip('t') for k in f_keys]))
-            frames = len(features['t0_b0'])
-
-            if max(features['rho_band']) < 2**self.log_rho_max:
-                features['rho_band'].insert(0, 2**self.log_rho_max)
-                extrapolate = True
-            rho_band = np.array( features['rho_band'] )
-
-            # Resample the features at frequencies [0.5, 1, 2, ..., 64]
-            resampled_bands = self.log_rho_max - self.log_rho_min + 2   # Extra entry at the end to store base band
-            resampled_qpc = np.empty( (temp_channels,frames,resampled_bands), dtype=np.float32)
-            qpc = np.empty( (temp_channels,frames,bands), dtype=np.float32)
-            for cc in range(temp_channels):
-                for bb in range(bands):
-                    qpc[cc,:,bb] = np.array( features[f't{cc}_b{bb}'] ).reshape( (1,1,frames) )
-
-                if self.resample:
-                    for tt in range(frames):
-                        lut = interp1d(rho_band, np.insert(qpc[cc,tt], 0, 0) if extrapolate else qpc[cc,tt])
-                        resampled_qpc[cc,tt] = np.append(lut(2**np.linspace(self.log_rho_max, self.log_rho_min, resampled_bands-1)), qpc[cc,tt,-1])
-
-            if self.resample:
-                qpc = torch.tensor(resampled_qpc)
-
-            base_rho_band = np.float32(rho_band[-1])
-            self.Q_per_ch[id] = qpc
-            self.base_rho_band[id] = base_rho_band
+            id = self.get_id(index)
+            if id in self.Q_per_ch:
+                qpc, base_rho_band = self.Q_per_ch[id], self.base_rho_band[id]
+            else:
+                qpc, base_rho_band = self.load(index)
+                self.Q_per_ch[id] = qpc
+                self.base_rho_band[id] = base_rho_band
 
         return qpc, base_rho_band, quality
 
@@ -89,11 +207,11 @@ def collate(batch):
     return qpc, torch.tensor(rho_band), torch.tensor(q, dtype=torch.float32)
 
 
-def get_loaders(feature_dir, train_table, test_table, resample, batch, num_workers):
-    train_dataset = VideoDataset(feature_dir, train_table, 'train', resample)
+def get_loaders(feature_dir, train_table, test_table, resample, batch, num_workers, cache=True):
+    train_dataset = VideoDataset(feature_dir, train_table, 'train', resample, cache)
     train_loader = D.DataLoader(train_dataset, batch, num_workers=num_workers, shuffle=True, persistent_workers=True, collate_fn=collate)
 
-    test_dataset = VideoDataset(feature_dir, test_table, 'test', resample)
+    test_dataset = VideoDataset(feature_dir, test_table, 'test', resample, cache)
     test_loader = D.DataLoader(test_dataset, batch, num_workers=num_workers, shuffle=False, persistent_workers=True, collate_fn=collate)
 
     return train_loader, test_loader
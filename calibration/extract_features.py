@@ -5,8 +5,11 @@ import os
 import pandas as pd
 import pycvvdp
 import sys
+import time
 import torch
-from tqdm import trange
+from tqdm import tqdm
+
+from task_queue import TaskQueue
 
 def read_args_from_file(args):
     assert os.path.isfile(args.quality_file), f'Quality file not found at: {args.quality_file}'
@@ -44,12 +47,15 @@ def get_args():
     parser.add_argument('--masking', default='base', choices=['base', 'mlp'], help='Per-frame masking model.')
     parser.add_argument('--pooling', default='base', choices=['base', 'lstm', 'gru'], help='Reduction method used to pool per-frame features.')
     parser.add_argument('--ckpt', default=None, help='PyTorch checkpoint to retrieve weights/parameters.')
-    parser.add_argument('-w', '--worker', default=None, type=str, help='WorkerID and the humber of workers in the format k/N, where N is the total number of workers and k=1..N.')
+    parser.add_argument('-w', '--worker', default=None, type=str, help='WorkerID and the humber of workers in the format k/N, where N is the total number of workers and k=1..N. Each worker processes every Nth condition, using its own task queue. Not needed when all workers can access the same features directory - use --jobs and --resume instead.')
+    parser.add_argument('--features-format', default='npz', choices=['npz', 'json'], help='Format of the feature files: "npz" (compact binary, default) or "json" (the format of older versions).')
     parser.add_argument('-f', '--features-suffix', default=None, help='suffix to add add to the features diretory name.')
     parser.add_argument('-c', '--config-dir', default=None, help="A path to cvvdp configuration files: display_models.json, cvvdp_parameters.json and others.")
     parser.add_argument('-d', '--display', default=None, help='Display name to create photometric and geometric models.')
     parser.add_argument('--gpu', type=int,  default=0, help='Select which GPU to use (e.g. 0), default is GPU 0. Pass -1 to run on the CPU.')
-    parser.add_argument('--resume', action='store_true', default=False, help='Resume running the metric (skip the conditions that have been already processed).')
+    parser.add_argument('--resume', action='store_true', default=False, help='Resume running the metric (skip the conditions that have been already processed and retry the failed ones and those of crashed workers). Also use it to start more workers that join a running extraction.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='The number of worker processes on this machine. The conditions are handed out to the workers from a shared queue (features*/tasks.sqlite), the longest videos first. The workers are distributed across GPUs, starting from --gpu, or pinned to separate subsets of CPU cores.')
+    parser.add_argument('--task-timeout', type=float, default=0, help='With --resume, requeue the conditions that have been processed by a worker for longer than this many hours (e.g. workers on other machines that crashed). 0 - only the conditions of the workers that are no longer running on this machine are requeued.')
     parser.add_argument('--full-screen-resize', choices=['bilinear', 'bicubic', 'nearest', 'area'], default=None, help="Both test and reference videos will be resized to match the full resolution of the display. Currently works only with videos.")
     parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
@@ -73,18 +79,108 @@ def get_args():
 
     return args, quality_table
 
-def main():
-    args, quality_table = get_args()
-
+def get_device(args, slot=0):
     if args.gpu >= 0 and torch.cuda.is_available():
-        device = torch.device('cuda:' + str(args.gpu))
-    else:
-        device = torch.device('cpu')
+        # Distribute local workers across the GPUs, starting from the selected one
+        return torch.device('cuda:' + str((args.gpu + slot) % torch.cuda.device_count()))
+    return torch.device('cpu')
 
+def create_metric(args, device):
     if args.masking == 'base' and args.pooling == 'base':
-        metric = pycvvdp.cvvdp(quiet=True, device=device, temp_padding='replicate')
+        return pycvvdp.cvvdp(quiet=True, device=device, temp_padding='replicate')
     else:
-        metric = pycvvdp.cvvdp_nn(quiet=True, device=device, temp_padding='replicate', masking=args.masking, pooling=args.pooling, ckpt=args.ckpt)
+        return pycvvdp.cvvdp_nn(quiet=True, device=device, temp_padding='replicate', masking=args.masking, pooling=args.pooling, ckpt=args.ckpt)
+
+def get_task_cost(args, row):
+    """
+    The cost used to balance the load: the duration or the number of frames if the quality table has such a column,
+    otherwise the size of the test file (which is proportional to the duration for videos of similar bit-rate).
+    """
+    for col in ['duration', 'frames']:
+        if col in row.index:
+            return float(row[col])
+    try:
+        return float(os.path.getsize(os.path.join(args.path_prefix, row['test'])))
+    except OSError:
+        return 0.
+
+def write_features(metric, stats, dest_name, features_format):
+    # Write to a temporary file first, so that a crashed worker never leaves a partially written feature file
+    tmp_name = f'{dest_name}.{os.getpid()}.tmp'
+    try:
+        if features_format == 'npz':
+            metric.write_features_to_npz(stats, tmp_name)
+        else:
+            metric.write_features_to_json(stats, tmp_name)
+        os.replace(tmp_name, dest_name)
+    finally:
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+
+def process_tasks(args, quality_table, dest_names, queue_fname, slot=0):
+    """
+    Take the rows of the quality table from the task queue and extract their features until the queue is empty.
+    A single metric is used for all rows and its display model is changed only when the display changes.
+    """
+    device = get_device(args, slot)
+    metric = create_metric(args, device)
+    displays = {}   # Display models loaded by this worker
+    current_display = None
+
+    tasks = TaskQueue(queue_fname)
+    while True:
+        kk = tasks.claim()
+        if kk is None:
+            break
+        test, ref = quality_table.loc[kk][['test', 'reference']]
+        dest_name = dest_names[kk]
+
+        # Some datasets may have different display models for each row
+        display = quality_table.loc[kk]['display'] if args.display == 'per-row' else args.display
+        if not display in displays:
+            displays[display] = (pycvvdp.vvdp_display_photometry.load(display), pycvvdp.vvdp_display_geometry.load(display))
+        disp_photo, disp_geom = displays[display]
+        if display != current_display:
+            metric.set_display_model(display_photometry=disp_photo, display_geometry=disp_geom)
+            current_display = display
+
+        # Create the video source and run the metric
+        try:
+            vs = pycvvdp.video_source_file(os.path.join(args.path_prefix, test),
+                                        os.path.join(args.path_prefix, ref),
+                                        display_photometry=disp_photo,
+                                        full_screen_resize=args.full_screen_resize,
+                                        resize_resolution=disp_geom.resolution,
+                                        verbose=args.verbose)
+
+            with torch.no_grad():
+                _, stats = metric.predict_video_source(vs)
+
+            write_features(metric, stats, dest_name, args.features_format)
+        except Exception as e:
+            logging.error( f'Failed on condition {os.path.basename(dest_name)}: {e}' )
+            tasks.failed(kk, repr(e))
+            continue
+        tasks.done(kk)
+    tasks.close()
+
+def _worker_main(args, quality_table, dest_names, queue_fname, slot):
+    # Runs in a spawned process, so the logging and the configuration directory need to be set again
+    level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(format='[%(levelname)s] %(message)s', level=level)
+    if not args.config_dir is None:
+        pycvvdp.utils.config_files.set_config_dir(args.config_dir)
+    if (args.gpu < 0 or not torch.cuda.is_available()) and hasattr(os, 'sched_setaffinity'):
+        # Pin each worker to its own subset of CPU cores
+        cores = sorted(os.sched_getaffinity(0))
+        my_cores = cores[slot::args.jobs]
+        if len(my_cores)>0:
+            os.sched_setaffinity(0, my_cores)
+            torch.set_num_threads(len(my_cores))
+    process_tasks(args, quality_table, dest_names, queue_fname, slot)
+
+def main():
+    args, quality_table = get_args()
 
     if not args.worker is None:
         kn = args.worker.split('/',1)
@@ -109,42 +205,61 @@ def main():
     if not args.worker is None:
         rng_start = workerK-1
         rng_step = workerN
+        queue_fname = os.path.join(ft_path, f'tasks_{workerK}-of-{workerN}.sqlite')
     else:
         rng_start = 0
         rng_step = 1
+        queue_fname = os.path.join(ft_path, 'tasks.sqlite')
 
-    for kk in trange(rng_start, len(quality_table), rng_step):
-        test, ref, cond = quality_table.loc[kk][['test', 'reference', args.split_column]]
+    dest_names = {}
+    task_list = []
+    for kk in range(rng_start, len(quality_table), rng_step):
+        test, cond = quality_table.loc[kk][['test', args.split_column]]
 
         id = os.path.splitext(test)[0].replace('/', '_')    # Unique ID for each row: test filename without extension
         split = 'train' if cond in train_cond else 'test'
-        dest_name = os.path.join(ft_path, split, id + '_fmap.json')
-        if args.resume and os.path.isfile(dest_name):
-            logging.info(f'Skipping condition {id}')
-            continue
-
-        # Some datasets may have different display models for each row
-        display = quality_table.loc[kk]['display'] if args.display == 'per-row' else args.display
-        disp_photo = pycvvdp.vvdp_display_photometry.load(display)
-        disp_geom = pycvvdp.vvdp_display_geometry.load(display)
-        metric.set_display_model(display_photometry=disp_photo, display_geometry=disp_geom)
+        dest_names[kk] = os.path.join(ft_path, split, id + '_fmap.' + args.features_format)
+        # The features extracted earlier in either format count as done (VideoDataset reads both)
+        done = args.resume and any(os.path.isfile(os.path.join(ft_path, split, id + '_fmap.' + ext)) for ext in ('npz', 'json'))
+        task_list.append( (kk, get_task_cost(args, quality_table.loc[kk]), done) )
 
-        # Create the video source and run the metric
-        try:
-            vs = pycvvdp.video_source_file(os.path.join(args.path_prefix, test),
-                                        os.path.join(args.path_prefix, ref),
-                                        display_photometry=disp_photo,
-                                        full_screen_resize=args.full_screen_resize,
-                                        resize_resolution=disp_geom.resolution,
-                                        verbose=args.verbose)
+    # Without --resume, the queue is created from scratch. With --resume, the tasks that are already in the queue are
+    # kept (so that more workers can join a running extraction) and the tasks of the crashed workers are requeued.
+    tasks = TaskQueue(queue_fname)
+    tasks.add(task_list, reset=not args.resume)
+    if args.resume:
+        requeued = tasks.requeue_stale(timeout=args.task_timeout*3600 if args.task_timeout > 0 else None, failed=True)
+        if requeued > 0:
+            logging.info( f'Requeued {requeued} unfinished conditions' )
+    counts = tasks.counts()
+    logging.info( f"{counts.get('pending', 0)} conditions to process, {counts.get('done', 0)} already done" )
 
-            with torch.no_grad():
-                _, stats = metric.predict_video_source(vs)
-        except:
-            logging.error( f'Failed on condition {id}' )
-            raise
+    if args.jobs > 1:
+        import multiprocessing as mp
+        ctx = mp.get_context('spawn') # CUDA cannot be used with forked processes
+        workers = [ctx.Process(target=_worker_main, args=(args, quality_table, dest_names, queue_fname, slot)) for slot in range(args.jobs)]
+        for ww in workers:
+            ww.start()
+        with tqdm(total=len(task_list), initial=counts.get('done', 0)) as pbar:
+            while any(ww.is_alive() for ww in workers):
+                time.sleep(1.)
+                counts = tasks.counts()
+                pbar.update(counts.get('done', 0) + counts.get('failed', 0) - pbar.n)
+        for ww in workers:
+            ww.join()
+    else:
+        process_tasks(args, quality_table, dest_names, queue_fname)
 
-        metric.write_features_to_json(stats, dest_name)
+    unfinished = tasks.requeue_stale() # Workers that crashed without reporting a failure
+    if unfinished > 0:
+        logging.error( f'{unfinished} condition(s) were not finished, run again with --resume to process them' )
+    failed = tasks.errors()
+    tasks.close()
+    if len(failed) > 0:
+        logging.error( f'Failed on {len(failed)} condition(s), run again with --resume to retry:' )
+        for kk, error in failed:
+            logging.error( f'  {quality_table.loc[kk]["test"]}: {error}' )
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
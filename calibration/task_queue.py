@@ -0,0 +1,110 @@
+import os
+import socket
+import sqlite3
+import time
+
+class TaskQueue:
+    """
+    A queue of tasks (rows of the quality table) shared by the worker processes that extract features. The queue is
+    stored in an SQLite database, so the tasks are handed out to the workers one at a time as they become free, also
+    to workers started later or on other machines (if the database is on a file system that supports file locking).
+    The tasks with the largest cost (e.g. the longest videos) are handed out first, so that the workers finish at
+    a similar time.
+
+    Each task is 'pending', 'running', 'done' or 'failed'. A task that was 'running' in a process that no longer exists
+    (e.g. it crashed or was killed) can be put back to the queue with requeue_stale().
+    """
+    def __init__(self, fname, timeout=60.):
+        self.fname = fname
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        # Autocommit mode - the transactions are started explicitly
+        self.con = sqlite3.connect(fname, timeout=timeout, isolation_level=None)
+        self.con.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, cost REAL, state TEXT, worker TEXT, started REAL, error TEXT)')
+
+    def close(self):
+        self.con.close()
+
+    def add(self, tasks, reset=False):
+        """
+        Add tasks given as a list of (id, cost, done) tuples. The tasks that are already in the queue keep their state,
+        unless they are marked as done. If reset is True, all tasks are removed from the queue first.
+        """
+        with self._transaction():
+            if reset:
+                self.con.execute('DELETE FROM tasks')
+            self.con.executemany('INSERT OR IGNORE INTO tasks (id, cost, state) VALUES (?, ?, ?)',
+                                 [(int(id), float(cost), 'done' if done else 'pending') for id, cost, done in tasks])
+            self.con.executemany("UPDATE tasks SET state='done' WHERE id=? AND state!='running'",
+                                 [(int(id),) for id, cost, done in tasks if done])
+
+    def requeue_stale(self, timeout=None, failed=False):
+        """
+        Put back to the queue the tasks that were running in processes that no longer exist on this machine, and the
+        tasks that have been running for longer than timeout seconds (on any machine). If failed is True, the failed
+        tasks are also put back to the queue. Returns the number of requeued tasks.
+        """
+        host = socket.gethostname()
+        requeue = []
+        with self._transaction():
+            for id, worker, started in self.con.execute("SELECT id, worker, started FROM tasks WHERE state='running'").fetchall():
+                w_host, _, w_pid = worker.rpartition(':')
+                if (w_host == host and not _pid_exists(int(w_pid))) or (not timeout is None and time.time()-started > timeout):
+                    requeue.append((id,))
+            if failed:
+                requeue += self.con.execute("SELECT id FROM tasks WHERE state='failed'").fetchall()
+            self.con.executemany("UPDATE tasks SET state='pending', worker=NULL, started=NULL WHERE id=?", requeue)
+        return len(requeue)
+
+    def claim(self):
+        """
+        Take the pending task with the largest cost and mark it as running in this process. Returns the id of the task
+        or None if there are no pending tasks.
+        """
+        with self._transaction():
+            row = self.con.execute("SELECT id FROM tasks WHERE state='pending' ORDER BY cost DESC, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.con.execute("UPDATE tasks SET state='running', worker=?, started=? WHERE id=?", (self.worker, time.time(), row[0]))
+        return row[0]
+
+    def done(self, id):
+        with self._transaction():
+            self.con.execute("UPDATE tasks SET state='done', error=NULL WHERE id=?", (id,))
+
+    def failed(self, id, error):
+        with self._transaction():
+            self.con.execute("UPDATE tasks SET state='failed', error=? WHERE id=?", (error, id))
+
+    def counts(self):
+        """
+        Returns a dict with the number of tasks in each state.
+        """
+        return dict(self.con.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+
+    def errors(self):
+        return self.con.execute("SELECT id, error FROM tasks WHERE state='failed' ORDER BY id").fetchall()
+
+    def _transaction(self):
+        return _Transaction(self.con)
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE locks the database for writing, so that two workers cannot claim the same task
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        self.con.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, type, value, tb):
+        self.con.execute('COMMIT' if type is None else 'ROLLBACK')
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -29,6 +29,7 @@ def get_args():
     parser.add_argument('-c', '--config-dir', default=None, help="A path to cvvdp configuration files: display_models.json, cvvdp_parameters.json and others.")
     parser.add_argument('--gpu', type=int,  default=0, help='Select which GPU to use (e.g. 0), default is GPU 0. Pass -1 to run on the CPU.')
     parser.add_argument('--resample-bands', action='store_true', default=False)
+    parser.add_argument('--no-feature-cache', action='store_true', default=False, help='Do not store the (resampled) features in a memory-mapped file in the features directory (feature_store*.bin), which is built once and shared by the data loading workers.')
     parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
     # Training args
@@ -85,7 +86,7 @@ def main():
 
     # Dataloaders
     ft_path = 'features' if args.features_suffix is None else 'features_' + args.features_suffix
-    train_loader, val_loader = data.get_loaders(ft_path, train_table, test_table, args.resample_bands, args.batch, args.num_workers)
+    train_loader, val_loader = data.get_loaders(ft_path, train_table, test_table, args.resample_bands, args.batch, args.num_workers, cache=not args.no_feature_cache)
 
     # PyTorch training setup
     opt = optimizers[args.optimizer](params, lr=args.learning_rate)
@@ -0,0 +1,47 @@
+# This example shows how to run ColorVideoVDP in reduced precision (float16 or bfloat16) and how much 
+# the predictions differ from those computed in full (float32) precision. 
+
+# Important: This and other examples should be executed from the main ColorVideoVDP directory:
+# python examples/ex_precision.py
+
+import os
+import time
+import numpy as np
+
+import pycvvdp
+from ex_utils import *
+
+'''
+Results of current version on CPU (for reference):
+Precision fp32: 7.2961 JOD
+Precision fp16: 7.2969 JOD (difference: +0.0009 JOD)
+Precision bf16: 7.2917 JOD (difference: -0.0044 JOD)
+Precision mixed: 7.2949 JOD (difference: -0.0012 JOD)
+
+The differences for videos are tested in tests/test_precision.py.
+'''
+
+display_name = 'standard_fhd'
+media_folder = os.path.join(os.path.dirname(__file__), '..', 'example_media')
+
+I_ref = pycvvdp.load_image_as_array(os.path.join(media_folder, 'tree.jpg'))[:360,:640,:]
+
+np.random.seed(0)
+I_test = imnoise( I_ref, 20/255 )
+
+Q_fp32 = None
+for precision in ['fp32', 'fp16', 'bf16', 'mixed']:
+    # 'fp16' - the temporal filters, pyramid decomposition and masking are computed in float16
+    # 'bf16' - the temporal filters and pyramid decomposition are computed in float16, masking in bfloat16
+    # 'mixed' - the temporal filters and pyramid decomposition are computed in float16, masking in float32
+    metric = pycvvdp.cvvdp(display_name=display_name, precision=precision)
+
+    start = time.time()
+    Q_JOD, stats = metric.predict( I_test, I_ref, dim_order="HWC" )
+    end = time.time()
+
+    if Q_fp32 is None:
+        Q_fp32 = Q_JOD
+        print( f'Precision {precision}: {Q_JOD:.4f} JOD (took {end-start:.4f} secs to compute)' )
+    else:
+        print( f'Precision {precision}: {Q_JOD:.4f} JOD (difference: {Q_JOD-Q_fp32:+.4f} JOD, took {end-start:.4f} secs to compute)' )
@@ -1,6 +1,54 @@
-from pycvvdp.cvvdp_metric import cvvdp
-from pycvvdp.cvvdp_nn_metric import cvvdp_nn
-from pycvvdp.pupsnr import pu_psnr_y, pu_psnr_rgb2020, psnr_rgb
-from pycvvdp.video_source_file import video_source_file, video_source_video_file, load_image_as_array
-from pycvvdp.display_model import vvdp_display_photometry, vvdp_display_photo_eotf, vvdp_display_geometry
-from pycvvdp.video_source_yuv import video_source_yuv_file
+# The classes are imported on the first access (PEP 562) so that `import pycvvdp` does not load PyTorch 
+# and other heavy dependencies until they are needed, e.g. when only parsing command line arguments.
+import importlib
+import sys
+import types
+
+_lazy_attributes = {
+    'cvvdp': 'pycvvdp.cvvdp_metric',
+    'cvvdp_nn': 'pycvvdp.cvvdp_nn_metric',
+    'pu_psnr_y': 'pycvvdp.pupsnr',
+    'pu_psnr_rgb2020': 'pycvvdp.pupsnr',
+    'psnr_rgb': 'pycvvdp.pupsnr',
+    'video_source_file': 'pycvvdp.video_source_file',
+    'video_source_video_file': 'pycvvdp.video_source_file',
+    'load_image_as_array': 'pycvvdp.video_source_file',
+    'vvdp_display_photometry': 'pycvvdp.display_model',
+    'vvdp_display_photo_eotf': 'pycvvdp.display_model',
+    'vvdp_display_geometry': 'pycvvdp.display_model',
+    'video_source_yuv_file': 'pycvvdp.video_source_yuv',
+    'reference_cache': 'pycvvdp.reference_cache',
+    'cvvdp_stream': 'pycvvdp.cvvdp_stream',
+    'temporal_sampling': 'pycvvdp.temporal_sampling',
+    'heatmap_sink': 'pycvvdp.heatmap_sink',
+    'heatmap_video_writer': 'pycvvdp.heatmap_sink',
+    'heatmap_image_frames': 'pycvvdp.heatmap_sink',
+    'heatmap_memmap': 'pycvvdp.heatmap_sink',
+}
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value # Do not look it up again
+        return value
+    if not name.startswith('_'):
+        # Submodules (e.g. pycvvdp.utils) are also imported on the first access
+        try:
+            return importlib.import_module(f'{__name__}.{name}')
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+    raise AttributeError(f"module 'pycvvdp' has no attribute '{name}'")
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazy_attributes.keys()))
+
+class _lazy_module(types.ModuleType):
+    # Importing a submodule sets the package attribute of the same name (e.g. pycvvdp.video_source_file), 
+    # which would hide the class with the same name. Keep the class instead. 
+    def __setattr__(self, name, value):
+        if name in _lazy_attributes and isinstance(value, types.ModuleType) and value.__name__ == _lazy_attributes[name]:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _lazy_module
@@ -1,29 +1,93 @@
+import os
+import threading
 import torch
 import pycvvdp.utils as utils
 
-from interp import interp1q, batch_interp1d
+from pycvvdp.interp import interp1q, batch_interp1d, get_interpolants_quick
 
-class castleCSF:
+# The CSF look-up tables, shared by all castleCSF objects in the process. Each entry is keyed by the LUT 
+# file, its modification time and the device so that the JSON file is parsed and copied to the device only once, 
+# and the rho-resolved tables are computed only once for all metric instances (e.g. those created by run_cvvdp
+# for several display models, or in the interactive/server mode). 
+_csf_tables = {}
+_csf_tables_lock = threading.Lock()
 
-    def __init__(self, csf_version, device, config_paths=[]):
-        self.device = device
-        csf_lut_file = utils.config_files.find( f"csf_lut_{csf_version}.json", config_paths )
-        csf_lut = utils.json2dict(csf_lut_file)
+def load_csf_tables( csf_lut_file, device ):
+    key = (os.path.abspath(csf_lut_file), os.path.getmtime(csf_lut_file), str(device))
+    with _csf_tables_lock:
+        if key in _csf_tables:
+            return _csf_tables[key]
 
-        self.log_L_bkg = torch.log10( torch.as_tensor(csf_lut["L_bkg"], device=device) )
-        self.log_rho = torch.log10( torch.as_tensor(csf_lut["rho"], device=device) )
-        self.omega = csf_lut["omega"]
+        csf_lut = utils.json2dict(csf_lut_file)
+        tables = {}
+        tables['log_L_bkg'] = torch.log10( torch.as_tensor(csf_lut["L_bkg"], device=device) )
+        tables['log_rho'] = torch.log10( torch.as_tensor(csf_lut["rho"], device=device) )
+        tables['omega'] = csf_lut["omega"]
 
-        self.logS = []
+        logS = []
         for oo in range(2): # For each temp frequency
-            self.logS.append([])
+            logS.append([])
             ch_num = 3 if oo==0 else 1
             for cc in range(ch_num):
-                field_name = f"o{self.omega[oo]}_c{cc+1}"
-                self.logS[oo].append( torch.as_tensor(csf_lut[field_name], device=device) )
+                field_name = f"o{tables['omega'][oo]}_c{cc+1}"
+                logS[oo].append( torch.as_tensor(csf_lut[field_name], device=device) )
+        tables['logS'] = logS
+        tables['logS_rho'] = {} # (oo, cc, rho) -> log sensitivity as a function of log luminance
+        tables['S_dense'] = {}  # (oo, cc, rho, lut_size) -> dense LUT of sensitivity
+
+        _csf_tables[key] = tables
+        return tables
+
+'''
+The castleCSF model, implemented as the look-up tables stored in the csf_lut_*.json files. 
+
+If dense_lut_size is not None, the sensitivity for each spatial frequency is resampled to a dense LUT of 
+dense_lut_size uniformly spaced log-luminance levels and the per-pixel look-up is done with the nearest 
+sample (a single gather) instead of the linear interpolation. This is faster but slightly less accurate.
+'''
+class castleCSF:
+
+    def __init__(self, csf_version, device, config_paths=[], dense_lut_size=None):
+        self.device = device
+        self.csf_lut_file = utils.config_files.find( f"csf_lut_{csf_version}.json", config_paths )
+        self.dense_lut_size = dense_lut_size
+        self.set_tables( load_csf_tables(self.csf_lut_file, device) )
+
+    def set_tables( self, tables ):
+        self.tables = tables
+        self.log_L_bkg = tables['log_L_bkg']
+        self.log_rho = tables['log_rho']
+        self.omega = tables['omega']
+        self.logS = tables['logS']
+        self.logS_rho = tables['logS_rho']
+        self.S_dense = tables['S_dense']
 
-        self.logS_rho = {}
+    # Compute the LUTs for the given list of spatial frequencies (e.g. all the bands of a pyramid) in one go, 
+    # so that there is no interpolation across spatial frequencies when the sensitivity is computed. 
+    def precompute( self, rho_list ):
+        N = self.log_L_bkg.numel()
+        for oo in range(2):
+            for cc in range(len(self.logS[oo])):
+                missing = [rho for rho in rho_list if not (oo, cc, rho) in self.logS_rho]
+                if not missing:
+                    continue
+                log_rho_q = torch.log10(torch.as_tensor(missing, device=self.device, dtype=torch.float32))
+                logS_r = batch_interp1d(log_rho_q.repeat_interleave(N), self.log_rho, self.logS[oo][cc].repeat(len(missing),1)).view(len(missing),N)
+                for kk, rho in enumerate(missing):
+                    self.logS_rho[(oo, cc, rho)] = logS_r[kk]
 
+    def get_logS_rho( self, rho, oo, cc ):
+        key = (oo, cc, rho)
+        if not key in self.logS_rho: 
+            self.precompute( [rho] )
+        return self.logS_rho[key]
+
+    def get_dense_lut( self, rho, oo, cc ):
+        key = (oo, cc, rho, self.dense_lut_size)
+        if not key in self.S_dense:
+            log_L_dense = torch.linspace( self.log_L_bkg[0], self.log_L_bkg[-1], self.dense_lut_size, device=self.device )
+            self.S_dense[key] = 10**interp1q( self.log_L_bkg, self.get_logS_rho(rho, oo, cc), log_L_dense )
+        return self.S_dense[key]
 
     def sensitivity(self, rho, omega, logL_bkg, cc, sigma):
         # rho - spatial frequency
@@ -33,29 +97,44 @@ class castleCSF:
 
         # Which LUT to use
         oo = 0 if omega==0 else 1
-        logS = self.logS[oo][cc]
 
-        # First interpolate between spatial frequencies rho
-        rho_str = f"o{oo}_c{cc}_rho{rho}"
-        if rho_str in self.logS_rho: # Check if it is cached
-            logS_r = self.logS_rho[rho_str]
-        else:
-            N = self.log_L_bkg.numel()
-            logS_r = torch.empty((N), device=self.device)
-            logS_r = batch_interp1d(torch.log10(torch.as_tensor(rho, device=self.device, dtype=torch.float32)).expand(N), self.log_rho, logS)
-            self.logS_rho[rho_str] = logS_r        
+        if not self.dense_lut_size is None:
+            # Nearest sample from the dense LUT - no interpolation
+            S_dense = self.get_dense_lut(rho, oo, cc)
+            x0, x1 = self.log_L_bkg[0], self.log_L_bkg[-1]
+            ind = ((logL_bkg-x0)*((self.dense_lut_size-1)/(x1-x0))).round().clamp(0, self.dense_lut_size-1).long()
+            return S_dense[ind]
+
+        # First interpolate between spatial frequencies rho (cached)
+        logS_r = self.get_logS_rho(rho, oo, cc)
 
         # Then, interpolate across luminance levels    
         S = 10**interp1q( self.log_L_bkg, logS_r, logL_bkg )
 
         return S
 
+    # Sensitivity for several channels at once, given as a list of (omega, cc) pairs. The result has the shape 
+    # [len(omega_cc), *logL_bkg.shape]. The interpolants across luminance levels are computed once and shared
+    # by all channels. The result is the same as calling sensitivity() for each channel. 
+    def sensitivity_channels(self, rho, omega_cc, logL_bkg, sigma):
+        shp = logL_bkg.shape
+        S = torch.empty( (len(omega_cc),)+shp, device=logL_bkg.device )
+        x_q = logL_bkg.flatten()
+        if not self.dense_lut_size is None:
+            x0, x1 = self.log_L_bkg[0], self.log_L_bkg[-1]
+            ind = ((x_q-x0)*((self.dense_lut_size-1)/(x1-x0))).round().clamp(0, self.dense_lut_size-1).long()
+            for kk, (omega, cc) in enumerate(omega_cc):
+                oo = 0 if omega==0 else 1
+                S[kk] = self.get_dense_lut(rho, oo, cc)[ind].view(shp)
+        else:
+            imin, imax, ifrc = get_interpolants_quick(x_q, self.log_L_bkg)
+            ifrc_c = 1.0-ifrc
+            for kk, (omega, cc) in enumerate(omega_cc):
+                oo = 0 if omega==0 else 1
+                logS_r = self.get_logS_rho(rho, oo, cc)
+                S[kk] = (10**(logS_r[imin] * ifrc_c + logS_r[imax] * ifrc)).view(shp)
+        return S
+
     def update_device( self, device ):
         self.device = device
-        self.log_L_bkg = self.log_L_bkg.to(device)
-        self.log_rho = self.log_rho.to(device)
-
-        for oo in range(2): # For each temp frequency
-            ch_num = 3 if oo==0 else 1
-            for cc in range(ch_num):
-                self.logS[oo][cc] = self.logS[oo][cc].to(device)
+        self.set_tables( load_csf_tables(self.csf_lut_file, device) )
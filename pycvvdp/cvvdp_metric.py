@@ -1,14 +1,8 @@
 from abc import abstractmethod
-from urllib.parse import ParseResultBytes
-try:
-    from numpy import expand_dims
-except ImportErorr:
-    from numpy.lib.shape_base import expand_dims
 import math
 import torch
 from torch.utils import checkpoint
 from torch.functional import Tensor
-from torchvision.transforms import GaussianBlur
 import torch.nn.functional as Func
 import numpy as np 
 import os
@@ -17,25 +11,13 @@ import json
 #import argparse
 #import time
 #import math
-import torch.utils.benchmark as torchbench
 import logging
 from datetime import date
 
-try:
-    import matplotlib.pyplot as plt
-    from matplotlib import ticker
-    from matplotlib.colors import Normalize
-    has_matplotlib = True
-except:
-    has_matplotlib = False
-
-try:
-    from pynvml import nvmlInit, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
-    has_nvml = True
-except:
-    has_nvml = False
-
-from pycvvdp.visualize_diff_map import visualize_diff_map
+# Optional dependencies (matplotlib for distograms, pynvml for querying free GPU memory) are 
+# imported on the first use, so that they do not slow down `import pycvvdp`
+
+from pycvvdp.visualize_diff_map import visualize_diff_map, visualize_diff_map_uint8
 from pycvvdp.video_source import *
 
 from pycvvdp.vq_metric import *
@@ -49,9 +31,8 @@ from pycvvdp.dump_channels import DumpChannels
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from third_party.cpuinfo import cpuinfo
 from pycvvdp.lpyr_dec import lpyr_dec, lpyr_dec_2, weber_contrast_pyr, log_contrast_pyr
-from interp import interp1, interp3, interp1dim2
+from pycvvdp.interp import interp1, interp3, interp1dim2
 
 import pycvvdp.utils as utils
 
@@ -60,6 +41,7 @@ import pycvvdp.utils as utils
 
 from pycvvdp.display_model import vvdp_display_photometry, vvdp_display_geometry
 from pycvvdp.csf import castleCSF
+from pycvvdp.memory_model import load_memory_model, calibrate_memory_model, is_out_of_memory
 
 
 def safe_pow( x:Tensor, p ): 
@@ -85,12 +67,35 @@ def pow_neg( x:Tensor, p ):
 ColourVideoVDP metric. Refer to pytorch_examples for examples on how to use this class. 
 """
 class cvvdp(vq_metric):
-    def __init__(self, display_name="standard_4k", display_photometry=None, display_geometry=None, config_paths=[], heatmap=None, quiet=False, device=None, temp_padding="replicate", use_checkpoints=False, calibrated_ckpt=None, dump_channels=None, gpu_mem = None):
+    def __init__(self, display_name="standard_4k", display_photometry=None, display_geometry=None, config_paths=[], heatmap=None, quiet=False, device=None, temp_padding="replicate", use_checkpoints=False, calibrated_ckpt=None, dump_channels=None, gpu_mem = None, ref_cache=None, dense_csf_lut=False, fused_masking=True, compile=False, precision='fp32', tile_size=None):
         self.quiet = quiet
         self.heatmap = heatmap
         self.temp_padding = temp_padding
         self.use_checkpoints = use_checkpoints # Used for training
         self.gpu_mem = gpu_mem # how many GB of memory we are allowed to use
+        self.dense_csf_lut = dense_csf_lut # When True, look up the CSF in a dense LUT (nearest sample) instead of interpolating
+        self.fused_masking = fused_masking # When True, use the in-place implementation of the masking model (if possible)
+        self.compile = compile # When True, compile the processing of a block of frames with torch.compile (CUDA graphs on CUDA)
+        self.compiled_blocks = {} # (channels, height, width, temp_ch, is_image, device) -> (frames, compiled process_block_of_frames)
+
+        # Precision of the computations:
+        #   'fp32' - all in float32
+        #   'fp16' - the temporal buffers, pyramid and the masking model in float16
+        #   'bf16' - the temporal buffers and pyramid in float16, the masking model in bfloat16 (the 8-bit mantissa of 
+        #            bfloat16 is too coarse for the luminance in the temporal buffers and the pyramid)
+        #   'mixed' - the temporal buffers and pyramid in float16, the masking model in float32
+        # The CSF look-up and the pooling are always done in float32.
+        assert precision in ['fp32', 'fp16', 'bf16', 'mixed'], "Unknown precision"
+        self.precision = precision
+        self.dtype = torch.float32 if precision == 'fp32' else torch.float16 # The temporal buffers and the pyramid
+        self.mask_dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16, 'mixed': torch.float32}[precision]
+
+        # When not None, the bands larger than tile_size x tile_size pixels are processed in tiles (see process_block_of_frames_tiled)
+        self.tile_size = tile_size
+
+        # When not None, the number of frames processed at once (instead of the value from estimate_block_N)
+        self.block_N_frames = None
+        self.cpu_max_block_N = 8 # The maximum number of frames processed at once on CPU
 
         assert heatmap in ["threshold", "supra-threshold", "raw", "none", None], "Unknown heatmap type"            
 
@@ -110,11 +115,14 @@ class cvvdp(vq_metric):
         self.temp_resample = False  # When True, resample the temporal features to nominal_fps
         self.nominal_fps = 240
 
+        self.config_paths = config_paths
+        self.calibrated_ckpt = calibrated_ckpt
         self.load_config(config_paths)
         if calibrated_ckpt is not None:
             self.update_from_checkpoint(calibrated_ckpt)
 
         self.dump_channels = dump_channels
+        self.ref_cache = ref_cache # reference_cache object, used to reuse the reference features across test videos
 
         # if self.mask_s > 0.0:
         #     self.mask_p = self.mask_q + self.mask_s
@@ -143,7 +151,7 @@ class cvvdp(vq_metric):
         self.mask_c = torch.as_tensor( parameters['mask_c'], device=self.device ) # content masking adjustment
         self.pu_dilate = parameters['pu_dilate']
         if self.pu_dilate>0:
-            self.pu_blur = GaussianBlur(int(self.pu_dilate*4)+1, self.pu_dilate)
+            self.pu_blur = utils.GaussianBlur(int(self.pu_dilate*4)+1, self.pu_dilate)
             self.pu_padsize = int(self.pu_dilate*2)
             
         self.beta = torch.as_tensor( parameters['beta'], device=self.device ) # The exponent of the spatial summation (p-norm)
@@ -155,7 +163,7 @@ class cvvdp(vq_metric):
         self.masking_model = parameters['masking_model']
         if "texture" in self.masking_model:
             tex_blur_sigma = 8
-            self.tex_blur = GaussianBlur(int(tex_blur_sigma*4)+1, tex_blur_sigma)
+            self.tex_blur = utils.GaussianBlur(int(tex_blur_sigma*4)+1, tex_blur_sigma)
             self.tex_pad_size = int(tex_blur_sigma*2)
 
         self.csf = parameters['csf']
@@ -213,7 +221,7 @@ class cvvdp(vq_metric):
 
         self.omega = [0, 5]
 
-        self.csf = castleCSF(csf_version=self.csf, device=self.device, config_paths=config_paths)
+        self.csf = castleCSF(csf_version=self.csf, device=self.device, config_paths=config_paths, dense_lut_size=(4096 if self.dense_csf_lut else None))
 
         # Mask to block selected channels, used in the ablation stdies [Ysust, RB, YV, Ytrans]
         self.block_channels = torch.as_tensor( parameters['block_channels'], device=self.device, dtype=torch.bool ) if 'block_channels' in parameters else None
@@ -276,11 +284,23 @@ class cvvdp(vq_metric):
           'circular'  - tile the video in the front, so that the last frame is used for frame 0.
           'pingpong'  - the video frames are mirrored so that frames -1, -2, ... correspond to frames 0, 1, ...
     '''
-    def predict(self, test_cont, reference_cont, dim_order="BCFHW", frames_per_second=0):
+    def predict(self, test_cont, reference_cont, dim_order="BCFHW", frames_per_second=0, heatmap_sink=None):
 
         test_vs = video_source_array( test_cont, reference_cont, frames_per_second, dim_order=dim_order, display_photometry=self.display_photometry )
 
-        return self.predict_video_source(test_vs)
+        return self.predict_video_source(test_vs, heatmap_sink=heatmap_sink)
+
+    '''
+    Create a stream for computing the quality of a video that is supplied frame by frame (e.g. a live transcode), 
+    without knowing its length in advance. Frames are added with `push(test_frame, reference_frame)` and the 
+    quality of the frames pushed so far can be read at any point with `current_jod()`. The memory used does not 
+    depend on the length of the video. If early_exit_ci is set, `push` returns True once the confidence interval
+    of the JOD is narrower than early_exit_ci (but not earlier than after min_duration seconds). 
+    See pycvvdp.cvvdp_stream for details. 
+    '''
+    def stream(self, frames_per_second, height, width, block_N_frames=1, early_exit_ci=None, min_duration=2.0, ci_level=0.95):
+        from pycvvdp.cvvdp_stream import cvvdp_stream
+        return cvvdp_stream(self, frames_per_second, height, width, block_N_frames=block_N_frames, early_exit_ci=early_exit_ci, min_duration=min_duration, ci_level=ci_level)
 
     '''
     Compute a loss function between test and reference images/videos. Used as an optimization term in which the loss is minimized. 
@@ -294,23 +314,138 @@ class cvvdp(vq_metric):
 
     '''
     The same as `predict` but takes as input fvvdp_video_source_* object instead of Numpy/Pytorch arrays. Video source is recommended when processing long videos as it allows frame-by-frame loading.
+
+    temporal_sampling - if a pycvvdp.temporal_sampling object is passed, only the selected segments of the video are evaluated 
+        (see predict_sampled). 
+    heatmap_sink - if a pycvvdp.heatmap_sink object is passed (e.g. heatmap_video_writer), the heatmap is passed to it block by 
+        block instead of being returned in stats['heatmap'], so that the heatmap of a long video is not stored in the memory. 
+    '''
+    def predict_video_source(self, vid_source, temporal_sampling=None, heatmap_sink=None):
+        if not temporal_sampling is None and vid_source.get_video_size()[2] > 1:
+            if not heatmap_sink is None:
+                raise RuntimeError( "Heatmap sinks cannot be used with temporal sampling" )
+            return self.predict_sampled(vid_source, temporal_sampling)
+        return self.predict_batch([vid_source], heatmap_sinks=None if heatmap_sink is None else [heatmap_sink])[0]
+
+    '''
+    Predict the quality of a single (long) video on several devices at once. The frames are split into contiguous shards 
+    (shards_per_device per device) that are processed in parallel in worker processes, one per device, each holding its own 
+    copy of the metric. devices is a list of devices, e.g. ['cuda:0', 'cuda:1'], or ['cpu', 'cpu'] for several CPU workers. 
+    make_vid_source must be a picklable function (e.g. functools.partial(pycvvdp.video_source_file, test_fname, ref_fname, ...)) 
+    that creates the video source - each worker opens the video on its own. The results are the same as those of 
+    predict_video_source, up to floating point rounding. Heatmaps are not supported. 
+    '''
+    def predict_sharded(self, make_vid_source, devices, shards_per_device=1):
+        from pycvvdp.frame_sharding import predict_sharded
+        return predict_sharded(self, make_vid_source, devices, shards_per_device=shards_per_device)
+
+    '''
+    Predict the quality of a long video by evaluating only the segments selected by temporal_sampling (pycvvdp.temporal_sampling). 
+    Each segment is preceded by filter_len-1 frames that fill the temporal filters, so the evaluated frames have the same 
+    Q_per_ch as when the whole video is processed. Segments that are closer than that are evaluated in a single pass. 
+    The quality of each segment is extrapolated to its stratum (the segment is repeated to fill the stratum) and the 
+    extrapolated Q_per_ch is pooled as usual. 
+
+    In addition to the usual statistics, stats contains:
+      'jod_sampling_error' - the standard error of the JOD due to the sampling (in JOD units), estimated from the variation 
+                             of the quality between the segments (NaN if there is only one stratum)
+      'frames_evaluated'   - the number of frames that were scored (without the frames filling the temporal filters)
+    '''
+    def predict_sampled(self, vid_source, temporal_sampling):
+        if self.do_heatmap:
+            raise RuntimeError( "Heatmaps are not supported when only some segments of a video are evaluated" )
+        if self.temp_resample:
+            raise RuntimeError( "Temporal resampling is not supported when only some segments of a video are evaluated" )
+
+        height, width, N_frames = vid_source.get_video_size()
+        fps = vid_source.get_frames_per_second()
+        F, _ = self.get_temporal_filters(fps)
+        prime_len = torch.numel(F[0])-1 # Frames needed to fill the temporal filters
+
+        strata = temporal_sampling.get_strata(N_frames, fps)
+
+        # Group the segments into runs of consecutive frames, each starting prime_len frames before its first segment
+        runs = [] # [first frame, end frame, [strata]]
+        for st in strata:
+            r0 = max(0, st[2]-prime_len)
+            if runs and r0 <= runs[-1][1]:
+                runs[-1][1] = st[3]
+                runs[-1][2].append(st)
+            else:
+                runs.append([r0, st[3], [st]])
+
+        Q_per_ch = None
+        Q_seg_p = []  # Mean Q_tc^beta_t of each segment, for the sampling error
+        for r0, r1, run_strata in runs:
+            Q_run_jod, stats = self.predict_batch([video_source_segment(vid_source, r0, r1-r0)])[0]
+            Q_run = torch.as_tensor(stats['Q_per_ch'], device=self.device)
+            if Q_per_ch is None:
+                Q_per_ch = torch.empty((Q_run.shape[0], N_frames, Q_run.shape[2]), device=self.device)
+            for t0, t1, p0, p1 in run_strata:
+                Q_seg = Q_run[:,(p0-r0):(p1-r0),:]
+                ind = torch.arange(t1-t0, device=self.device) % (p1-p0)
+                Q_per_ch[:,t0:t1,:] = Q_seg[:,ind,:]
+                Q_tc = self.pool_channels(self.pool_spatial_bands(Q_seg))
+                Q_seg_p.append( safe_pow(Q_tc, self.beta_t).mean() )
+
+        rho_band = stats['rho_band']
+        Q_jod = self.do_pooling_and_jods(Q_per_ch, rho_band[-1], fps)
+
+        # Standard error of the mean of Q_tc^beta_t for stratified sampling with one segment per stratum, 
+        # with the finite population correction
+        w = torch.as_tensor([t1-t0 for t0, t1, p0, p1 in strata], dtype=torch.float32, device=self.device)/N_frames
+        x = torch.stack(Q_seg_p)
+        n = len(strata)
+        frames_evaluated = sum([p1-p0 for t0, t1, p0, p1 in strata])
+        if n > 1:
+            M = torch.sum(w*x)
+            se = torch.sqrt( torch.sum(w*w*(x-M)**2) * n/(n-1) * (1.-frames_evaluated/N_frames) )
+            Q_bounds = safe_pow(torch.stack( ((M-se).clamp(min=0.), M+se) ), 1/self.beta_t)
+            jod_bounds = self.met2jod(Q_bounds)
+            jod_sampling_error = float(jod_bounds[0]-jod_bounds[1])/2.
+        else:
+            jod_sampling_error = float('nan')
+
+        stats['Q_per_ch'] = Q_per_ch.detach().cpu().numpy()
+        stats['N_frames'] = N_frames
+        stats['jod_sampling_error'] = jod_sampling_error
+        stats['frames_evaluated'] = frames_evaluated
+
+        return (Q_jod.squeeze(), stats)
+
+    '''
+    Predict quality for several test/reference pairs at once. vid_sources is a list of fvvdp_video_source_* objects, which must all have 
+    the same resolution, number of frames and frame rate. The pairs are stacked along the frame dimension so that the temporal filtering, 
+    pyramid decomposition, CSF and masking are run once per block of frames for the whole batch. This improves GPU utilization when
+    scoring many short or low-resolution pairs.
+
+    heatmap_sinks - an optional list with one pycvvdp.heatmap_sink per video source (see predict_video_source).
+
+    Returns a list with one (Q_jod, stats) tuple per video source, in the same order as vid_sources. 
     '''
-    def predict_video_source(self, vid_source):
+    def predict_batch(self, vid_sources, heatmap_sinks=None):
         # We assume the pytorch default NCDHW layout
 
-        vid_sz = vid_source.get_video_size() # H, W, F
+        B = len(vid_sources)
+        if B == 0:
+            return []
+
+        vid_sz = tuple(vid_sources[0].get_video_size()) # H, W, F
         height, width, N_frames = vid_sz
+        src_fps = vid_sources[0].get_frames_per_second()
+
+        for vs in vid_sources[1:]:
+            if tuple(vs.get_video_size()) != vid_sz or vs.get_frames_per_second() != src_fps:
+                raise RuntimeError( "All video sources in a batch must have the same resolution, number of frames and frame rate" )
+
+        if self.dump_channels and B>1:
+            raise RuntimeError( "Dumping channels is not supported when processing a batch of video sources" )
 
         # 'medium' is a bit slower than 'high' on 3090
         # torch.set_float32_matmul_precision('medium')
 
         if self.lpyr is None or self.lpyr.W!=width or self.lpyr.H!=height:
-            if self.contrast.startswith("weber"):
-                self.lpyr = weber_contrast_pyr(width, height, self.pix_per_deg, self.device, contrast=self.contrast)
-            elif self.contrast.startswith("log"):
-                self.lpyr = log_contrast_pyr(width, height, self.pix_per_deg, self.device, contrast=self.contrast)
-            else:
-                raise RuntimeError( f"Unknown contrast {self.contrast}" )
+            self.lpyr = self.create_contrast_pyramid(width, height)
 
             if self.do_heatmap:
                 self.heatmap_pyr = lpyr_dec_2(width, height, self.pix_per_deg, self.device)
@@ -324,166 +459,223 @@ class cvvdp(vq_metric):
             temp_ch = 1  # How many temporal channels
         else:
             temp_ch = 2
-            self.F, omega_tmp = self.get_temporal_filters(vid_source.get_frames_per_second())
+            self.F, omega_tmp = self.get_temporal_filters(src_fps)
             self.filter_len = torch.numel(self.F[0])
 
         all_ch = 2+temp_ch
 
+        if not heatmap_sinks is None:
+            if not self.do_heatmap:
+                raise RuntimeError( "A heatmap sink was passed, but the metric does not compute heatmaps (heatmap=None)" )
+            if len(heatmap_sinks) != B:
+                raise RuntimeError( "There must be one heatmap sink per video source" )
+
         if self.do_heatmap:
             dmap_channels = 1 if self.heatmap == "raw" else 3
-            heatmap = torch.zeros([1,dmap_channels,N_frames,height,width], dtype=torch.float16, device=torch.device('cpu')) # Store heatmap in the CPU memory
+            if heatmap_sinks is None:
+                heatmaps = [torch.zeros([1,dmap_channels,N_frames,height,width], dtype=torch.float16, device=torch.device('cpu')) for bi in range(B)] # Store heatmap in the CPU memory
+            else:
+                for sink in heatmap_sinks:
+                    sink.open(width, height, N_frames, src_fps, dmap_channels)
         else:
-            heatmap = None
+            heatmaps = None
 
-        sw_buf = [None, None]
+        sw_buf = None
         Q_per_ch = None
 
         fl = self.filter_len
 
-        if self.device.type == 'cuda' and torch.cuda.is_available() and not is_image:
+        pix_cnt = width*height*B # All pairs in the batch share the same block of frames
+        if self.tile_size is None:
+            tile_pix_cnt = None
+        else:
+            tile_side = self.tile_size + 2*self.get_tile_margin()
+            tile_pix_cnt = min(width,tile_side)*min(height,tile_side)*B
+        if is_image:
+            block_N_frames = 1
+        elif not self.block_N_frames is None:
+            block_N_frames = min(self.block_N_frames, N_frames)
+        elif self.device.type == 'cuda' and torch.cuda.is_available():
             # GPU utilization is better if we process many frames, but it requires more GPU memory
-            pix_cnt = width*height
-            block_N_frames = self.estimate_block_N(pix_cnt, N_frames)
+            block_N_frames = self.estimate_block_N(pix_cnt, N_frames, tile_pix_cnt=tile_pix_cnt)
+        elif self.device.type == 'cpu' and not self.get_memory_model() is None:
+            # Processing several frames at once helps vectorization on CPU, but only if we know how much memory is needed
+            block_N_frames = self.estimate_block_N(pix_cnt, N_frames, tile_pix_cnt=tile_pix_cnt)
         else:
             block_N_frames = 1
 
-        if self.contrast=="log":
-            met_colorspace='logLMS_DKLd65'
-        else:
-            met_colorspace='DKLd65' # This metric uses DKL colourspaxce with d65 whitepoint
+        met_colorspace = self.get_met_colorspace()
 
         if self.dump_channels:
-            self.dump_channels.open(vid_source.get_frames_per_second())
+            self.dump_channels.open(src_fps)
+
+        # Reuse the features of the reference if the same reference was already processed
+        ref_key = None
+        ref_hit = False
+        if not self.ref_cache is None and B==1 and not self.dump_channels and not self.use_checkpoints and self.tile_size is None:
+            ref_key = self.get_reference_cache_key(vid_sources[0], met_colorspace)
+            if not ref_key is None:
+                if self.ref_cache.contains(ref_key):
+                    ref_hit = True
+                    block_N_frames = self.ref_cache.get_block_N_frames(ref_key)
+                else:
+                    self.ref_cache.begin(ref_key, block_N_frames)
 
+        # If a block runs out of memory, it is split into smaller blocks (not possible when the reference features are cached)
+        can_split = not is_image and ref_key is None and not self.use_checkpoints and not self.dump_channels
 
-        for ff in range(0, N_frames, block_N_frames):
+        ff = 0
+        while ff < N_frames:
             cur_block_N_frames = min(block_N_frames,N_frames-ff) # How many frames in this block?
 
             if is_image:                
-                R = torch.empty((1, 6, 1, height, width), device=self.device)
-                R[:,0::2, :, :, :] = vid_source.get_test_frame(0, device=self.device, colorspace=met_colorspace)
-                R[:,1::2, :, :, :] = vid_source.get_reference_frame(0, device=self.device, colorspace=met_colorspace)
+                R = torch.empty((B, 6, 1, height, width), device=self.device, dtype=self.dtype)
+                for bi, vs in enumerate(vid_sources):
+                    R[bi:(bi+1),0::2, :, :, :] = vs.get_test_frame(0, device=self.device, colorspace=met_colorspace)
+                    if not ref_hit:
+                        R[bi:(bi+1),1::2, :, :, :] = vs.get_reference_frame(0, device=self.device, colorspace=met_colorspace)
 
             else: # This is video
                 #if self.debug: print("Frame %d:\n----" % ff)
 
+                # The sliding window buffer is a ring buffer: frame n is stored at the index n % ring_len. 
+                # sw_buf[:,0,...] is the test and sw_buf[:,1,...] is the reference
                 if ff == 0: # First frame
-                    sw_buf[0] = torch.zeros((1,3,fl+block_N_frames-1,height,width), device=self.device, dtype=torch.float32) # TODO: switch to float16
-                    sw_buf[1] = torch.zeros((1,3,fl+block_N_frames-1,height,width), device=self.device, dtype=torch.float32)
+                    ring_len = fl+block_N_frames-1
+                    sw_buf = torch.zeros((B,2,3,ring_len,height,width), device=self.device, dtype=self.dtype)
 
                     if self.debug and not hasattr( self, 'sw_buf_allocated' ):
                         # Memory allocated after creating buffers for temporal filters 
                         self.sw_buf_allocated = torch.cuda.max_memory_allocated(self.device)
 
-                    if self.temp_padding == "replicate":
-                        for fi in range(cur_block_N_frames):
-                            ind = fl+fi-1
-                            sw_buf[0][:,:,ind:ind+1,:,:] = vid_source.get_test_frame(ff+fi, device=self.device, colorspace=met_colorspace)
-                            sw_buf[1][:,:,ind:ind+1,:,:] = vid_source.get_reference_frame(ff+fi, device=self.device, colorspace=met_colorspace)
-
-                        ind = fl-1
-                        sw_buf[0][:,:,0:-cur_block_N_frames,:,:] = sw_buf[0][:,:,ind:ind+1,:,:] # Replicate the first frame
-                        sw_buf[1][:,:,0:-cur_block_N_frames,:,:] = sw_buf[1][:,:,ind:ind+1,:,:] # Replicate the first frame
-
-                    # elif self.temp_padding == "circular":
-                    #     sw_buf[0] = torch.zeros([1, 1, fl, height, width], device=self.device)
-                    #     sw_buf[1] = torch.zeros([1, 1, fl, height, width], device=self.device)
-                    #     for kk in range(fl):
-                    #         fidx = (N_frames - 1 - fl + kk) % N_frames
-                    #         sw_buf[0][:,:,kk,...] = vid_source.get_test_frame(fidx, device=self.device)
-                    #         sw_buf[1][:,:,kk,...] = vid_source.get_reference_frame(fidx, device=self.device)
-                    # elif self.temp_padding == "pingpong":
-                    #     sw_buf[0] = torch.zeros([1, 1, fl, height, width], device=self.device)
-                    #     sw_buf[1] = torch.zeros([1, 1, fl, height, width], device=self.device)
-
-                    #     pingpong = list(range(0,N_frames)) + list(range(N_frames-2,0,-1))
-                    #     indices = []
-                    #     while(len(indices) < (fl-1)):
-                    #         indices = indices + pingpong
-                    #     indices = indices[-(fl-1):] + [0]
-
-                    #     for kk in range(fl):
-                    #         fidx = indices[kk]
-                    #         sw_buf[0][:,:,kk,...] = vid_source.get_test_frame(fidx,device=self.device)
-                    #         sw_buf[1][:,:,kk,...] = vid_source.get_reference_frame(fidx,device=self.device)
-                    else:
+                    if self.temp_padding != "replicate":
+                        # "circular" and "pingpong" padding were supported in the past, but they require preloading the entire video
                         raise RuntimeError( 'Unknown padding method "{}"'.format(self.temp_padding) )
-                else:
-                    # scroll the sliding window buffers
-                    # Tensor splicing leads to strange errors with videos; switching to torch.roll()
-                    # sw_buf[0][:,:,0:-cur_block_N_frames,:,:] = sw_buf[0][:,:,cur_block_N_frames:,:,:]
-                    # sw_buf[1][:,:,0:-cur_block_N_frames,:,:] = sw_buf[1][:,:,cur_block_N_frames:,:,:]
-                    sw_buf[0] = torch.roll(sw_buf[0], shifts=-cur_block_N_frames, dims=2)
-                    sw_buf[1] = torch.roll(sw_buf[1], shifts=-cur_block_N_frames, dims=2)
-
-                    for fi in range(cur_block_N_frames):
-                        ind=fl+fi-1
-                        sw_buf[0][:,:,ind:ind+1,:,:] = vid_source.get_test_frame(ff+fi, device=self.device, colorspace=met_colorspace)
-                        sw_buf[1][:,:,ind:ind+1,:,:] = vid_source.get_reference_frame(ff+fi, device=self.device, colorspace=met_colorspace)
-
-                # Order: test-sustained-Y, ref-sustained-Y, test-rg, ref-rg, test-yv, ref-yv, test-transient-Y, ref-transient-Y
-                # Images do not have the two last channels
-                R = torch.zeros((1, 8, cur_block_N_frames, height, width), device=self.device)
-
-                for cc in range(all_ch): # Iterate over chromatic and temporal channels
-                    # 1D filter over time (over frames)
-                    corr_filter = self.F[cc].flip(0).view([1,1,self.F[cc].shape[0],1,1]) 
-                    sw_ch = 0 if cc==3 else cc # colour channel in the sliding window
-                    for fi in range(cur_block_N_frames):
-                        R[:,cc*2+0, fi, :, :] = (sw_buf[0][:, sw_ch, fi:(fl+fi), :, :] * corr_filter).sum(dim=-3,keepdim=True) # Test
-                        R[:,cc*2+1, fi, :, :] = (sw_buf[1][:, sw_ch, fi:(fl+fi), :, :] * corr_filter).sum(dim=-3,keepdim=True) # Reference
 
-            if self.dump_channels:
-                self.dump_channels.dump_temp_ch(R)
-
-            if self.use_checkpoints:
-                # Used for training
-                Q_per_ch_block, heatmap_block = checkpoint.checkpoint(self.process_block_of_frames, R, vid_sz, temp_ch, self.lpyr, is_image, use_reentrant=False)
-            else:
-                Q_per_ch_block, heatmap_block = self.process_block_of_frames(R, vid_sz, temp_ch, self.lpyr, is_image)
+                # The whole block of frames is read and converted at once
+                for bi, vs in enumerate(vid_sources):
+                    self.store_in_ring_buffer(sw_buf[bi,0], vs.get_test_frames(ff, cur_block_N_frames, device=self.device, colorspace=met_colorspace), ff)
+                    if not ref_hit:
+                        self.store_in_ring_buffer(sw_buf[bi,1], vs.get_reference_frames(ff, cur_block_N_frames, device=self.device, colorspace=met_colorspace), ff)
+
+                if ff == 0 and self.temp_padding == "replicate":
+                    # Frames -fl+1 .. -1 are stored at the end of the ring buffer and are a copy of the first frame
+                    sw_buf[:,:,:,(ring_len-fl+1):,:,:] = sw_buf[:,:,:,0:1,:,:]
+
+            sub_blocks = [(ff, cur_block_N_frames)] # (first frame, number of frames)
+            while sub_blocks:
+                f0, n_frames = sub_blocks.pop(0)
+                out_of_memory = False
+                try:
+                    if not is_image:
+                        # Order: test-sustained-Y, ref-sustained-Y, test-rg, ref-rg, test-yv, ref-yv, test-transient-Y, ref-transient-Y
+                        # Images do not have the two last channels
+                        R = torch.zeros((B, 8, n_frames, height, width), device=self.device, dtype=self.dtype)
+
+                        sides = 1 if ref_hit else 2 # Do not filter the reference if its features are cached
+                        self.apply_temporal_filters(sw_buf, R, self.F, f0, all_ch, sides)
+
+                    if self.dump_channels:
+                        self.dump_channels.dump_temp_ch(R)
+
+                    # Stack the pairs along the frame dimension: [B,ch,frames,H,W] -> [1,ch,B*frames,H,W]. All the 
+                    # processing in process_block_of_frames is done independently for each frame.
+                    R_blk = R.permute(1,0,2,3,4).reshape(1, R.shape[1], B*R.shape[2], height, width).contiguous()
+
+                    if self.use_checkpoints:
+                        # Used for training
+                        Q_per_ch_block, heatmap_block = checkpoint.checkpoint(self.process_block_of_frames, R_blk, vid_sz, temp_ch, self.lpyr, is_image, use_reentrant=False)
+                    elif not ref_key is None:
+                        if ref_hit: # The reference channels of R_blk are not used, the cached features are used instead
+                            Q_per_ch_block, heatmap_block = self.process_block_of_frames(R_blk, vid_sz, temp_ch, self.lpyr, is_image, ref_block=self.ref_cache.get(ref_key, f0, self.device))
+                        else:
+                            ref_block = {}
+                            Q_per_ch_block, heatmap_block = self.process_block_of_frames(R_blk, vid_sz, temp_ch, self.lpyr, is_image, ref_block_out=ref_block)
+                            self.ref_cache.put(ref_key, f0, ref_block)
+                    else:
+                        Q_per_ch_block, heatmap_block = self.process_block(R_blk, vid_sz, temp_ch, self.lpyr, is_image)
+                    del R_blk
+                except Exception as e:
+                    if not (can_split and n_frames>1 and is_out_of_memory(e)):
+                        raise
+                    out_of_memory = True
+
+                if out_of_memory:
+                    # Release the memory of the failed block (the exception is already out of scope) and try with two halves
+                    R = R_blk = None
+                    if self.device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                    n_half = n_frames//2
+                    logging.warning( f"Out of memory when processing {n_frames} frames at once, trying with {n_half} frames." )
+                    sub_blocks = [(f0, n_half), (f0+n_half, n_frames-n_half)] + sub_blocks
+                    block_N_frames = min(block_N_frames, n_half) # Fewer frames in the next blocks
+                    continue
+
+                if Q_per_ch is None:
+                    Q_per_ch = torch.zeros((B, Q_per_ch_block.shape[0], N_frames, Q_per_ch_block.shape[2]), device=self.device)
+                
+                f_end = f0+n_frames
+                Q_per_ch[:,:,f0:f_end,:] = Q_per_ch_block.view(Q_per_ch_block.shape[0], B, n_frames, Q_per_ch_block.shape[2]).permute(1,0,2,3)
+
+                if self.do_heatmap:
+                    for bi in range(B):
+                        hm_block = heatmap_block[:,(bi*n_frames):((bi+1)*n_frames),...].detach()
+                        to_uint8 = not heatmap_sinks is None and heatmap_sinks[bi].dtype == torch.uint8 # Quantize on the device
+                        if self.heatmap == "raw":
+                            if to_uint8:
+                                hm_block = (hm_block.clamp(0., 1.)*255.).to(torch.uint8)
+                        else:
+                            ref_frame = R[bi:(bi+1),0, :, :, :]
+                            vis_fn = visualize_diff_map_uint8 if to_uint8 else visualize_diff_map
+                            hm_block = vis_fn(hm_block, context_image=ref_frame, colormap_type=self.heatmap, use_cpu=self.device.type == 'mps')
+                        if heatmap_sinks is None:
+                            heatmaps[bi][:,:,f0:f_end,...] = hm_block.type(torch.float16).cpu()
+                        else:
+                            heatmap_sinks[bi].write(hm_block.reshape(1, dmap_channels, n_frames, height, width))
+
+            ff += cur_block_N_frames
+
+        if not ref_key is None and not ref_hit:
+            self.ref_cache.end(ref_key)
+
+        if not heatmap_sinks is None:
+            for sink in heatmap_sinks:
+                sink.close()
 
-            if Q_per_ch is None:
-                Q_per_ch = torch.zeros((Q_per_ch_block.shape[0], N_frames, Q_per_ch_block.shape[2]), device=self.device)
-            
-            ff_end = ff+Q_per_ch_block.shape[1]
-            Q_per_ch[:,ff:ff_end,:] = Q_per_ch_block  
+        rho_band = self.lpyr.get_freqs()
 
-            if self.do_heatmap:
-                if self.heatmap == "raw":
-                    heatmap[:,:,ff:ff_end,...] = heatmap_block.detach().type(torch.float16).cpu()
-                else:
-                    ref_frame = R[:,0, :, :, :]
-                    heatmap[:,:,ff:ff_end,...] = visualize_diff_map(heatmap_block, context_image=ref_frame, colormap_type=self.heatmap, use_cpu=self.device.type == 'mps').detach().type(torch.float16).cpu()
+        results = []
+        for bi in range(B):
+            Q_per_ch_bi = Q_per_ch[bi]
+            N_frames_bi = N_frames
+            if self.temp_resample:
+                t_end = N_frames/src_fps # Video duration in s
+                t_org = torch.linspace( 0., t_end, N_frames, device=self.device )
+                N_frames_bi = math.ceil(t_end * self.nominal_fps)
+                t_resampled = torch.linspace( 0., N_frames_bi/self.nominal_fps, N_frames_bi, device=self.device )
+                Q_per_ch_bi = interp1dim2(t_org, Q_per_ch_bi, t_resampled)
+                fps = self.nominal_fps
+            else:
+                fps = src_fps
 
-        if self.temp_resample:
-            t_end = N_frames/vid_source.get_frames_per_second() # Video duration in s
-            t_org = torch.linspace( 0., t_end, N_frames, device=self.device )
-            N_frames_resampled = math.ceil(t_end * self.nominal_fps)
-            t_resampled = torch.linspace( 0., N_frames_resampled/self.nominal_fps, N_frames_resampled, device=self.device )
-            Q_per_ch = interp1dim2(t_org, Q_per_ch, t_resampled)
-            N_frames = N_frames_resampled
-            fps = self.nominal_fps
-        else:
-            fps = vid_source.get_frames_per_second()
+            Q_jod = self.do_pooling_and_jods(Q_per_ch_bi, rho_band[-1], fps)
 
+            stats = {}
+            stats['Q_per_ch'] = Q_per_ch_bi.detach().cpu().numpy() # the quality per channel and per frame
+            stats['rho_band'] = rho_band # The spatial frequency per band in cpd
+            stats['frames_per_second'] = fps
+            stats['width'] = width
+            stats['height'] = height
+            stats['N_frames'] = N_frames_bi
 
-        rho_band = self.lpyr.get_freqs()
-        Q_jod = self.do_pooling_and_jods(Q_per_ch, rho_band[-1], fps)
+            if self.do_heatmap and heatmap_sinks is None:
+                stats['heatmap'] = heatmaps[bi]
 
-        stats = {}
-        stats['Q_per_ch'] = Q_per_ch.detach().cpu().numpy() # the quality per channel and per frame
-        stats['rho_band'] = rho_band # The spatial frequency per band in cpd
-        stats['frames_per_second'] = fps
-        stats['width'] = width
-        stats['height'] = height
-        stats['N_frames'] = N_frames
+            results.append( (Q_jod.squeeze(), stats) )
 
         if self.dump_channels:
             self.dump_channels.close()
 
-        if self.do_heatmap:            
-            stats['heatmap'] = heatmap
-
         if self.debug: 
             logging.debug( f"Processing {block_N_frames} frames in a batch." )
             logging.debug( f"Resolution: {width}x{height} = {width*height/1e6} Mpixels" )
@@ -501,40 +693,182 @@ class cvvdp(vq_metric):
             # logging.debug( f"Memory used per pixel for temporal filters: {per_pixel_sw_buf} B" )
             # logging.debug( f"Memory used per pixel for block of frames: {per_pixel} B" )
 
-        return (Q_jod.squeeze(), stats)
+        return results
+
+    def get_met_colorspace(self):
+        if self.contrast=="log":
+            return 'logLMS_DKLd65'
+        else:
+            return 'DKLd65' # This metric uses DKL colourspaxce with d65 whitepoint
+
+    def create_contrast_pyramid(self, width, height):
+        if self.contrast.startswith("weber"):
+            return weber_contrast_pyr(width, height, self.pix_per_deg, self.device, contrast=self.contrast)
+        elif self.contrast.startswith("log"):
+            return log_contrast_pyr(width, height, self.pix_per_deg, self.device, contrast=self.contrast)
+        else:
+            raise RuntimeError( f"Unknown contrast {self.contrast}" )
+
+    # Store frames [1,3,N,H,W] (the frames ff .. ff+N-1) in the ring buffer buf[3,ring_len,H,W], where frame n is 
+    # stored at the index n % ring_len. The frames are copied in at most two slices.
+    def store_in_ring_buffer(self, buf, frames, ff):
+        ring_len = buf.shape[1]
+        N = frames.shape[2]
+        ind = ff % ring_len
+        N_first = min(N, ring_len-ind)
+        buf[:,ind:(ind+N_first),:,:] = frames[0,:,:N_first,:,:]
+        if N_first < N: # Wrap around the end of the buffer
+            buf[:,0:(N-N_first),:,:] = frames[0,:,N_first:,:,:]
+
+    # Apply the temporal filters F to the frames ff .. ff+N-1 stored in the ring buffer sw_buf[B,2,3,ring_len,H,W] 
+    # (frame n is stored at the index n % ring_len) and write the result to R[B,8,N,H,W]. Only the first 
+    # sides (1 - test, 2 - test and reference) of the sliding window are filtered.
+    def apply_temporal_filters(self, sw_buf, R, F, ff, all_ch, sides=2):
+        B, _, _, ring_len, height, width = sw_buf.shape
+        N = R.shape[2]
+        fl = torch.numel(F[0])
+        # The temporal filters are applied as a single matrix product per colour channel. The rows of
+        # filt_mat contain the filter taps placed at the ring buffer indices of the corresponding frames: 
+        # frame ff+fi-kk is multiplied by F[cc][kk]. The filters of all the temporal channels that use the colour 
+        # channel are stacked in the rows of a 2D filt_mat, so that the ring buffer is not broadcast (copied) for each of them.
+        frame_ind = (ff + torch.arange(N, device=self.device).view(-1,1) - torch.arange(fl, device=self.device).view(1,-1)) % ring_len
+        for sw_ch, chs in enumerate(((0,3), (1,), (2,))): # Colour channel in the sliding window and temporal channels that use it
+            chs = [cc for cc in chs if cc<all_ch]
+            filt_mat = torch.zeros((len(chs), N, ring_len), device=self.device, dtype=self.dtype)
+            for kk, cc in enumerate(chs):
+                filt_mat[kk,:,:].scatter_(1, frame_ind, F[cc].view(1,-1).expand(N,-1).to(self.dtype))
+            sw_ch_buf = sw_buf[:,0:sides,sw_ch,:,:,:].reshape(B, sides, ring_len, height*width)
+            R_ch = torch.matmul(filt_mat.view(len(chs)*N, ring_len), sw_ch_buf) # [B, sides, len(chs)*N, height*width]
+            for kk, cc in enumerate(chs):
+                R[:,(cc*2):(cc*2+sides),:,:,:] = R_ch[:,:,(kk*N):((kk+1)*N),:].view(B, sides, N, height, width)
+
+    # The spatial frequency of each band of lpyr as seen by the CSF (the baseband at 0.1 cpd), as a list of Python floats.
+    # The CSF LUTs are resolved for all the bands at once (no-op if already done), so that processing a block of frames
+    # only looks up the sensitivity. 
+    def get_csf_band_freqs(self, lpyr):
+        rho_band = lpyr.get_freqs()
+        rho_band[lpyr.get_band_count()-1] = 0.1 # Baseband
+        rho_band = rho_band.tolist()
+        self.csf.precompute(rho_band)
+        return rho_band
+
+    # Process a block of frames with the tiled, compiled or the default implementation, depending on the options of the metric
+    def process_block(self, R, vid_sz, temp_ch, lpyr, is_image):
+        if not self.tile_size is None and not self.dump_channels:
+            return self.process_block_of_frames_tiled(R, vid_sz, temp_ch, lpyr, is_image)
+        elif self.compile and not self.do_heatmap and not self.dump_channels:
+            return self.process_block_of_frames_compiled(R, vid_sz, temp_ch, lpyr, is_image)
+        else:
+            return self.process_block_of_frames(R, vid_sz, temp_ch, lpyr, is_image)
+
+    # Return the key identifying the reference features in the reference cache, or None if 
+    # the reference cannot be identified. The key includes everything that the features depend on: 
+    # the reference content, the display model, the frame rate and the colour space.
+    def get_reference_cache_key(self, vid_source, met_colorspace):
+        ref_id = vid_source.get_reference_id()
+        if ref_id is None:
+            return None
+        return (ref_id, self.get_info_string(), vid_source.get_frames_per_second(), tuple(vid_source.get_video_size()), met_colorspace, self.temp_padding, self.contrast, str(self.device))
 
     # Determine how many frames we can process in a single batch 
     # Larger batch means faster processing, but it requires more memory
-    def estimate_block_N(self, pix_cnt, N_frames):
+    # tile_pix_cnt - the number of pixels in a tile (with the margins) if the frames are processed in tiles. As the 
+    # full-frame buffers cannot be tiled, a RuntimeError is raised if even a single frame does not fit into memory.
+    def estimate_block_N(self, pix_cnt, N_frames, tile_pix_cnt=None):
         # Determine how much memory we have
-        if has_nvml:
-            # This is more accurate estimate
-            nvmlInit()
-            h = nvmlDeviceGetHandleByIndex(self.device.index)
-            info = nvmlDeviceGetMemoryInfo(h)
-            mem_avail = info.free - 1e9  # We reserving some space, not to use all the memory
-        else:
-            # Torch does not allow us to querry the free memory on the GPU so this is an inaccurate estimate - likely to fail if other applications are using a GPU
-            total = torch.cuda.get_device_properties(self.device).total_memory
-            allocated = torch.cuda.memory_allocated(self.device)
-            mem_avail = total-allocated - 2e9  # Total available minus 2G (used by other apps)
-
-        if not self.gpu_mem is None:
-            mem_avail = min(int(self.gpu_mem*1e9), mem_avail)
+        mem_avail = self.get_available_memory()
 
         if self.debug:
             logging.debug( f"Available memory: {mem_avail/1e9} GB")
         # Estimate how much we need for processing
         # The model is:  total_mem = a + pix_cnt*(N_frames+filter_len-1)*b + pix_cnt*N_frames*c
-        a = 1.6e9
-        b = 16
-        c = 320 if not self.use_checkpoints else 1000 # A different value for training
+        model = self.get_memory_model()
+        if not model is None:
+            # Measured on this machine with calibrate_memory_model() (for the same tile_size)
+            a, b, c = model['a'], model['b'], model['c']
+        else:
+            a = 1.6e9
+            b = 16
+            if self.use_checkpoints:
+                c = 1000 # A different value for training
+            elif self.fused_masking and self.masking_model == "mult-mutual":
+                c = 272  # The fused masking model (apply_masking_model_fused) needs 3 fewer band-sized buffers
+                if self.precision in ['fp16', 'bf16']:
+                    c *= 0.6  # Measured peak memory relative to fp32
+                elif self.precision == 'mixed':
+                    c *= 0.87
+            else:
+                c = 320
+            if self.precision != 'fp32':
+                b = 8 # The temporal buffers are stored in 16 bits
+            if not tile_pix_cnt is None:
+                # In the tiled mode, the sliding window of the temporal filters (3 colour channels of the test and reference), 
+                # the frames being read (float32), the temporal channels R and their Gaussian pyramid are stored for the 
+                # full frame (c_full, measured on CPU), the rest (c) only for a tile
+                b = 6*self.dtype.itemsize
+                c_full = 44 + 4*self.dtype.itemsize
+                c = c_full + c*tile_pix_cnt/pix_cnt
 
         max_frames = int(math.floor((mem_avail-a-pix_cnt*(self.filter_len-1)*b)/(pix_cnt*b+pix_cnt*c))) # how many frames can we fit into memory
 
+        if max_frames < 1 and not tile_pix_cnt is None:
+            mem_needed = a + pix_cnt*self.filter_len*b + pix_cnt*c
+            raise RuntimeError( f"Not enough memory to process {pix_cnt/1e6:.1f} Mpixel frames: a single frame needs about {mem_needed/1e9:.1f} GB, but only {mem_avail/1e9:.1f} GB is available. "
+                                f"The sliding window of the temporal filters ({self.filter_len} frames), the temporal channels and the Gaussian pyramid are stored for the full frame, whatever the tile size. "
+                                "Use precision='fp16' or a device with more memory." )
+
+        if self.device.type == 'cpu':
+            # Larger blocks do not make the processing on CPU faster as the data no longer fits in the cache
+            max_frames = min(max_frames, self.cpu_max_block_N)
+
         block_N_frames = max(1, min(max_frames,N_frames))  # Process so many frames in one pass 
         return block_N_frames
 
+    # The memory (in bytes) that can be used for processing, on the device of the metric
+    def get_available_memory(self):
+        if self.device.type == 'cuda':
+            try:
+                from pynvml import nvmlInit, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
+                has_nvml = True
+            except:
+                has_nvml = False
+
+            if has_nvml:
+                # This is more accurate estimate
+                nvmlInit()
+                h = nvmlDeviceGetHandleByIndex(self.device.index)
+                info = nvmlDeviceGetMemoryInfo(h)
+                mem_avail = info.free - 1e9  # We reserving some space, not to use all the memory
+            else:
+                # Torch does not allow us to querry the free memory on the GPU so this is an inaccurate estimate - likely to fail if other applications are using a GPU
+                total = torch.cuda.get_device_properties(self.device).total_memory
+                allocated = torch.cuda.memory_allocated(self.device)
+                mem_avail = total-allocated - 2e9  # Total available minus 2G (used by other apps)
+        else:
+            try:
+                with open('/proc/meminfo') as fh:
+                    meminfo = dict( (ll.split(':')[0], ll.split(':')[1]) for ll in fh )
+                mem_free = int(meminfo['MemAvailable'].split()[0])*1024
+            except (OSError, KeyError, ValueError):
+                mem_free = os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+            mem_avail = mem_free/2 # Leave the rest for the video decoding and other processes
+
+        if not self.gpu_mem is None:
+            mem_avail = min(int(self.gpu_mem*1e9), mem_avail)
+        return mem_avail
+
+    # The memory model measured with calibrate_memory_model() for the current settings, or None
+    def get_memory_model(self):
+        return load_memory_model(self)
+
+    '''
+    Measure how much memory is needed to process a block of frames with the current settings (contrast, masking model,
+    heatmap, precision) on the device of the metric and store the result in the per-machine cache file. Once calibrated,
+    the measured model is used to choose how many frames are processed at once, also on CPU. See pycvvdp.memory_model. 
+    '''
+    def calibrate_memory_model(self, resolutions=None, frames=None, save=True):
+        return calibrate_memory_model(self, resolutions=resolutions, frames=frames, save=save)
+
 
     def get_ch_weights(self, no_channels):
         if hasattr(self, 'ch_chrom_w'):
@@ -556,21 +890,7 @@ class cvvdp(vq_metric):
         no_frames = Q_per_ch.shape[1]
         no_bands = Q_per_ch.shape[2]
 
-        per_ch_w = self.get_ch_weights( no_channels )
-
-        # if no_frames>1: # If video
-        #     per_ch_w = self.ch_weights[0:no_channels].view(-1,1,1)
-        #     #torch.stack( (torch.ones(1, device=self.device), torch.as_tensor(self.w_transient, device=self.device)[None] ), dim=1)[:,:,None]
-        # else: # If image
-        #     per_ch_w = 1
-
-        # Weights for the spatial bands
-        per_sband_w = torch.ones( (no_channels,1,no_bands), dtype=torch.float32, device=self.device)
-        per_sband_w[:,0,-1] = self.baseband_weight[0:no_channels]
-
-        #per_sband_w = torch.exp(interp1( self.quality_band_freq_log, self.quality_band_w_log, torch.log(torch.as_tensor(rho_band, device=self.device)) ))[:,None,None]
-
-        Q_sc = self.lp_norm(Q_per_ch*per_ch_w*per_sband_w, self.beta_sch, dim=2, normalize=False)  # Sum across spatial channels
+        Q_sc = self.pool_spatial_bands(Q_per_ch)
 
         is_image = (no_frames==1)
         t_int = self.image_int if is_image else 1.0 # Integration correction for images
@@ -580,16 +900,10 @@ class cvvdp(vq_metric):
             Q_in = Q_sc.permute(0,2,1)
             B_filt = torch.ones( (1,1,bfilt_len), dtype=torch.float32, device=Q_in.device )/float(bfilt_len)
             Q_bi = torch.nn.functional.conv1d(Q_in,B_filt, padding="valid")
-            if not self.block_channels is None:
-                Q_tc = self.lp_norm(Q_bi[self.block_channels,...], self.beta_tch, dim=0, normalize=False)  # Sum across temporal and chromatic channels                
-            else:
-                Q_tc = self.lp_norm(Q_bi,     self.beta_tch, dim=0, normalize=False)  # Sum across temporal and chromatic channels
+            Q_tc = self.pool_channels(Q_bi)
             Q = self.lp_norm(Q_tc,     self.beta_t,   dim=2, normalize=True)   # Sum across frames
         else:
-            if not self.block_channels is None:
-                Q_tc = self.lp_norm(Q_sc[self.block_channels[0:no_channels],...], self.beta_tch, dim=0, normalize=False)  # Sum across temporal and chromatic channels                
-            else:
-                Q_tc = self.lp_norm(Q_sc,     self.beta_tch, dim=0, normalize=False)  # Sum across temporal and chromatic channels
+            Q_tc = self.pool_channels(Q_sc)
 
             if is_image:
                 Q = Q_tc * t_int
@@ -611,6 +925,28 @@ class cvvdp(vq_metric):
         # Q_jod = sign(self.jod_a) * ((abs(self.jod_a)**(1.0/beta_jod))* Q)**beta_jod + 10.0 # This one can help with very large numbers
         # return Q_jod.squeeze()
 
+    # Q_per_ch[channel,frame,sp_band] -> Q_sc[channel,frame,1]
+    def pool_spatial_bands(self, Q_per_ch):
+        no_channels = Q_per_ch.shape[0]
+        no_bands = Q_per_ch.shape[2]
+
+        per_ch_w = self.get_ch_weights( no_channels )
+
+        # Weights for the spatial bands
+        per_sband_w = torch.ones( (no_channels,1,no_bands), dtype=torch.float32, device=self.device)
+        per_sband_w[:,0,-1] = self.baseband_weight[0:no_channels]
+
+        #per_sband_w = torch.exp(interp1( self.quality_band_freq_log, self.quality_band_w_log, torch.log(torch.as_tensor(rho_band, device=self.device)) ))[:,None,None]
+
+        return self.lp_norm(Q_per_ch*per_ch_w*per_sband_w, self.beta_sch, dim=2, normalize=False)  # Sum across spatial channels
+
+    # Q[channel,...] -> Q_tc[1,...]
+    def pool_channels(self, Q):
+        if not self.block_channels is None:
+            return self.lp_norm(Q[self.block_channels[0:Q.shape[0]],...], self.beta_tch, dim=0, normalize=False)  # Sum across temporal and chromatic channels                
+        else:
+            return self.lp_norm(Q,     self.beta_tch, dim=0, normalize=False)  # Sum across temporal and chromatic channels
+
     # Convert contrast differences to JODs
     def met2jod(self, Q):
 
@@ -626,7 +962,39 @@ class cvvdp(vq_metric):
         Q_JOD[Q>Q_t] = 10. - self.jod_a * (Q[Q>Q_t]**self.jod_exp);
         return Q_JOD
 
-    def process_block_of_frames(self, R, vid_sz, temp_ch, lpyr, is_image):
+    # The same as process_block_of_frames, but compiled with torch.compile into a single graph (fullgraph=True), so that
+    # the hundreds of small kernels of each block are fused and the Python overhead is removed. On CUDA, the compiled
+    # block is replayed as one CUDA graph. The CSF LUTs are resolved before the call, outside of the compiled region.
+    # Only the first block shape seen for each resolution is compiled (the steady-state block of block_N_frames frames). 
+    # The blocks with a different number of frames (e.g. the last, shorter block of a video) are processed without 
+    # compilation, so that each resolution is compiled only once. The first block of that shape is also processed 
+    # without compilation, so that the kernels created on the first use (pyramid, blur) exist before tracing. If the 
+    # compilation fails, the blocks are processed without compilation. 
+    def process_block_of_frames_compiled(self, R, vid_sz, temp_ch, lpyr, is_image):
+        rho_band = self.get_csf_band_freqs(lpyr)
+        key = (R.shape[1], R.shape[-2], R.shape[-1], temp_ch, is_image, str(R.device))
+        if not key in self.compiled_blocks:
+            self.compiled_blocks[key] = (R.shape[-3], None)
+        elif self.compiled_blocks[key][1] is None:
+            mode = "reduce-overhead" if R.device.type == 'cuda' else None
+            self.compiled_blocks[key] = (self.compiled_blocks[key][0], torch.compile(self.process_block_of_frames, fullgraph=True, dynamic=False, mode=mode))
+        N_frames, block_fn = self.compiled_blocks[key]
+        if block_fn is None or R.shape[-3] != N_frames:
+            return self.process_block_of_frames(R, vid_sz, temp_ch, lpyr, is_image, rho_band=rho_band)
+
+        try:
+            if R.device.type == 'cuda':
+                torch.compiler.cudagraph_mark_step_begin()
+            return block_fn(R, vid_sz, temp_ch, lpyr, is_image, rho_band=rho_band)
+        except Exception as e:
+            logging.warning( f"Compilation of the metric failed, falling back to the non-compiled version ({e})" )
+            self.compiled_blocks[key] = (N_frames, self.process_block_of_frames)
+            return self.process_block_of_frames(R, vid_sz, temp_ch, lpyr, is_image, rho_band=rho_band)
+
+    # ref_block - the reference features from the reference cache. If provided, the reference channels of R are not used
+    # ref_block_out - if a dict is passed, it is filled with the reference features to be stored in the reference cache 
+    # rho_band - the band frequencies from get_csf_band_freqs(lpyr), computed here if None
+    def process_block_of_frames(self, R, vid_sz, temp_ch, lpyr, is_image, ref_block=None, ref_block_out=None, rho_band=None):
         # R[channels,frames,width,height]
         #height, width, N_frames = vid_sz
         all_ch = 2+temp_ch
@@ -637,7 +1005,20 @@ class cvvdp(vq_metric):
         #     R = lms2006_to_dkld65( torch.log10(R.clip(min=1e-5)) )
 
         # Perform Laplacian pyramid decomposition
-        B_bands, L_bkg_pyr = lpyr.decompose(R[0,...])
+        if ref_block is None and ref_block_out is None:
+            B_bands, L_bkg_pyr = lpyr.decompose(R[0,...])
+        else:
+            if ref_block is None:
+                gpyr, gexp = lpyr.gaussian_pyramid_exp(R[0,...])
+                ref_block_out['gpyr'] = [gl[1::2,...] for gl in gpyr]
+                ref_block_out['gexp'] = [gl[1::2,...] for gl in gexp]
+                ref_block_out['S'] = []
+            else:
+                # Decompose only the test channels and interleave them with the cached reference channels
+                gpyr_t, gexp_t = lpyr.gaussian_pyramid_exp(R[0,0::2,...].contiguous())
+                gpyr = [torch.stack((gl_t, gl_r), dim=1).flatten(0,1) for gl_t, gl_r in zip(gpyr_t, ref_block['gpyr'])]
+                gexp = [torch.stack((gl_t, gl_r), dim=1).flatten(0,1) for gl_t, gl_r in zip(gexp_t, ref_block['gexp'])]
+            B_bands, L_bkg_pyr = lpyr.contrast_pyramid(gpyr, gexp)
 
         if self.debug: assert len(B_bands) == lpyr.get_band_count()
 
@@ -650,8 +1031,8 @@ class cvvdp(vq_metric):
 
         # L_bkg_bb = [None for i in range(lpyr.get_band_count()-1)]
 
-        rho_band = lpyr.get_freqs()
-        rho_band[lpyr.get_band_count()-1] = 0.1 # Baseband
+        if rho_band is None:
+            rho_band = self.get_csf_band_freqs(lpyr)
 
         Q_per_ch_block = None
         block_N_frames = R.shape[-3] 
@@ -667,20 +1048,14 @@ class cvvdp(vq_metric):
             logL_bkg = lpyr.get_gband(L_bkg_pyr, bb)
 
             # Compute CSF
-            rho = rho_band[bb] # Spatial frequency in cpd
-            ch_height, ch_width = logL_bkg.shape[-2], logL_bkg.shape[-1]
-            S = torch.empty((all_ch,block_N_frames,ch_height,ch_width), device=self.device)
-            for cc in range(all_ch):
-                tch = 0 if cc<3 else 1  # Sustained or transient
-                cch = cc if cc<3 else 0 # Y, rg, yv
-                # The sensitivity is always extracted for the reference frame
-                S[cc,:,:,:] = self.csf.sensitivity(rho, self.omega[tch], logL_bkg[...,1,:,:,:], cch, self.csf_sigma) * 10.0**(self.sensitivity_correction/20.0)
-
-            if is_baseband:
-                D = (torch.abs(T_f-R_f) * S)
+            if not ref_block is None:
+                S = ref_block['S'][bb]
             else:
-                # dimensions: [channel,frame,height,width]
-                D = self.apply_masking_model(T_f, R_f, S)
+                S = self.band_sensitivity(rho_band[bb], logL_bkg, all_ch)
+                if not ref_block_out is None:
+                    ref_block_out['S'].append(S)
+
+            D = self.band_difference(T_f, R_f, S, is_baseband)
 
             if Q_per_ch_block is None:
                 Q_per_ch_block = torch.empty((all_ch, block_N_frames, lpyr.get_band_count()), device=self.device)
@@ -786,6 +1161,241 @@ class cvvdp(vq_metric):
         else:
             return torch.sign(x)
 
+    # Margin (in pixels of a band) added to each side of a tile so that the spatial filters of the masking model
+    # give the same result as for the full band
+    def get_tile_margin(self):
+        margin = self.pu_padsize if self.pu_dilate != 0 else 0
+        if "texture" in self.masking_model:
+            margin = max(margin, self.tex_pad_size)
+        return margin+2
+
+    '''
+    The same as process_block_of_frames, but the bands larger than tile_size x tile_size are processed in tiles 
+    (with a margin on each side, see get_tile_margin). The expanded coarser level, contrast, CSF and masking are 
+    computed for one tile at a time and the spatial pooling sums D^beta over the tiles (without the margins). The 
+    results are the same as without the tiles, up to the floating point rounding. The baseband, which needs the mean 
+    luminance of the frame, is processed as a whole. 
+
+    The tiles bound only the memory of the per-band processing. The sliding window of the temporal filters 
+    (sw_buf, 6 values per pixel for each of the filter_len+N-1 frames), the temporal channels (R, 8 values per pixel
+    and frame) and their Gaussian pyramid (4/3 of R) are still stored for the full frame, so the peak memory grows 
+    linearly with the resolution, whatever the tile_size. For example, at 8K and 60 fps (filter_len=17) the sliding 
+    window alone takes 13.5 GB in fp32 (6.8 GB in fp16), plus about 2 GB per frame of the block. estimate_block_N 
+    raises an error if a single frame does not fit into memory. 
+    '''
+    def process_block_of_frames_tiled(self, R, vid_sz, temp_ch, lpyr, is_image):
+        all_ch = 2+temp_ch
+        block_N_frames = R.shape[-3]
+        band_cnt = lpyr.get_band_count()
+
+        gpyr = lpyr.gaussian_pyramid_dec(R[0,...], band_cnt)
+
+        rho_band = self.get_csf_band_freqs(lpyr)
+
+        ts = self.tile_size
+        margin = self.get_tile_margin()
+        beta_is_tensor = isinstance(self.beta, torch.Tensor)
+
+        Q_per_ch_block = torch.empty((all_ch, block_N_frames, band_cnt), device=self.device)
+
+        for bb in range(band_cnt):  # For each spatial frequency band
+            is_baseband = (bb==(band_cnt-1))
+            band_mul = 1.0 if (bb==0 or is_baseband) else 2.0 # As in lpyr.get_band()
+
+            H_b, W_b = gpyr[bb].shape[-2], gpyr[bb].shape[-1]
+            if is_baseband or (H_b<=ts and W_b<=ts):
+                tiles = [(0, H_b, 0, W_b)]
+            else:
+                tiles = [(y0, min(y0+ts,H_b), x0, min(x0+ts,W_b)) for y0 in range(0,H_b,ts) for x0 in range(0,W_b,ts)]
+
+            D_p_sum = 0.  # Sum of D^beta 
+            D_sum = 0.    # Sum of D and D^2 (for std pooling)
+            D_sq_sum = 0.
+            if self.do_heatmap:
+                D_chr = torch.empty((1, block_N_frames, H_b, W_b), device=self.device)
+
+            for y0, y1, x0, x1 in tiles:
+                py0, py1, px0, px1 = max(0,y0-margin), min(H_b,y1+margin), max(0,x0-margin), min(W_b,x1+margin)
+
+                if is_baseband:
+                    glayer_ex = None
+                else:
+                    glayer_ex = lpyr.gausspyr_expand_region(gpyr[bb+1], (H_b, W_b), py0, py1, px0, px1)
+                B_t, logL_bkg = lpyr.contrast_band(gpyr[bb][...,py0:py1,px0:px1], glayer_ex)
+                del glayer_ex
+                B_t = B_t * band_mul
+
+                S = self.band_sensitivity(rho_band[bb], logL_bkg, all_ch)
+                del logL_bkg
+                D = self.band_difference(B_t[0::2,...], B_t[1::2,...], S, is_baseband)
+                del B_t, S
+                D = D[...,(y0-py0):(y1-py0),(x0-px0):(x1-px0)]
+
+                if beta_is_tensor:
+                    D_p_sum = D_p_sum + torch.sum(safe_pow(D, self.beta), dim=(-2,-1))
+                else:
+                    D_p_sum = D_p_sum + torch.sum(torch.abs(D)**self.beta, dim=(-2,-1))
+                if self.std_pool[1]=='S':
+                    D_sum = D_sum + torch.sum(D, dim=(-2,-1))
+                    D_sq_sum = D_sq_sum + torch.sum(D*D, dim=(-2,-1))
+
+                if self.do_heatmap:
+                    # Weights for the channels: sustained, RG, YV, [transient]
+                    t_int = self.image_int if is_image else 1.0
+                    per_ch_w = self.get_ch_weights( all_ch ).view(-1,1,1,1) * t_int
+                    D_chr[...,y0:y1,x0:x1] = self.lp_norm(D*per_ch_w, self.beta_tch, dim=-4, normalize=False)  # Sum across temporal and chromatic channels
+                del D
+
+            # Spatial pooling, the same as lp_norm(D, beta, dim=(-2,-1), normalize=True)
+            N = float(H_b*W_b)
+            if beta_is_tensor:
+                Q_per_ch_block[:,:,bb] = safe_pow(D_p_sum/N, 1/self.beta)
+            else:
+                Q_per_ch_block[:,:,bb] = (D_p_sum/N) ** (1./self.beta)
+
+            if self.std_pool[1]=='S':
+                std_ws = 2**self.std_w[1]
+                Q_per_ch_block[:,:,bb] += std_ws*torch.sqrt( ((D_sq_sum - D_sum*D_sum/N)/(N-1)).clamp(min=0.) )
+
+            if self.do_heatmap:
+                self.heatmap_pyr.set_lband(bb, D_chr)
+                del D_chr
+
+            if bb>0:
+                gpyr[bb] = None # Not needed anymore (gpyr[0] is the input)
+
+        if self.do_heatmap:
+            heatmap_block = 1.-(self.met2jod( self.heatmap_pyr.reconstruct() )/10.)
+        else:
+            heatmap_block = None
+
+        return Q_per_ch_block, heatmap_block
+
+    # Sensitivity S[channel,frame,height,width] for the band of the spatial frequency rho (in cpd)
+    def band_sensitivity(self, rho, logL_bkg, all_ch):
+        # Channels: sustained Y, rg, yv, [transient Y]
+        omega_cc = [(self.omega[0 if cc<3 else 1], cc if cc<3 else 0) for cc in range(all_ch)]
+        # The sensitivity is always extracted for the reference frame
+        return self.csf.sensitivity_channels(rho, omega_cc, logL_bkg[...,1,:,:,:].float(), self.csf_sigma) * 10.0**(self.sensitivity_correction/20.0)
+
+    # Visual difference D[channel,frame,height,width] between the test and reference contrast bands (in float32)
+    def band_difference(self, T_f, R_f, S, is_baseband):
+        if is_baseband:
+            return (torch.abs(T_f-R_f) * S)
+
+        # dimensions: [channel,frame,height,width]
+        if self.use_fused_masking(T_f, R_f, S):
+            if self.mask_dtype == torch.float16:
+                D = self.apply_masking_model_fused_log(T_f, R_f, S.half())
+            else:
+                D = self.apply_masking_model_fused(T_f.to(self.mask_dtype), R_f.to(self.mask_dtype), S.to(self.mask_dtype))
+            return D.float() # Pooling is done in float32
+        else:
+            # Reduced precision is used only with the fused masking
+            return self.apply_masking_model(T_f.float(), R_f.float(), S)
+
+    # The fused masking can be used only for the "mult-mutual" model and when no gradients are needed, as it 
+    # overwrites its intermediate results. 
+    def use_fused_masking(self, T, R, S):
+        if not self.fused_masking or self.masking_model != "mult-mutual":
+            return False
+        if not torch.is_grad_enabled():
+            return True
+        return not any( x.requires_grad for x in [T, R, S, self.mask_p, self.mask_q, self.mask_c, self.xcm_weights, self.d_max] )
+
+    # The same as apply_masking_model() for the "mult-mutual" model, but the intermediate results are computed 
+    # in-place, in a single pass over the band, so that only a few band-sized buffers are allocated. 
+    # The results are identical.
+    def apply_masking_model_fused(self, T, R, S):
+        num_ch = T.shape[0]
+        ch_gain = torch.reshape( torch.as_tensor( [1, 1.45, 1, 1.], device=T.device, dtype=T.dtype), (4, 1, 1, 1) )[:num_ch,...] 
+        epsilon = torch.as_tensor( 0.00001, device=T.device )
+        p = self.mask_p
+        q = self.mask_q[0:num_ch].view(num_ch,1,1,1)
+
+        T_p = torch.mul(T, S).mul_(ch_gain)
+        R_p = torch.mul(R, S).mul_(ch_gain)
+
+        # Difference, safe_pow(|T_p-R_p|, p)
+        D = torch.sub(T_p, R_p).abs_().add_(epsilon).pow_(p).sub_(epsilon**p)
+
+        # Mutual masking, min(|T_p|,|R_p|)
+        M_mm = torch.minimum(T_p.abs_(), R_p.abs_(), out=T_p)
+        del R_p, T_p
+        if self.pu_dilate != 0 and M_mm.shape[-2]>self.pu_padsize and M_mm.shape[-1]>self.pu_padsize:
+            M_mm = self.pu_blur.forward(M_mm)
+        M_mm.mul_(10**self.mask_c)
+
+        # safe_pow(|M_mm|, q), pooled across the channels
+        C = M_mm.abs_().add_(epsilon).pow_(q).sub_(epsilon**q)
+        if self.do_xchannel_masking:
+            M = torch.empty_like(C)
+            xcm_weights = torch.reshape( (2**self.xcm_weights), (4,4,1,1,1) )[:num_ch,...].to(C.dtype)
+            for cc in range(num_ch): # for each channel: Sust, RG, VY, Trans
+                torch.sum( C * xcm_weights[:,cc], dim=0, keepdim=True, out=M[cc:cc+1,...] )
+            del C
+        else:
+            cm_weights = torch.reshape( (2**self.xcm_weights), (4,1,1,1) )[:num_ch,...]
+            M = C.mul_(cm_weights)
+
+        D.div_(M.add_(1))
+
+        # Soft clamping, max_v * D / (max_v + D), reusing the buffer of M
+        if self.dclamp_type in ["soft", "per_channel"]:
+            max_v = 10**self.d_max if self.dclamp_type == "soft" else 10**(self.d_max[:num_ch,...].view(-1,1,1,1))
+            torch.add(D, max_v, out=M)
+            return D.mul_(max_v).div_(M)
+        else:
+            del M
+            return self.clamp_diffs( D )
+
+    # The same as apply_masking_model_fused(), but the power functions and the pooling across the channels are 
+    # computed in the log domain so that the intermediate values do not overflow float16. The soft clamping is
+    # max_v*D/(max_v+D) = max_v*sigmoid(log(D)-log(max_v)). Used when precision='fp16'.
+    def apply_masking_model_fused_log(self, T, R, S):
+        num_ch = T.shape[0]
+        ch_gain = torch.reshape( torch.as_tensor( [1, 1.45, 1, 1.], device=T.device, dtype=T.dtype), (4, 1, 1, 1) )[:num_ch,...] 
+        epsilon = 0.00001
+        p = self.mask_p
+        q = self.mask_q[0:num_ch].view(num_ch,1,1,1)
+
+        T_p = torch.mul(T, S).mul_(ch_gain)
+        R_p = torch.mul(R, S).mul_(ch_gain)
+
+        # log(|T_p-R_p|^p)
+        log_D = torch.sub(T_p, R_p).abs_().add_(epsilon).log_().mul_(p)
+
+        M_mm = torch.minimum(T_p.abs_(), R_p.abs_(), out=T_p)
+        del R_p, T_p
+        if self.pu_dilate != 0 and M_mm.shape[-2]>self.pu_padsize and M_mm.shape[-1]>self.pu_padsize:
+            M_mm = self.pu_blur.forward(M_mm)
+        M_mm.mul_(10**self.mask_c)
+
+        # log(M) = log(sum_k w_k*|M_mm_k|^q_k) 
+        log_C = M_mm.abs_().add_(epsilon).log_().mul_(q)
+        if self.do_xchannel_masking:
+            log_M = torch.empty_like(log_C)
+            log_w = (self.xcm_weights*math.log(2.)).view(4,4,1,1,1)[:num_ch,...].to(log_C.dtype)
+            for cc in range(num_ch):
+                torch.logsumexp( log_C + log_w[:,cc], dim=0, keepdim=True, out=log_M[cc:cc+1,...] )
+            del log_C
+        else:
+            log_M = log_C.add_((self.xcm_weights*math.log(2.)).view(4,1,1,1)[:num_ch,...].to(log_C.dtype))
+
+        # log(D/(1+M))
+        log_D.sub_(Func.softplus(log_M)) # log(1+M) = softplus(log(M))
+        del log_M
+
+        if self.dclamp_type == "soft":
+            return log_D.sub_(self.d_max*math.log(10.)).sigmoid_().mul_(10**self.d_max)
+        elif self.dclamp_type == "per_channel":
+            d_max = self.d_max[:num_ch,...].view(-1,1,1,1)
+            return log_D.sub_(d_max*math.log(10.)).sigmoid_().mul_(10**d_max)
+        elif self.dclamp_type == "hard":
+            return log_D.clamp_(max=self.d_max*math.log(10.)).exp_()
+        else:
+            return self.clamp_diffs(log_D.exp_())
+
     def apply_masking_model(self, T, R, S):
         # T - test contrast tensor T[channel,frame,width,height]
         # R - reference contrast tensor
@@ -1077,7 +1687,8 @@ class cvvdp(vq_metric):
         L_black, L_refl = self.display_photometry.get_black_level()
         return f'"ColorVideoVDP v{self.version}, {self.pix_per_deg:.4g} [pix/deg], ' \
                f'Lpeak={self.display_photometry.get_peak_luminance():.5g}, ' \
-               f'Lblack={L_black:.4g}, Lrefl={L_refl:.4g} [cd/m^2], ({standard_str})"' 
+               f'Lblack={L_black:.4g}, Lrefl={L_refl:.4g} [cd/m^2], ({standard_str})' \
+               + ('"' if self.precision == 'fp32' else f', precision={self.precision}"')
 
     def write_features_to_json(self, stats, dest_fname):
         Q_per_ch = stats['Q_per_ch'] # quality per channel [cc,ff,bb]
@@ -1096,6 +1707,22 @@ class cvvdp(vq_metric):
         with open(dest_fname, 'w', encoding='utf-8') as f:
             json.dump(fmap, f, ensure_ascii=False, indent=4)
 
+    '''
+    Write the features (stats returned by predict_video_source) to an uncompressed .npz file. Q_per_ch is stored as a 
+    single float32 array [channels,frames,bands] and the remaining statistics (rho_band, frames_per_second, width, 
+    height, ...) as separate arrays. The file is much smaller and faster to read than the one written by 
+    write_features_to_json. Q_per_ch can be memory-mapped when reading (see calibration/data.py:load_features).
+    '''
+    def write_features_to_npz(self, stats, dest_fname):
+        fmap = {}
+        for key, value in stats.items():
+            if key == "heatmap" or value is None:
+                continue
+            fmap[key] = np.asarray(value, dtype=np.float32) if key == "Q_per_ch" else np.asarray(value)
+
+        with open(dest_fname, 'wb') as f: # Passing a file object prevents numpy from appending .npz
+            np.savez(f, **fmap)
+
     def save_to_config(self, fname, comment):
         # Save the current parameters to the given file
         assert fname.endswith('.json'), 'Please provide a .json file'
@@ -1143,7 +1770,11 @@ class cvvdp(vq_metric):
         band_labels = [f"{val:.2f}" for val in np.flip(rho_band)[::2]]
         band_labels[0] = "BB"
 
-        if not has_matplotlib:
+        try:
+            import matplotlib.pyplot as plt
+            from matplotlib import ticker
+            from matplotlib.colors import Normalize
+        except ImportError:
             raise RuntimeError( 'matplotlib is missing. Please install it before exporting distograms.')
             
         fig, axs = plt.subplots(nrows=ch_no, figsize=(base_size*frame_no/60+1, base_size))
@@ -0,0 +1,223 @@
+# Streaming (online) quality prediction, for videos that are supplied frame by frame
+import math
+import collections
+from statistics import NormalDist
+import torch
+
+from pycvvdp.video_source import video_source_array
+from pycvvdp.cvvdp_metric import safe_pow
+
+'''
+Computes ColorVideoVDP for a video that is supplied frame by frame, for example when monitoring a live
+transcode. Created by cvvdp.stream(). The frames are processed as soon as block_N_frames frames have been
+pushed, and instead of storing the quality of each frame, the pooling across frames is done with running
+sums. Only the sliding window of the temporal filters, the window of the Bloch integration (if enabled)
+and a few scalars are stored, so the memory does not grow with the length of the video.
+
+For the same frames, current_jod() gives the same result as cvvdp.predict(), up to floating point rounding.
+Heatmaps, dumping channels and temporal resampling are not supported.
+
+The confidence interval of the JOD is estimated with the method of batch means: the pooled per-frame
+differences are averaged in segments of ci_segment seconds and the spread of the segment means gives the
+standard error. The segments are used because the consecutive frames are strongly correlated. The interval
+tells how much the JOD could still change if the rest of the video was similar to what has been seen so far,
+it cannot predict a sudden change of quality later in the video.
+
+Example:
+    stream = metric.stream(30, 1080, 1920, early_exit_ci=0.2)
+    for test_frame, ref_frame in frames: # [height,width,colour] display-encoded frames
+        if stream.push(test_frame, ref_frame):
+            break
+    print( stream.current_jod(), stream.jod_confidence_interval() )
+'''
+class cvvdp_stream:
+
+    def __init__(self, metric, fps, height, width, block_N_frames=1, early_exit_ci=None, min_duration=2.0, ci_level=0.95, ci_segment=1.0):
+        if metric.do_heatmap or metric.dump_channels:
+            raise RuntimeError( "Heatmaps and dumping channels are not supported when streaming" )
+        if metric.temp_resample:
+            raise RuntimeError( "Temporal resampling is not supported when streaming" )
+        if fps <= 0:
+            raise RuntimeError( "Streaming requires the frame rate of the video (frames_per_second>0)" )
+
+        self.metric = metric
+        self.fps = fps
+        self.height = height
+        self.width = width
+        self.device = metric.device
+        self.early_exit_ci = early_exit_ci
+        self.min_duration = min_duration
+        self.ci_level = ci_level
+
+        self.lpyr = metric.create_contrast_pyramid(width, height)
+        self.met_colorspace = metric.get_met_colorspace()
+
+        self.temp_ch = 2
+        self.all_ch = 2+self.temp_ch
+        self.F, _ = metric.get_temporal_filters(fps)
+        self.filter_len = torch.numel(self.F[0])
+        self.block_N_frames = block_N_frames
+        # The ring buffer of the sliding window, frame n is stored at the index n % ring_len
+        self.ring_len = self.filter_len+block_N_frames-1
+        self.sw_buf = torch.zeros((1,2,3,self.ring_len,height,width), device=self.device, dtype=metric.dtype)
+        self.frames_buffered = 0 # Frames in sw_buf that have not been processed yet
+        self.frames_pushed = 0
+
+        if metric.do_Bloch_int:
+            self.bfilt_len = int(math.ceil(metric.bfilt_duration * fps))
+            self.Q_sc_window = collections.deque(maxlen=self.bfilt_len)
+        else:
+            self.bfilt_len = None
+
+        # float64 accumulators so that the running sums stay accurate for long videos (MPS does not support float64)
+        self.acc_dtype = torch.float32 if self.device.type == 'mps' else torch.float64
+        self.sample_cnt = 0   # The number of pooled values (frames or Bloch windows)
+        self.Q_p_sum = torch.zeros((), device=self.device, dtype=self.acc_dtype) # Sum of Q_tc^beta_t
+        self.Q_mean = torch.zeros((), device=self.device, dtype=self.acc_dtype)  # Running mean and the sum of squared differences of Q_tc (Welford's algorithm), for std_pool
+        self.Q_M2 = torch.zeros((), device=self.device, dtype=self.acc_dtype)
+
+        self.seg_len = max(1, int(round(ci_segment*fps)))
+        self.seg_sum = torch.zeros((), device=self.device, dtype=self.acc_dtype)
+        self.seg_cnt = 0
+        self.seg_N = 0        # The number of complete segments and the running mean and M2 of their means
+        self.seg_mean = torch.zeros((), device=self.device, dtype=self.acc_dtype)
+        self.seg_M2 = torch.zeros((), device=self.device, dtype=self.acc_dtype)
+
+    '''
+    Add one or more frames of the test and reference video. The frames are display-encoded and are passed through the display
+    model of the metric, the same as in cvvdp.predict(). dim_order is the order of dimensions of the frames, for example "HWC"
+    for a single frame or "FHWC" for several frames.
+
+    Returns True if the early exit condition is met (see the class description), False otherwise.
+    '''
+    def push(self, test_frame, reference_frame, dim_order="HWC"):
+        vs = video_source_array( test_frame, reference_frame, self.fps, dim_order=dim_order, display_photometry=self.metric.display_photometry )
+        height, width, N_frames = vs.get_video_size()
+        if height != self.height or width != self.width:
+            raise RuntimeError( f"Expected frames of the resolution {self.width}x{self.height}, got {width}x{height}" )
+
+        with torch.no_grad():
+            T = vs.get_test_frames(0, N_frames, device=self.device, colorspace=self.met_colorspace)
+            R = vs.get_reference_frames(0, N_frames, device=self.device, colorspace=self.met_colorspace)
+            for fi in range(N_frames):
+                ind = self.frames_pushed % self.ring_len
+                self.sw_buf[0,0,:,ind:ind+1,:,:] = T[0,:,fi:(fi+1),:,:]
+                self.sw_buf[0,1,:,ind:ind+1,:,:] = R[0,:,fi:(fi+1),:,:]
+                if self.frames_pushed == 0:
+                    # Replicate padding: frames -fl+1 .. -1 are a copy of the first frame
+                    self.sw_buf[:,:,:,(self.ring_len-self.filter_len+1):,:,:] = self.sw_buf[:,:,:,0:1,:,:]
+                self.frames_pushed += 1
+                self.frames_buffered += 1
+                if self.frames_buffered == self.block_N_frames:
+                    self.process_buffered_frames()
+
+        return self.can_stop()
+
+    # Process the frames in the sliding window that have not been processed yet
+    def process_buffered_frames(self):
+        N = self.frames_buffered
+        if N == 0:
+            return
+        ff = self.frames_pushed-N
+        R = torch.zeros((1, 8, N, self.height, self.width), device=self.device, dtype=self.metric.dtype)
+        self.metric.apply_temporal_filters(self.sw_buf, R, self.F, ff, self.all_ch)
+        self.frames_buffered = 0
+
+        Q_per_ch_block, _ = self.metric.process_block(R, (self.height, self.width, self.frames_pushed), self.temp_ch, self.lpyr, False)
+        Q_sc = self.metric.pool_spatial_bands(Q_per_ch_block) # [channel,frame,1]
+
+        if self.bfilt_len is None:
+            self.add_samples(self.metric.pool_channels(Q_sc).flatten())
+        else:
+            for fi in range(N):
+                self.Q_sc_window.append(Q_sc[:,fi,0])
+                if len(self.Q_sc_window) == self.bfilt_len:
+                    Q_bi = torch.stack(list(self.Q_sc_window), dim=1).sum(dim=1, keepdim=True)/float(self.bfilt_len)
+                    self.add_samples(self.metric.pool_channels(Q_bi).flatten())
+
+    # Update the running sums with the values of Q_tc (pooled across spatial bands and channels)
+    def add_samples(self, Q_tc):
+        Q_tc = Q_tc.to(self.acc_dtype)
+        beta_t = self.metric.beta_t
+        Q_p = safe_pow(Q_tc, beta_t) if isinstance(beta_t, torch.Tensor) else torch.abs(Q_tc)**beta_t
+        self.Q_p_sum += Q_p.sum()
+
+        # Welford's algorithm, combining the running statistics with those of the new values
+        n = Q_tc.numel()
+        n_new = self.sample_cnt + n
+        b_mean = Q_tc.mean()
+        delta = b_mean-self.Q_mean
+        self.Q_M2 += ((Q_tc-b_mean)**2).sum() + delta*delta*(self.sample_cnt*n/n_new)
+        self.Q_mean += delta*(n/n_new)
+        self.sample_cnt = n_new
+
+        # Segment means for the confidence interval
+        kk = 0
+        while kk < n:
+            take = min(n-kk, self.seg_len-self.seg_cnt)
+            self.seg_sum += Q_p[kk:(kk+take)].sum()
+            self.seg_cnt += take
+            kk += take
+            if self.seg_cnt == self.seg_len:
+                self.seg_N += 1
+                m = self.seg_sum/self.seg_len
+                delta = m-self.seg_mean
+                self.seg_mean += delta/self.seg_N
+                self.seg_M2 += delta*(m-self.seg_mean)
+                self.seg_sum.zero_()
+                self.seg_cnt = 0
+
+    # Pooled (across frames) difference for the mean of Q_tc^beta_t equal to Q_p_mean
+    def pooled_Q(self, Q_p_mean):
+        beta_t = self.metric.beta_t
+        Q = safe_pow(Q_p_mean, 1/beta_t) if isinstance(beta_t, torch.Tensor) else Q_p_mean**(1./beta_t)
+        if self.bfilt_len is None and self.metric.std_pool[0]=='T' and self.sample_cnt>1:
+            std_wt = 2**self.metric.std_w[0]
+            Q = Q + std_wt*torch.sqrt(self.Q_M2/(self.sample_cnt-1))
+        return Q.float()
+
+    def ensure_samples(self):
+        if self.frames_buffered > 0:
+            with torch.no_grad():
+                self.process_buffered_frames()
+        if self.sample_cnt == 0 and self.frames_pushed > 0 and not self.bfilt_len is None:
+            # Fewer frames than the Bloch integration window - use all the frames seen so far as one (shorter) window
+            Q_bi = torch.stack(list(self.Q_sc_window), dim=1).mean(dim=1, keepdim=True)
+            return safe_pow(self.metric.pool_channels(Q_bi).flatten().to(self.acc_dtype), self.metric.beta_t).mean()
+        if self.sample_cnt == 0:
+            raise RuntimeError( "No frames have been pushed to the stream" )
+        return self.Q_p_sum/self.sample_cnt
+
+    '''
+    The quality (in JOD) of all the frames pushed so far.
+    '''
+    def current_jod(self):
+        Q_p_mean = self.ensure_samples()
+        return self.metric.met2jod(self.pooled_Q(Q_p_mean).view(1)).squeeze()
+
+    '''
+    The confidence interval (jod_low, jod_high) of current_jod() at the level ci_level. Returns None if fewer than
+    two segments (of ci_segment seconds) have been processed.
+    '''
+    def jod_confidence_interval(self, ci_level=None):
+        if ci_level is None:
+            ci_level = self.ci_level
+        Q_p_mean = self.ensure_samples()
+        if self.seg_N < 2:
+            return None
+        z = NormalDist().inv_cdf(0.5+ci_level/2)
+        h = z*torch.sqrt(self.seg_M2/(self.seg_N-1)/self.seg_N)
+        Q_bounds = torch.stack( (self.pooled_Q((Q_p_mean-h).clamp(min=0.)), self.pooled_Q(Q_p_mean+h)) )
+        jod_high, jod_low = self.metric.met2jod(Q_bounds).tolist()
+        return (jod_low, jod_high)
+
+    # Duration (in seconds) of the video pushed so far
+    def get_duration(self):
+        return self.frames_pushed/self.fps
+
+    # True if the early exit was requested and the confidence interval of the JOD is narrow enough
+    def can_stop(self):
+        if self.early_exit_ci is None or self.get_duration() < self.min_duration:
+            return False
+        ci = self.jod_confidence_interval()
+        return not ci is None and (ci[1]-ci[0]) <= self.early_exit_ci
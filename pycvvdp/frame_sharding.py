@@ -0,0 +1,98 @@
+# Evaluation of a single video on several devices, each processing a contiguous range of frames
+import os
+import logging
+import multiprocessing as mp
+import numpy as np
+import torch
+
+from pycvvdp.video_source import video_source_segment
+
+# The metric of a worker process
+_shard_metric = None
+
+# The arguments needed to create a copy of the metric in a worker process
+def get_metric_args(metric):
+    return { 'display_photometry': metric.display_photometry,
+             'display_geometry': metric.display_geometry,
+             'config_paths': metric.config_paths,
+             'quiet': True,
+             'temp_padding': metric.temp_padding,
+             'calibrated_ckpt': metric.calibrated_ckpt,
+             'gpu_mem': metric.gpu_mem,
+             'dense_csf_lut': metric.dense_csf_lut,
+             'fused_masking': metric.fused_masking,
+             'compile': metric.compile,
+             'precision': metric.precision,
+             'tile_size': metric.tile_size }
+
+def _init_shard_worker(metric_args, device_q, N_workers, log_level):
+    global _shard_metric
+    from pycvvdp.cvvdp_metric import cvvdp
+    logging.basicConfig(format='[%(levelname)s] %(message)s', level=log_level)
+    slot, device = device_q.get()
+    device = torch.device(device)
+    if device.type == 'cpu' and hasattr(os, 'sched_setaffinity'):
+        # Pin each worker to its own subset of CPU cores
+        cores = sorted(os.sched_getaffinity(0))
+        # With more workers than cores, the workers share the cores, one core per worker
+        my_cores = cores[slot % len(cores)::N_workers]
+        os.sched_setaffinity(0, my_cores)
+        torch.set_num_threads(len(my_cores))
+    logging.debug( f"Shard worker {slot} running on device {device}" )
+    _shard_metric = cvvdp(device=device, **metric_args)
+
+# Evaluate the frames first .. end-1, reading the video from the frame run_first to fill the temporal filters
+def _evaluate_shard(task):
+    make_vid_source, run_first, first, end = task
+    vs = make_vid_source()
+    with torch.no_grad():
+        Q_jod, stats = _shard_metric.predict_batch([video_source_segment(vs, run_first, end-run_first)])[0]
+    return stats['Q_per_ch'][:,(first-run_first):,:], stats['rho_band']
+
+'''
+Predict the quality of a single video by splitting its frames into contiguous shards, one per device (see
+cvvdp.predict_sharded). Each shard is read from filter_len-1 frames before its first frame, so that the temporal
+filters are filled exactly as when the whole video is processed. The per-frame Q_per_ch of the shards are
+concatenated in the order of frames and pooled by the metric.
+'''
+def predict_sharded(metric, make_vid_source, devices, shards_per_device=1):
+    if metric.do_heatmap or metric.dump_channels:
+        raise RuntimeError( "Heatmaps and dumping channels are not supported when the frames are sharded across devices" )
+    if metric.temp_resample:
+        raise RuntimeError( "Temporal resampling is not supported when the frames are sharded across devices" )
+
+    vs = make_vid_source()
+    height, width, N_frames = vs.get_video_size()
+    fps = vs.get_frames_per_second()
+    del vs
+
+    N_shards = min(N_frames, len(devices)*shards_per_device)
+    if N_frames == 1 or N_shards < 2:
+        return metric.predict_video_source(make_vid_source())
+
+    F, _ = metric.get_temporal_filters(fps)
+    prime_len = torch.numel(F[0])-1 # Frames needed to fill the temporal filters
+
+    edges = np.linspace(0, N_frames, N_shards+1).round().astype(int)
+    tasks = [ (make_vid_source, max(0, int(e0)-prime_len), int(e0), int(e1)) for e0, e1 in zip(edges[:-1], edges[1:]) ]
+
+    ctx = mp.get_context('spawn') # CUDA cannot be used with forked processes
+    device_q = ctx.Queue()
+    for slot, dev in enumerate(devices):
+        device_q.put((slot, str(dev)))
+    with ctx.Pool(processes=len(devices), initializer=_init_shard_worker, initargs=(get_metric_args(metric), device_q, len(devices), logging.getLogger().getEffectiveLevel())) as pool:
+        results = pool.map(_evaluate_shard, tasks, chunksize=1)
+
+    Q_per_ch = torch.as_tensor(np.concatenate([Q for Q, rho_band in results], axis=1), device=metric.device)
+    rho_band = results[0][1]
+    Q_jod = metric.do_pooling_and_jods(Q_per_ch, rho_band[-1], fps)
+
+    stats = {}
+    stats['Q_per_ch'] = Q_per_ch.detach().cpu().numpy()
+    stats['rho_band'] = rho_band
+    stats['frames_per_second'] = fps
+    stats['width'] = width
+    stats['height'] = height
+    stats['N_frames'] = N_frames
+
+    return (Q_jod.squeeze(), stats)
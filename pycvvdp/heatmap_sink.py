@@ -0,0 +1,202 @@
+# Sinks that receive the heatmap of a video block by block, while the video is being processed
+import re
+import queue
+import threading
+import numpy as np
+import torch
+
+from pycvvdp.video_writer import VideoWriter
+
+'''
+A heatmap sink receives the heatmap of a video from cvvdp block by block (see the heatmap_sink argument of
+cvvdp.predict_video_source), so that the heatmap of a long video does not need to be stored in the memory. Only
+a single block of frames is kept at a time.
+
+A sink is opened by cvvdp at the start of the video, write() is called for each block of frames in the order of
+frames, and close() is called at the end. A sink can be used for a single video.
+
+dtype is the type of the heatmap the sink expects. If it is torch.uint8, cvvdp colour-maps and quantizes the heatmap 
+on its device (see visualize_diff_map_uint8), so that only 8-bit frames are copied to the host. 
+'''
+class heatmap_sink:
+
+    dtype = torch.float16
+
+    # Called before the first block. channels is 3 for the colour-coded heatmaps and 1 for the 'raw' heatmap.
+    def open(self, width, height, N_frames, fps, channels):
+        self.width = width
+        self.height = height
+        self.N_frames = N_frames
+        self.fps = fps
+        self.channels = channels
+        self.frames_written = 0
+
+    # heatmap - [1,channels,frames,height,width] float tensor, or uint8 tensor with the values 0-255 (on any device). 
+    # The colour-coded heatmaps are in the range 0-1, but the 'raw' heatmap can exceed that range. The values are 
+    # clamped to 0-1 before they are written as images or video; heatmap_memmap stores them unchanged. 
+    def write(self, heatmap):
+        if heatmap.dtype == torch.uint8:
+            frames = heatmap[0].permute(1,2,3,0).cpu().numpy() # [frames,height,width,channels]
+        else:
+            frames = heatmap[0].permute(1,2,3,0).clamp(0., 1.).float().cpu().numpy()
+        for fi in range(frames.shape[0]):
+            self.write_frame(frames[fi])
+            self.frames_written += 1
+
+    def write_frame(self, frame):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+'''
+Writes the heatmap to a video file (with ffmpeg, see pycvvdp.video_writer.VideoWriter). The heatmap is received as 8-bit 
+frames and passed to the encoder in a background thread, so that encoding overlaps with the computation of the metric. 
+On CUDA, the frames are copied to pinned host buffers on a separate stream, so that the copy overlaps with the processing 
+of the next block of frames. codec is the ffmpeg encoder, e.g. 'mpeg4' (default), 'libx264' or 'h264_nvenc'.
+'''
+class heatmap_video_writer(heatmap_sink):
+
+    dtype = torch.uint8
+
+    def __init__(self, fname, codec='mpeg4', verbose=False, queue_len=2):
+        self.fname = fname
+        self.codec = codec
+        self.verbose = verbose
+        self.queue_len = queue_len # The number of blocks waiting to be encoded
+        self.vw = None
+        self.thread = None
+
+    def open(self, width, height, N_frames, fps, channels):
+        super().open(width, height, N_frames, fps, channels)
+        self.vw = VideoWriter(self.fname, fps=fps, sdr_codec=self.codec, verbose=self.verbose)
+        self.blocks = queue.Queue(maxsize=self.queue_len)
+        self.free_buffers = queue.Queue()
+        self.N_buffers = 0
+        self.copy_stream = None
+        self.error = None
+        self.thread = threading.Thread(target=self._encode_blocks, daemon=True)
+        self.thread.start()
+
+    def write(self, heatmap):
+        if not self.error is None:
+            raise self.error
+        frames = heatmap[0].permute(1,2,3,0) # [frames,height,width,channels]
+        if frames.dtype != torch.uint8:
+            frames = (frames.clamp(0., 1.)*255.).to(torch.uint8)
+        if frames.shape[3] == 1:
+            frames = frames.expand(-1, -1, -1, 3)
+        frames = frames.contiguous()
+
+        if frames.device.type == 'cuda':
+            buf = self._get_buffer(frames.numel())
+            if self.copy_stream is None:
+                self.copy_stream = torch.cuda.Stream(frames.device)
+            self.copy_stream.wait_stream(torch.cuda.current_stream(frames.device))
+            with torch.cuda.stream(self.copy_stream):
+                host_frames = buf[:frames.numel()].view(frames.shape)
+                host_frames.copy_(frames, non_blocking=True)
+                frames.record_stream(self.copy_stream)
+                copy_done = torch.cuda.Event()
+                copy_done.record(self.copy_stream)
+        else:
+            buf = None
+            host_frames = frames.cpu()
+            copy_done = None
+        self.blocks.put( (host_frames, copy_done, buf) )
+        self.frames_written += frames.shape[0]
+
+    # A pinned host buffer of at least numel bytes. At most queue_len+1 buffers are allocated.
+    def _get_buffer(self, numel):
+        if self.free_buffers.empty() and self.N_buffers <= self.queue_len:
+            self.N_buffers += 1
+            return torch.empty((numel,), dtype=torch.uint8, pin_memory=True)
+        buf = self.free_buffers.get()
+        if buf.numel() < numel:
+            buf = torch.empty((numel,), dtype=torch.uint8, pin_memory=True)
+        return buf
+
+    def _encode_blocks(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            host_frames, copy_done, buf = block
+            try:
+                if not copy_done is None:
+                    copy_done.synchronize()
+                if self.error is None:
+                    self.vw.write_frames_uint8(host_frames.numpy())
+            except Exception as e:
+                self.error = e
+            if not buf is None:
+                self.free_buffers.put(buf)
+
+    def close(self):
+        if not self.thread is None:
+            self.blocks.put(None)
+            self.thread.join()
+            self.thread = None
+        if not self.vw is None:
+            self.vw.close()
+            self.vw = None
+        if not self.error is None:
+            error, self.error = self.error, None
+            raise error
+
+
+'''
+Writes each frame of the heatmap to an image file. fname_pattern must contain `%0Nd` (e.g. "heatmap_%04d.png"),
+which is replaced with the frame number (starting from 0).
+'''
+class heatmap_image_frames(heatmap_sink):
+
+    dtype = torch.uint8
+
+    def __init__(self, fname_pattern):
+        m = re.search( r"%(\d)*d", fname_pattern )
+        if m is None:
+            raise RuntimeError( "The file name of heatmap frames must contain `%0Nd` string to be replaced with a frame number" )
+        (beg, end) = m.span()
+        self.fname_format = fname_pattern[0:beg] + '{:' + fname_pattern[beg+1:end] + '}' + fname_pattern[end:]
+
+    def write_frame(self, frame):
+        import imageio.v2 as imageio
+        if frame.shape[2] == 1:
+            frame = np.concatenate([frame]*3, -1)
+        if frame.dtype != np.uint8:
+            frame = (frame*255.0).astype(np.uint8)
+        imageio.imwrite( self.fname_format.format(self.frames_written), frame )
+
+
+'''
+Writes the heatmap to a memory-mapped .npy file of the shape [frames,height,width,channels] (float16). The values are
+stored without clamping, the same as in stats['heatmap']. The file can be opened with np.load(fname, mmap_mode='r') 
+without loading it to the memory.
+'''
+class heatmap_memmap(heatmap_sink):
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.mm = None
+
+    def open(self, width, height, N_frames, fps, channels):
+        super().open(width, height, N_frames, fps, channels)
+        self.mm = np.lib.format.open_memmap(self.fname, mode='w+', dtype=np.float16, shape=(N_frames, height, width, channels))
+
+    def write(self, heatmap):
+        N = heatmap.shape[2]
+        self.mm[self.frames_written:(self.frames_written+N)] = heatmap[0].permute(1,2,3,0).to(torch.float16).cpu().numpy() # Not clamped, so that the 'raw' heatmap is stored as it is
+        self.frames_written += N
+
+    def close(self):
+        if not self.mm is None:
+            self.mm.flush()
+            self.mm = None
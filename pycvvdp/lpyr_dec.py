@@ -37,7 +37,7 @@ class lpyr_dec():
             max_band = invalid_bands[0][0]
 
         # max_band+1 below converts index into count
-        self.height = np.clip(max_band+1, 0, max_levels) # int(np.clip(max(np.ceil(np.log2(ppd)), 1.0)))
+        self.height = int(np.clip(max_band+1, 0, max_levels)) # A Python int, so that torch.compile can unroll the loops over the levels
         self.band_freqs = np.array([1.0] + [0.3228 * 2.0 **(-f) for f in range(self.height)]) * self.ppd/2.0
 
         self.pyr_shape = self.height * [None] # shape (W,H) of each level of the pyramid
@@ -145,7 +145,7 @@ class lpyr_dec():
 
     def gaussian_pyramid_dec(self, image, levels = -1, kernel_a = 0.4):
 
-        default_levels = int(np.floor(np.log2(min(image.shape[-2], image.shape[-1]))))
+        default_levels = min(image.shape[-2], image.shape[-1]).bit_length()-1 # floor(log2()) in integer arithmetic (also when compiled)
 
         if levels == -1:
             levels = default_levels
@@ -160,6 +160,16 @@ class lpyr_dec():
         return res
 
 
+    # Gaussian pyramid together with the expanded (upsampled) coarser levels, gexp[i] = expand(gpyr[i+1]).
+    # Those are the costly convolutions of the decomposition. Each channel is processed independently, 
+    # so the pyramids of the test and reference channels can be computed separately. 
+    def gaussian_pyramid_exp(self, image, kernel_a = 0.4):
+        gpyr = self.gaussian_pyramid_dec(image, self.height+1, kernel_a)
+        gexp = []
+        for i in range(len(gpyr)-1):
+            gexp.append(self.gausspyr_expand(gpyr[i+1], [gpyr[i].shape[-2], gpyr[i].shape[-1]], kernel_a))
+        return gpyr, gexp
+
     def sympad(self, x, padding, axis):
         if padding == 0:
             return x
@@ -172,7 +182,7 @@ class lpyr_dec():
     def get_kernels( self, im, kernel_a = 0.4 ):
 
         ch_dim = len(im.shape)-2
-        if hasattr(self, "K_horiz") and ch_dim==self.K_ch_dim:
+        if hasattr(self, "K_horiz") and ch_dim==self.K_ch_dim and self.K_horiz.dtype==im.dtype:
             return self.K_vert, self.K_horiz
 
         K = torch.tensor([0.25 - kernel_a/2.0, 0.25, kernel_a, 0.25, 0.25 - kernel_a/2.0], device=im.device, dtype=im.dtype)
@@ -236,6 +246,17 @@ class lpyr_dec():
 
         return y
 
+    # The same as gausspyr_expand(x, sz)[...,y0:y1,x0:x1], but only the coarse samples needed for the region are expanded. 
+    # The margin of 3 coarse samples ensures that the padding at the edges of the region does not affect the result.
+    def gausspyr_expand_region(self, x, sz, y0, y1, x0, x1, kernel_a = 0.4):
+        cy0, cy1 = max(0, y0//2-3), min(x.shape[-2], y1//2+3)
+        cx0, cx1 = max(0, x0//2-3), min(x.shape[-1], x1//2+3)
+        # At the bottom/right edge of the image, the size must be odd/even as in the full expansion
+        exp_h = sz[0]-2*cy0 if cy1==x.shape[-2] else 2*(cy1-cy0)
+        exp_w = sz[1]-2*cx0 if cx1==x.shape[-1] else 2*(cx1-cx0)
+        y = self.gausspyr_expand(x[...,cy0:cy1,cx0:cx1], [exp_h, exp_w], kernel_a)
+        return y[...,(y0-2*cy0):(y1-2*cy0),(x0-2*cx0):(x1-2*cx0)]
+
     def interleave_zeros(self, x, dim):
         z = torch.zeros_like(x, device=self.device)
         if dim==2:
@@ -272,7 +293,7 @@ class lpyr_dec_2(lpyr_dec):
             max_band = invalid_bands[0][0]
 
         # max_band+1 below converts index into count
-        self.height = np.clip(max_band+1, 0, max_levels) # int(np.clip(max(np.ceil(np.log2(ppd)), 1.0)))
+        self.height = int(np.clip(max_band+1, 0, max_levels)) # A Python int, so that torch.compile can unroll the loops over the levels
         self.band_freqs = np.array([1.0] + [0.3228 * 2.0 **(-f) for f in range(self.height)]) * self.ppd/2.0
 
         self.pyr_shape = self.height * [None] # shape (W,H) of each level of the pyramid
@@ -359,10 +380,13 @@ class weber_contrast_pyr(lpyr_dec):
         self.contrast = contrast
 
     def decompose(self, image):
-        levels = self.height+1
-        kernel_a = 0.4
-        gpyr = self.gaussian_pyramid_dec(image, levels, kernel_a)
+        # The expanded levels are computed one at a time in contrast_pyramid() so that only one is kept in memory
+        gpyr = self.gaussian_pyramid_dec(image, self.height+1)
+        return self.contrast_pyramid(gpyr)
 
+    # Compute contrast bands and the (log) background luminance from the Gaussian pyramid and its expanded levels (see gaussian_pyramid_exp).
+    # If gexp is None, the expanded levels are computed here.
+    def contrast_pyramid(self, gpyr, gexp=None):
         height = len(gpyr)
         if height == 0:
             return []
@@ -373,39 +397,13 @@ class weber_contrast_pyr(lpyr_dec):
             is_baseband = (i==(height-1))
 
             if is_baseband:
-                layer = gpyr[i]
-                if self.contrast.endswith('ref'):
-                    L_bkg = torch.clamp(gpyr[i][...,1:2,:,:,:], min=0.01)
-                else:
-                    L_bkg = torch.clamp(gpyr[i][...,0:2,:,:,:], min=0.01)
-                    # The sustained channels use the mean over the image as the background. Otherwise, they would be divided by itself and the contrast would be 1.
-                    L_bkg_mean = torch.mean(L_bkg, dim=[-1, -2], keepdim=True)
-                    L_bkg = L_bkg.repeat([int(image.shape[-4]/2), 1, 1, 1])
-                    L_bkg[0:2,:,:,:] = L_bkg_mean
-            else:
-                glayer_ex = self.gausspyr_expand(gpyr[i+1], [gpyr[i].shape[-2], gpyr[i].shape[-1]], kernel_a)
-                layer = gpyr[i] - glayer_ex 
-
-                # Order: test-sustained-Y, ref-sustained-Y, test-rg, ref-rg, test-yv, ref-yv, test-transient-Y, ref-transient-Y
-                # L_bkg is set to ref-sustained 
-                if self.contrast == 'weber_g1_ref':
-                    L_bkg = torch.clamp(glayer_ex[...,1:2,:,:,:], min=0.01)
-                elif self.contrast == 'weber_g1':
-                    L_bkg = torch.clamp(glayer_ex[...,0:2,:,:,:], min=0.01)
-                elif self.contrast == 'weber_g0_ref':
-                    L_bkg = torch.clamp(gpyr[i][...,1:2,:,:,:], min=0.01)
-                else:
-                    raise RuntimeError( f"Contrast {self.contrast} not supported")
-
-            if L_bkg.shape[-4]==2: # If L_bkg NOT identical for the test and reference images
-                contrast = torch.empty_like(layer)
-                contrast[...,0::2,:,:,:] = torch.clamp(torch.div(layer[...,0::2,:,:,:], L_bkg[...,0,:,:,:]), max=1000.0)    
-                contrast[...,1::2,:,:,:] = torch.clamp(torch.div(layer[...,1::2,:,:,:], L_bkg[...,1,:,:,:]), max=1000.0)    
+                glayer_ex = None
             else:
-                contrast = torch.clamp(torch.div(layer, L_bkg), max=1000.0)
+                glayer_ex = gexp[i] if not gexp is None else self.gausspyr_expand(gpyr[i+1], [gpyr[i].shape[-2], gpyr[i].shape[-1]])
+            contrast, log_L_bkg = self.contrast_band(gpyr[i], glayer_ex)
 
             lpyr.append(contrast)
-            L_bkg_pyr.append(torch.log10(L_bkg))
+            L_bkg_pyr.append(log_L_bkg)
 
         # L_bkg_bb = gpyr[height-1][...,0:2,:,:,:]
         # lpyr.append(gpyr[height-1]) # Base band
@@ -413,6 +411,43 @@ class weber_contrast_pyr(lpyr_dec):
 
         return lpyr, L_bkg_pyr
 
+    # Contrast and log background luminance of a single band, given the level of the Gaussian pyramid and the expanded
+    # coarser level (None for the baseband). Any region of a (non-base) band can be computed from the same regions of
+    # glayer and glayer_ex.
+    def contrast_band(self, glayer, glayer_ex):
+        if glayer_ex is None: # baseband
+            layer = glayer
+            if self.contrast.endswith('ref'):
+                L_bkg = torch.clamp(glayer[...,1:2,:,:,:], min=0.01)
+            else:
+                L_bkg = torch.clamp(glayer[...,0:2,:,:,:], min=0.01)
+                # The sustained channels use the mean over the image as the background. Otherwise, they would be divided by itself and the contrast would be 1.
+                L_bkg_mean = torch.mean(L_bkg, dim=[-1, -2], keepdim=True)
+                L_bkg = L_bkg.repeat([int(glayer.shape[-4]/2), 1, 1, 1])
+                L_bkg[0:2,:,:,:] = L_bkg_mean
+        else:
+            layer = glayer - glayer_ex 
+
+            # Order: test-sustained-Y, ref-sustained-Y, test-rg, ref-rg, test-yv, ref-yv, test-transient-Y, ref-transient-Y
+            # L_bkg is set to ref-sustained 
+            if self.contrast == 'weber_g1_ref':
+                L_bkg = torch.clamp(glayer_ex[...,1:2,:,:,:], min=0.01)
+            elif self.contrast == 'weber_g1':
+                L_bkg = torch.clamp(glayer_ex[...,0:2,:,:,:], min=0.01)
+            elif self.contrast == 'weber_g0_ref':
+                L_bkg = torch.clamp(glayer[...,1:2,:,:,:], min=0.01)
+            else:
+                raise RuntimeError( f"Contrast {self.contrast} not supported")
+
+        if L_bkg.shape[-4]==2: # If L_bkg NOT identical for the test and reference images
+            contrast = torch.empty_like(layer)
+            contrast[...,0::2,:,:,:] = torch.clamp(torch.div(layer[...,0::2,:,:,:], L_bkg[...,0,:,:,:]), max=1000.0)    
+            contrast[...,1::2,:,:,:] = torch.clamp(torch.div(layer[...,1::2,:,:,:], L_bkg[...,1,:,:,:]), max=1000.0)    
+        else:
+            contrast = torch.clamp(torch.div(layer, L_bkg), max=1000.0)
+
+        return contrast, torch.log10(L_bkg)
+
 
 # This pyramid computes and stores contrast during decomposition, improving performance and reducing memory consumption
 class log_contrast_pyr(lpyr_dec):
@@ -427,10 +462,13 @@ class log_contrast_pyr(lpyr_dec):
         self.b = math.log10(lms_d65[0]) - math.log10(lms_d65[1]) + math.log10(lms_d65[0]+lms_d65[1])
 
     def decompose(self, image):
-        levels = self.height+1
-        kernel_a = 0.4
-        gpyr = self.gaussian_pyramid_dec(image, levels, kernel_a)
+        # The expanded levels are computed one at a time in contrast_pyramid() so that only one is kept in memory
+        gpyr = self.gaussian_pyramid_dec(image, self.height+1)
+        return self.contrast_pyramid(gpyr)
 
+    # Compute contrast bands and the (log) background luminance from the Gaussian pyramid and its expanded levels (see gaussian_pyramid_exp).
+    # If gexp is None, the expanded levels are computed here.
+    def contrast_pyramid(self, gpyr, gexp=None):
         height = len(gpyr)
         if height == 0:
             return []
@@ -441,15 +479,10 @@ class log_contrast_pyr(lpyr_dec):
             is_baseband = (i==(height-1))
 
             if is_baseband:
-                contrast = gpyr[i]
-                L_bkg = self.a * (gpyr[i][...,0:2,:,:,:] - self.b)
+                glayer_ex = None
             else:
-                glayer_ex = self.gausspyr_expand(gpyr[i+1], [gpyr[i].shape[-2], gpyr[i].shape[-1]], kernel_a)
-                contrast = gpyr[i] - glayer_ex 
-
-                # Order: test-sustained-Y, ref-sustained-Y, test-rg, ref-rg, test-yv, ref-yv, test-transient-Y, ref-transient-Y                
-                # Mapping from log10(L) + log10(M) to log10(L+M)
-                L_bkg = self.a * (glayer_ex[...,0:2,:,:,:] - self.b)
+                glayer_ex = gexp[i] if not gexp is None else self.gausspyr_expand(gpyr[i+1], [gpyr[i].shape[-2], gpyr[i].shape[-1]])
+            contrast, L_bkg = self.contrast_band(gpyr[i], glayer_ex)
 
             lpyr.append(contrast)
             L_bkg_pyr.append(L_bkg)
@@ -457,6 +490,19 @@ class log_contrast_pyr(lpyr_dec):
         
         return lpyr, L_bkg_pyr
 
+    # Contrast and log background luminance of a single band (see weber_contrast_pyr.contrast_band)
+    def contrast_band(self, glayer, glayer_ex):
+        if glayer_ex is None: # baseband
+            contrast = glayer
+            L_bkg = self.a * (glayer[...,0:2,:,:,:] - self.b)
+        else:
+            contrast = glayer - glayer_ex 
+
+            # Order: test-sustained-Y, ref-sustained-Y, test-rg, ref-rg, test-yv, ref-yv, test-transient-Y, ref-transient-Y                
+            # Mapping from log10(L) + log10(M) to log10(L+M)
+            L_bkg = self.a * (glayer_ex[...,0:2,:,:,:] - self.b)
+        return contrast, L_bkg
+
 
     # def gausspyr_expand(self, x, sz = None, kernel_a = 0.4):
     #     if sz is None:
@@ -0,0 +1,206 @@
+# Calibration of the memory model used to decide how many frames cvvdp processes at once
+import os
+import json
+import time
+import weakref
+import logging
+import platform
+import threading
+import torch
+
+'''
+The memory needed by cvvdp to process a block of N frames of pix_cnt pixels is modelled as
+
+    total_mem = a + pix_cnt*(N+filter_len-1)*b + pix_cnt*N*c
+
+where b is the memory of the sliding window of the temporal filters and c is everything else (the temporal channels,
+pyramid, CSF, masking and the heatmap), both per pixel and per frame. c depends on the contrast and masking model, the
+heatmap, precision and the device, and the built-in constants in cvvdp.estimate_block_N are only rough estimates for
+CUDA. calibrate_memory_model() measures the peak memory for a few resolutions and block sizes, fits a and c and stores
+them in a per-machine cache file (memory_model.json in $PYCVVDP_CACHE_DIR, or ~/.cache/pycvvdp). The stored model is
+then used by cvvdp.estimate_block_N on both CUDA and CPU. With tile_size, the model is calibrated separately for each 
+tile size. The part of c needed for a tile does not grow with the resolution, so the model is conservative for 
+resolutions larger than those used for the calibration.
+
+On CUDA, the peak memory is the peak reserved by the PyTorch caching allocator. On CPU, it is the peak of the memory of
+the live tensors, which does not include the workspaces of some operations (e.g. convolutions), so a safety margin is added.
+'''
+
+_models = {}   # Contents of the cache file, loaded once per process
+_models_mtime = None
+_models_lock = threading.Lock()
+
+def get_cache_file():
+    cache_dir = os.environ.get('PYCVVDP_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'pycvvdp')
+    return os.path.join(cache_dir, 'memory_model.json')
+
+# The string identifying the settings of the metric and the device the memory model was measured for
+def get_memory_model_key(metric):
+    if metric.device.type == 'cuda':
+        dev_name = torch.cuda.get_device_name(metric.device)
+    else:
+        dev_name = metric.device.type + (':' + platform.processor() if platform.processor() else '')
+    heatmap = metric.heatmap if metric.do_heatmap else 'none'
+    tiles = '' if metric.tile_size is None else f"|tile-{metric.tile_size}"
+    return f"{dev_name}|torch-{torch.__version__}|{metric.contrast}|{metric.masking_model}|heatmap-{heatmap}|{metric.precision}|fused-{metric.fused_masking}|dense_csf-{metric.dense_csf_lut}|ckpt-{metric.use_checkpoints}" + tiles
+
+def _load_models():
+    global _models, _models_mtime
+    fname = get_cache_file()
+    try:
+        mtime = os.path.getmtime(fname)
+    except OSError:
+        return {}
+    if mtime != _models_mtime:
+        try:
+            with open(fname, 'r') as fh:
+                _models = json.load(fh)
+        except (OSError, ValueError) as e:
+            logging.warning( f"Cannot read the memory model cache '{fname}': {e}" )
+            _models = {}
+        _models_mtime = mtime
+    return _models
+
+# Returns a dict with 'a', 'b' and 'c' of the memory model measured for the metric, or None if it has not been calibrated
+def load_memory_model(metric):
+    with _models_lock:
+        return _load_models().get(get_memory_model_key(metric))
+
+def save_memory_model(metric, model):
+    fname = get_cache_file()
+    with _models_lock:
+        models = dict(_load_models())
+        models[get_memory_model_key(metric)] = model
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = fname + f".{os.getpid()}.tmp"
+        with open(tmp_fname, 'w') as fh:
+            json.dump(models, fh, indent=2)
+        os.replace(tmp_fname, fname) # Atomic, so that parallel processes do not read a partially written file
+
+# True if the exception was raised because the device ran out of memory
+def is_out_of_memory(e):
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and ("out of memory" in str(e) or "not enough memory" in str(e))
+
+'''
+Tracks the peak memory of the live tensors created by PyTorch operations (used on CPU, where PyTorch does not report
+the memory allocated).
+'''
+def _live_tensor_tracker():
+    from torch.utils._python_dispatch import TorchDispatchMode
+    from torch.utils._pytree import tree_flatten
+
+    class live_tensor_tracker(TorchDispatchMode):
+        def __init__(self):
+            super().__init__()
+            self.storages = {}  # data_ptr -> [bytes, the number of live tensors using the storage]
+            self.tracked = set()
+            self.current = 0
+            self.peak = 0
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            out = func(*args, **(kwargs or {}))
+            for tt in tree_flatten(out)[0]:
+                if isinstance(tt, torch.Tensor) and not id(tt) in self.tracked:
+                    self.track(tt)
+            return out
+
+        def track(self, tt):
+            st = tt.untyped_storage()
+            ptr = st.data_ptr()
+            if ptr in self.storages:
+                self.storages[ptr][1] += 1
+            else:
+                self.storages[ptr] = [st.nbytes(), 1]
+                self.current += st.nbytes()
+                self.peak = max(self.peak, self.current)
+            self.tracked.add(id(tt))
+            weakref.finalize(tt, self.release, id(tt), ptr)
+
+        def release(self, tid, ptr):
+            self.tracked.discard(tid)
+            entry = self.storages[ptr]
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.current -= entry[0]
+                del self.storages[ptr]
+
+    return live_tensor_tracker()
+
+# Peak memory (in bytes) needed to process a video of N frames of height x width pixels in a single block
+def measure_peak_memory(metric, height, width, N):
+    from pycvvdp.video_source import video_source_array
+    gen = torch.Generator().manual_seed(0)
+    ref = (torch.rand((1,3,N,height,width), generator=gen)*200+20).to(torch.uint8)
+    tst = (ref.to(torch.int16) + (torch.rand(ref.shape, generator=gen)*40-20).to(torch.int16)).clamp(0,255).to(torch.uint8)
+    vs = video_source_array(tst, ref, 30, dim_order='BCFHW', display_photometry=metric.display_photometry)
+
+    block_N_frames = metric.block_N_frames
+    metric.block_N_frames = N
+    try:
+        with torch.no_grad():
+            if metric.device.type == 'cuda':
+                torch.cuda.synchronize(metric.device)
+                torch.cuda.empty_cache()
+                base = torch.cuda.memory_reserved(metric.device)
+                torch.cuda.reset_peak_memory_stats(metric.device)
+                metric.predict_video_source(vs)
+                torch.cuda.synchronize(metric.device)
+                peak = torch.cuda.max_memory_reserved(metric.device) - base
+            else:
+                tracker = _live_tensor_tracker()
+                with tracker:
+                    metric.predict_video_source(vs)
+                peak = tracker.peak
+    finally:
+        metric.block_N_frames = block_N_frames
+    return peak
+
+'''
+Measure the peak memory for the given resolutions (a list of (height, width)) and the numbers of frames processed at once,
+fit the memory model and store it in the cache file (if save is True). Returns the model as a dict.
+'''
+def calibrate_memory_model(metric, resolutions=None, frames=None, save=True):
+    if resolutions is None:
+        resolutions = [(540, 960), (1080, 1920)] if metric.device.type == 'cuda' else [(270, 480), (540, 960)]
+    if frames is None:
+        frames = (2, 6) if metric.device.type == 'cuda' else (2, 3) # A single frame would be processed as an image
+
+    fps = 30
+    F, _ = metric.get_temporal_filters(fps)
+    filter_len = torch.numel(F[0])
+    b = 6*metric.dtype.itemsize # The sliding window stores 3 colour channels of the test and reference frames
+
+    t_start = time.time()
+    metric.predict_video_source(_dummy_source(metric, 64, 64, 1)) # Initialize everything that is allocated once
+    points = []
+    for height, width in resolutions:
+        for N in frames:
+            peak = measure_peak_memory(metric, height, width, N)
+            pix_cnt = height*width
+            points.append( (pix_cnt*N, peak - pix_cnt*(N+filter_len-1)*b) )
+            logging.debug( f"Peak memory for {N} frame(s) of {width}x{height}: {peak/1e6:.1f} MB" )
+
+    # Least squares fit of y = a + x*c, then c is increased so that the model is not below any of the measurements
+    X = torch.tensor([x for x, y in points], dtype=torch.float64)
+    Y = torch.tensor([y for x, y in points], dtype=torch.float64)
+    A = torch.stack((torch.ones_like(X), X), dim=1)
+    a, c = torch.linalg.lstsq(A, Y.view(-1,1)).solution.flatten().tolist()
+    a = max(a, 0.)
+    c = max([(y-a)/x for x, y in points])
+
+    margin = 1.1 if metric.device.type == 'cuda' else 1.25 # The CPU measurements do not include the workspaces of some operations
+    model = { 'a': a + 2.5e8, 'b': b, 'c': c*margin, 'resolutions': resolutions, 'frames': list(frames), 'date': time.strftime('%Y-%m-%d') }
+    logging.info( f"Memory model for '{get_memory_model_key(metric)}': a={model['a']/1e6:.0f} MB, c={model['c']:.1f} B/pixel/frame (calibrated in {time.time()-t_start:.1f} s)" )
+
+    if save:
+        save_memory_model(metric, model)
+    return model
+
+def _dummy_source(metric, height, width, N):
+    from pycvvdp.video_source import video_source_array
+    ref = torch.full((1,3,N,height,width), 128, dtype=torch.uint8)
+    return video_source_array(ref, ref, 30 if N>1 else 0, dim_order='BCFHW', display_photometry=metric.display_photometry)
@@ -0,0 +1,108 @@
+# Cache of the reference-side features, used when the same reference is compared with many test videos/images
+import os
+import logging
+import tempfile
+import torch
+
+'''
+Stores the features of a reference video that do not depend on the test video, so that they can be reused
+when the same reference is compared with many test videos (e.g. an encoding ladder). For each block of
+frames the cache stores:
+  'gpyr' - the Gaussian pyramid of the reference temporal channels (level 0 are the temporal channels)
+  'gexp' - the expanded Gaussian levels, so that the Laplacian bands are gpyr[i]-gexp[i]
+  'S'    - the per-band sensitivity (CSF), which is always computed for the reference
+
+The features are stored in the CPU memory, up to max_mem bytes. If the features do not fit, they are saved
+to cache_dir (or a temporary directory if cache_dir is None and spill_to_disk is True). If the features do
+not fit in memory and cannot be spilled, the reference is not cached. Note that the features of a long 
+high-resolution video are large (about 60 bytes per pixel per frame), so reading them back from a slow 
+disk can take longer than recomputing them.
+
+The key should identify the reference content, display model, frame rate and the range of frames. It is
+created by cvvdp.get_reference_cache_key().
+'''
+class reference_cache:
+
+    def __init__(self, max_mem=2e9, cache_dir=None, spill_to_disk=False):
+        self.max_mem = max_mem
+        self.cache_dir = cache_dir
+        self.spill_to_disk = spill_to_disk or (cache_dir is not None)
+        self.tmp_dir = None
+        self.entries = {}    # key -> { 'block_N_frames': int, 'complete': bool, 'blocks': { first_frame: dict or file name } }
+        self.mem_used = 0
+        self.file_cnt = 0
+
+    # True if all the blocks for the given key have been stored
+    def contains(self, key):
+        return key in self.entries and self.entries[key]['complete']
+
+    def get_block_N_frames(self, key):
+        return self.entries[key]['block_N_frames']
+
+    # Start storing the features for the given key. Any previous (incomplete) entry is discarded.
+    def begin(self, key, block_N_frames):
+        if key in self.entries:
+            self.discard(key)
+        self.entries[key] = { 'block_N_frames': block_N_frames, 'complete': False, 'blocks': {} }
+
+    # Mark that all the blocks for the given key have been stored
+    def end(self, key):
+        if key in self.entries:
+            self.entries[key]['complete'] = True
+
+    def is_recording(self, key):
+        return key in self.entries and not self.entries[key]['complete']
+
+    def put(self, key, ff, block):
+        if not self.is_recording(key):
+            return
+
+        block = { name: [tt.detach().to('cpu', copy=True) for tt in tensors] for name, tensors in block.items() }
+        block_bytes = sum( tt.numel()*tt.element_size() for tensors in block.values() for tt in tensors )
+
+        if self.mem_used + block_bytes <= self.max_mem:
+            self.entries[key]['blocks'][ff] = block
+            self.mem_used += block_bytes
+        elif self.spill_to_disk:
+            fname = os.path.join( self._get_dir(), f"ref_block_{self.file_cnt:06d}.pt" )
+            self.file_cnt += 1
+            torch.save( block, fname )
+            self.entries[key]['blocks'][ff] = fname
+        else:
+            logging.debug( "Reference features do not fit in the memory budget of the reference cache. The reference will not be cached." )
+            self.discard(key)
+
+    def get(self, key, ff, device):
+        block = self.entries[key]['blocks'][ff]
+        if isinstance(block, str):
+            block = torch.load( block, map_location=device )
+        return { name: [tt.to(device) for tt in tensors] for name, tensors in block.items() }
+
+    def discard(self, key):
+        if not key in self.entries:
+            return
+        for block in self.entries[key]['blocks'].values():
+            if isinstance(block, str):
+                if os.path.isfile(block):
+                    os.remove(block)
+            else:
+                self.mem_used -= sum( tt.numel()*tt.element_size() for tensors in block.values() for tt in tensors )
+        del self.entries[key]
+
+    def clear(self):
+        for key in list(self.entries.keys()):
+            self.discard(key)
+        if not self.tmp_dir is None:
+            self.tmp_dir.cleanup()
+            self.tmp_dir = None
+
+    def _get_dir(self):
+        if not self.cache_dir is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            return self.cache_dir
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix="cvvdp_ref_cache_")
+        return self.tmp_dir.name
+
+    def __del__(self):
+        self.clear()
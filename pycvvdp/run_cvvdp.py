@@ -3,14 +3,12 @@
 import os, sys
 import os.path
 import argparse
+import functools
 import logging
 #from natsort import natsorted
 import glob
-import ffmpeg
-import numpy as np
-import torch
-import imageio.v2 as imageio
 import re
+import time
 
 import pycvvdp
 
@@ -18,11 +16,9 @@ import shlex
 
 #from pyfvvdp.fvvdp_display_model import fvvdp_display_photometry, fvvdp_display_geometry
 # from pyfvvdp.visualize_diff_map import visualize_diff_map
-import pycvvdp.utils as utils
 
-from pycvvdp.ssim_metric import ssim_metric
-from pycvvdp.dm_preview import dm_preview_metric
-from pycvvdp.dump_channels import DumpChannels
+# PyTorch, numpy, ffmpeg and imageio are imported in the functions that need them so that the program starts 
+# quickly when it does not need them (e.g. --help or --display ?). See also --startup-profile.
 
 def expand_wildcards(filestrs):
     if not isinstance(filestrs, list):
@@ -38,6 +34,8 @@ def expand_wildcards(filestrs):
 
 # Save a numpy array as a video
 def np2vid(np_srgb, vidfile, fps, verbose=False):
+    import numpy as np
+    import ffmpeg
 
     N, H, W, C = np_srgb.shape
     if C == 1:
@@ -63,6 +61,8 @@ def np2vid(np_srgb, vidfile, fps, verbose=False):
 
 # Save a numpy array as an image
 def np2img(np_srgb, imgfile):
+    import numpy as np
+    import imageio.v2 as imageio
 
     N, H, W, C = np_srgb.shape
     if C == 1:
@@ -82,8 +82,11 @@ def parse_args(arg_list=None):
     parser.add_argument("-r", "--ref", type=str, nargs='+', required = False, help="list of reference images/videos")
     parser.add_argument("--device", type=str,  default='cuda:0', help="select which PyTorch device to use. Pick from ['cpu', 'mps', 'cuda:0', 'cuda:1', ...]")
     parser.add_argument("--heatmap", type=str, default="none", help="type of difference map (none, raw, threshold, supra-threshold).")
+    parser.add_argument("--heatmap-codec", type=str, default='mpeg4', help="ffmpeg encoder used for the heatmap videos (--heatmap-format mp4), e.g. 'mpeg4' (default, always available), 'libx264', or a hardware encoder, such as 'h264_nvenc' (NVIDIA) or 'h264_videotoolbox' (macOS).")
+    parser.add_argument("--heatmap-format", choices=['mp4', 'png', 'npy'], default='mp4', help="how the heatmap of a video is stored: 'mp4' - a video file, 'png' - one image per frame (base_heatmap_0000.png, ...), 'npy' - a float16 numpy array [frames,height,width,channels] that can be memory-mapped. The heatmap is written block by block while the video is processed, so it does not need to fit in the memory.")
     parser.add_argument("-g", "--distogram", type=float, default=-1, const=10, nargs='?', help="generate a distogram that visualizes the differences per-channel and per frame. The optional floating point parameter is the maximum JOD value to use in the visualization.")
     parser.add_argument("-x", "--features", action='store_true', default=False, help="generate JSON files with extracted features. Useful for retraining the metric.")
+    parser.add_argument("--features-format", choices=['json', 'npz'], default='json', help="the format of the feature files (--features): 'json' or 'npz' - a compact binary numpy archive with the features stored as a single float32 array, which can be memory-mapped.")
     parser.add_argument("-o", "--output-dir", type=str, default=None, help="in which directory heatmaps and feature files should be stored (the default is the current directory)")
     parser.add_argument("--result", type=str, default=None, help="write metric prediction results to a CSV file passed as an argument.")
     parser.add_argument("-c", "--config-paths", type=str, nargs='+', default=[], help="One or more paths to configuration files or directories. The main configurations files are `display_models.json`, `color_spaces.json` and `cvvdp_parameters.json`. The file name must start as the name of the original config file.")
@@ -94,12 +97,27 @@ def parse_args(arg_list=None):
     parser.add_argument("--temp-padding", choices=['replicate', 'circular', 'pingpong'], default='replicate', help='How to pad the video in the time domain (for the temporal filters). "replicate" - repeat the first frame. "pingpong" - mirror the first frames. "circular" - take the last frames.')
     parser.add_argument("--pix-per-deg", type=float, default=None, help='Overwrite display geometry and use the provided pixels per degree value.')
     parser.add_argument("--fps", type=float, default=None, help='Frames per second. It will overwrite frame rate stores in the video file. Required when passing an array of image files.')
-    parser.add_argument("--frames", type=str, default=None, help='Range of frames specified as first:step:last, first:last, or first: (Matlab notation). Currently works only with frames provided as images.')
+    parser.add_argument("--frames", type=str, default=None, help='Range of frames specified as first:step:last, first:last, or first: (Matlab notation). Currently works only with frames provided as images and raw .yuv files.')
     parser.add_argument("--gpu-mem", type=float, default=None, help='How much GPU memory can we use in GB. Use if CUDA reports out of mem errors, or you want to run multiple instances at the same time.')
+    parser.add_argument("--calibrate-memory", action='store_true', default=False, help="Measure how much memory cvvdp needs per pixel with the current settings (--device, --heatmap, --precision, ...) and store it in the per-machine cache (~/.cache/pycvvdp/memory_model.json). The measured model is then used to decide how many frames are processed at once, on both GPU and CPU. Exits after the calibration.")
+    parser.add_argument("--compile", action='store_true', default=False, help="Compile the metric with torch.compile (and use CUDA graphs on CUDA). The first block of frames of each resolution takes long to compile, but the following ones are faster. Use when processing many frames/videos of the same resolution, for example in the interactive or server mode.")
+    parser.add_argument("--precision", choices=['fp32', 'fp16', 'bf16', 'mixed'], default='fp32', help="Precision of the computations. 'fp16' computes the temporal filters, pyramid and masking in float16. 'bf16' and 'mixed' compute the temporal filters and pyramid in float16 and masking in bfloat16 or float32. Reduced precision uses less GPU memory, so more frames are processed at once, but the JOD values differ slightly from those computed with 'fp32'.")
+    parser.add_argument("--tile-size", type=int, default=None, metavar='PIXELS', help="Process the pyramid bands larger than PIXELSxPIXELS in tiles of that size. Reduces the GPU memory needed per frame for very high resolution content (8K and more), so that more frames are processed at once. The temporal filter buffers and the Gaussian pyramid are still stored for the full frame. The results are the same as without tiling.")
+    parser.add_argument("--temporal-sampling", choices=['uniform', 'random', 'scene'], default=None, help="Evaluate only some segments of each video (cvvdp only), which is much faster for long videos. The video is split into strata of N segments (see --sampling-every) and one segment per stratum is evaluated: 'uniform' - in the middle of the stratum, 'random' - at a random position, 'scene' - the strata are aligned with the scene cuts given in --scene-cuts. The standard error of the JOD due to sampling is reported.")
+    parser.add_argument("--sampling-every", type=int, default=10, metavar='N', help="With --temporal-sampling, evaluate one in N segments (default 10).")
+    parser.add_argument("--segment-duration", type=float, default=1.0, metavar='SECONDS', help="With --temporal-sampling, the duration of each evaluated segment in seconds (default 1).")
+    parser.add_argument("--scene-cuts", type=str, default=None, metavar='FRAMES', help="With --temporal-sampling scene, a comma-separated list of the first frames of the scenes, e.g. 0,240,1020")
+    parser.add_argument("--shard-devices", type=str, default=None, metavar='DEVICES', help="Split the frames of each video into contiguous shards processed in parallel on the listed devices (cvvdp only), e.g. 'cuda:0,cuda:1', or 'cpu,cpu,cpu,cpu' for four CPU worker processes. Speeds up the processing of a single long video.")
+    parser.add_argument("--ref-cache-mem", type=float, default=2, help='How much CPU memory (in GB) can be used to cache the reference features when a single reference is compared with many test videos/images. Set to 0 to disable the cache.')
+    parser.add_argument("--ref-cache-dir", type=str, default=None, help='Directory in which the reference features are stored when they do not fit in the memory set with --ref-cache-mem.')
     parser.add_argument("-q", "--quiet", action='store_true', default=False, help="Do not print any information but the final JOD value. Warning message will be still printed.")
     parser.add_argument("-v", "--verbose", action='store_true', default=False, help="Print out extra information.")
     parser.add_argument("--ffmpeg-cc", action='store_true', default=False, help="Use ffmpeg for upsampling and colour conversion. Use custom pytorch code by default (faster and less memory).")
+    parser.add_argument("--prefetch-frames", type=int, default=4, help="Decode video frames in background threads, keeping up to this many frames ready for processing. Set to 0 to decode frames on demand.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Process test/reference pairs in this many worker processes. The workers are distributed across CUDA devices or pinned to separate subsets of CPU cores. The results are reported in the input order.")
     parser.add_argument("-i", "--interactive", action='store_true', default=False, help="Run in an interactive mode, in which command line arguments are provided to the standard input, line by line. Saves on start-up time when running a large number of comparisons.")
+    parser.add_argument("--serve", type=str, default=None, metavar="ADDRESS", help="Run as a server, which listens on a UNIX socket (ADDRESS is a path) or a TCP socket (ADDRESS is host:port). Each request is a line with the command line arguments, as in the interactive mode. The metrics are initialized once and reused between the requests.")
+    parser.add_argument("--startup-profile", action='store_true', default=False, help="Report the time spent on importing modules and initializing the metric (and on the first comparison if test and reference are passed).")
     parser.add_argument("--dump-channels", nargs='+', choices=['temporal', 'lpyr', 'difference'], default=None, help="Output video/images with intermediate processing stages (for debugging and visualization).")
     if arg_list is not None:
         args = parser.parse_args(arg_list)
@@ -107,27 +125,8 @@ def parse_args(arg_list=None):
         args = parser.parse_args()
     return args
 
-def run_on_args(args):
-    if args.quiet:
-        log_level = logging.ERROR
-    else:        
-        log_level = logging.DEBUG if args.verbose else logging.INFO
-        
-    logging.basicConfig(format='[%(levelname)s] %(message)s', level=log_level)
-
-    if args.verbose:
-        import platform
-        logging.debug( f'Platform: {platform.platform()}' )
-
-    if args.display == "?":
-        pycvvdp.vvdp_display_photometry.list_displays(args.config_paths)
-        return
-
-    if args.test is None or args.ref is None:
-        logging.error( "Paths to both test and reference content needs to be specified.")
-        return
-
-    # Range of frames to process
+# Parse the range of frames to process, passed as first:step:last, first:last, or first:
+def get_frame_range(args):
     frame_range = None
     if not args.frames is None:
         ss = args.frames.split(':')
@@ -142,9 +141,10 @@ def run_on_args(args):
             frame_range = range(sn[0],(sn[2]+1),sn[1])
         elif len(ss) <= 2:
             frame_range = range(sn[0],(sn[1]+1))
-        
-
+    return frame_range
 
+def get_device(args):
+    import torch
     # Changed option to include MPS support for Macbooks
     # if args.gpu >= 0 and torch.cuda.is_available():
     #     device = torch.device('cuda:' + str(args.gpu))
@@ -163,8 +163,274 @@ def run_on_args(args):
         if args.device != 'cpu':
             logging.warning(f'The requested device ({args.device}) is not found, reverting to CPU. This may result in slow execution.')
         device = torch.device('cpu')
+    return device
+
+def get_display_models(args):
+    display_photometry = pycvvdp.vvdp_display_photometry.load(args.display, config_paths=args.config_paths)
+    if args.pix_per_deg is None:
+        display_geometry = pycvvdp.vvdp_display_geometry.load(args.display, config_paths=args.config_paths)
+    else:
+        display_geometry = pycvvdp.vvdp_display_geometry( [1024, 1024], ppd=args.pix_per_deg )
+    return display_photometry, display_geometry
+
+def create_metric(mm, args, device, display_photometry, display_geometry, ref_cache=None):
+    if mm == 'cvvdp':
+        if args.dump_channels:
+            from pycvvdp.dump_channels import DumpChannels
+            dump_channels = DumpChannels( dump_temp_ch=("temporal" in args.dump_channels), dump_lpyr=("lpyr" in args.dump_channels), dump_diff=("difference" in args.dump_channels), output_dir=args.output_dir )
+        else:
+            dump_channels = None
+
+        metric = pycvvdp.cvvdp( display_photometry=display_photometry,
+                                display_geometry=display_geometry,
+                                heatmap=args.heatmap, 
+                                device=device,
+                                temp_padding=args.temp_padding,
+                                config_paths=args.config_paths,
+                                quiet=args.quiet,
+                                gpu_mem=args.gpu_mem,
+                                compile=args.compile,
+                                precision=args.precision,
+                                tile_size=args.tile_size,
+                                dump_channels=dump_channels,
+                                ref_cache=ref_cache )
+    elif mm == 'pu-psnr-rgb':
+        if args.heatmap:
+            logging.warning( f'Skipping heatmap as it is not supported by {mm}' )
+        metric = pycvvdp.pu_psnr_rgb2020(device=device)
+    elif mm == 'pu-psnr-y':
+        if args.heatmap:
+            logging.warning( f'Skipping heatmap as it is not supported by {mm}' )
+        metric = pycvvdp.pu_psnr_y(device=device)
+    elif mm == 'ssim':
+        if args.heatmap:
+            logging.warning( f'Skipping heatmap as it is not supported by {mm}' )
+        from pycvvdp.ssim_metric import ssim_metric
+        metric = ssim_metric(device=device)
+    elif mm.startswith( 'dm-preview' ):
+        from pycvvdp.dm_preview import dm_preview_metric
+        metric = dm_preview_metric(output_exr=("exr" in mm), side_by_side=("sbs" in mm), device=device)
+    else:
+        raise RuntimeError( f"Unknown metric {mm}")
+
+    return metric
+
+def log_metric_info(metrics):
+    for mm in metrics:
+        info_str = mm.get_info_string()
+        if not info_str is None:
+            logging.info( 'When reporting metric results, please include the following information:' )
+            logging.info( info_str )
+
+def create_metrics(args, device, display_photometry, display_geometry, ref_cache=None):
+    metrics = [create_metric(mm, args, device, display_photometry, display_geometry, ref_cache) for mm in args.metric]
+    log_metric_info(metrics)
+    return metrics
+
+'''
+Keeps the display models and metric objects between the calls of run_on_args so that the configuration files are 
+read, and the CSF and pyramids are initialized, only once. Used in the interactive and server modes. The metrics 
+are keyed by the metric name and all the arguments that affect how the metric is initialized. 
+'''
+class metric_pool:
+
+    def __init__(self):
+        self.display_models = {}
+        self.metrics = {}
+
+    def get_display_models(self, args):
+        key = (args.display, tuple(args.config_paths), args.pix_per_deg)
+        if not key in self.display_models:
+            self.display_models[key] = get_display_models(args)
+        return self.display_models[key]
+
+    def get_metrics(self, args, device, display_photometry, display_geometry, ref_cache=None):
+        metrics = []
+        for mm in args.metric:
+            if mm == 'cvvdp' and args.dump_channels:
+                # The channels are dumped to args.output_dir - do not reuse 
+                metrics.append( create_metric(mm, args, device, display_photometry, display_geometry, ref_cache) )
+                continue
+            key = (mm, args.display, tuple(args.config_paths), args.pix_per_deg, args.heatmap, str(device), args.temp_padding, args.gpu_mem, args.compile, args.precision, args.tile_size, args.quiet)
+            if not key in self.metrics:
+                self.metrics[key] = create_metric(mm, args, device, display_photometry, display_geometry)
+            metric = self.metrics[key]
+            if mm == 'cvvdp':
+                metric.ref_cache = ref_cache # The cache is specific to each call
+            metrics.append( metric )
+        log_metric_info(metrics)
+        return metrics
+
+def create_reference_cache(args, N_test, N_ref, mem_fraction=1):
+    if N_ref==1 and N_test>1 and (args.ref_cache_mem>0 or not args.ref_cache_dir is None):
+        # The same reference is used with all test sources - cache its features
+        return pycvvdp.reference_cache( max_mem=args.ref_cache_mem*1e9*mem_fraction, cache_dir=args.ref_cache_dir )
+    else:
+        return None
+
+# Run all metrics on a single test/reference pair and write heatmaps, features and distograms. 
+# Returns a list of (metric name, quality unit, quality) tuples.
+def process_pair(args, metrics, test_file, ref_file, display_photometry, display_geometry, frame_range, out_dir):
+    import torch
+    results = []
+    logging.info(f"Predicting the quality of '{test_file}' compared to '{ref_file}'")
+    for mm in metrics:
+        # Other padding modes need random access to frames. Raw .yuv files are memory-mapped and do not need preloading.
+        preload = args.temp_padding != 'replicate' and os.path.splitext(test_file)[1].lower() != '.yuv'
+        with torch.no_grad():
+            make_vs = functools.partial( pycvvdp.video_source_file, test_file, ref_file, 
+                                            display_photometry=display_photometry, 
+                                            config_paths=args.config_paths,
+                                            full_screen_resize=args.full_screen_resize, 
+                                            resize_resolution=display_geometry.resolution, 
+                                            frames=args.nframes,
+                                            fps=args.fps,
+                                            frame_range=frame_range,
+                                            preload=preload,
+                                            ffmpeg_cc=args.ffmpeg_cc,
+                                            prefetch_frames=args.prefetch_frames,
+                                            verbose=args.verbose )
+            vs = make_vs()
+
+            base, ext = os.path.splitext(os.path.basename(test_file))            
+            base_fname = os.path.join(out_dir, base)
+            mm.set_base_fname(base_fname)
+
+            if not args.shard_devices is None and isinstance(mm, pycvvdp.cvvdp):
+                del vs # Each shard worker opens the video on its own
+                vs = None
+                Q_pred, stats = mm.predict_sharded(make_vs, args.shard_devices.split(','))
+            elif not args.temporal_sampling is None and isinstance(mm, pycvvdp.cvvdp):
+                scene_cuts = None if args.scene_cuts is None else [int(ff) for ff in args.scene_cuts.split(',')]
+                sampling = pycvvdp.temporal_sampling( args.temporal_sampling, every_nth=args.sampling_every, segment_duration=args.segment_duration, scene_cuts=scene_cuts )
+                Q_pred, stats = mm.predict_video_source(vs, temporal_sampling=sampling)
+                if 'jod_sampling_error' in stats:
+                    logging.info( f"Evaluated {stats['frames_evaluated']} of {stats['N_frames']} frames, the standard error due to sampling: {stats['jod_sampling_error']:.4f} JOD" )
+            elif args.heatmap and isinstance(mm, pycvvdp.cvvdp) and vs.get_video_size()[2]>1:
+                # Stream the heatmap of a video to a file while it is processed
+                if args.heatmap_format == 'png':
+                    dest_name = os.path.join(out_dir, base + "_heatmap_%04d.png")
+                    sink = pycvvdp.heatmap_image_frames(dest_name)
+                elif args.heatmap_format == 'npy':
+                    dest_name = os.path.join(out_dir, base + "_heatmap.npy")
+                    sink = pycvvdp.heatmap_memmap(dest_name)
+                else:
+                    dest_name = os.path.join(out_dir, base + "_heatmap.mp4")
+                    sink = pycvvdp.heatmap_video_writer(dest_name, codec=args.heatmap_codec, verbose=args.verbose)
+                logging.info("Writing heat map '" + dest_name + "' ...")
+                with sink:
+                    Q_pred, stats = mm.predict_video_source(vs, heatmap_sink=sink)
+            else:
+                Q_pred, stats = mm.predict_video_source(vs)
+            results.append( (mm.short_name(), mm.quality_unit(), float(Q_pred)) )
+
+            if args.features and not stats is None:
+                if mm == 'pu-psnr':
+                    logging.warning( f'Skipping features as it is not supported by {mm}' )
+                    break
+                dest_name = os.path.join(out_dir, base + "_fmap." + args.features_format)
+                logging.info("Writing feature map '" + dest_name + "' ...")
+                if args.features_format == 'npz':
+                    mm.write_features_to_npz(stats, dest_name)
+                else:
+                    mm.write_features_to_json(stats, dest_name)
+
+            if args.heatmap and not stats is None and 'heatmap' in stats:
+                if stats["heatmap"].shape[2]>1: # if it is a video
+                    dest_name = os.path.join(out_dir, base + "_heatmap.mp4")
+                    logging.info("Writing heat map '" + dest_name + "' ...")
+                    np2vid(torch.squeeze(stats["heatmap"].permute((2,3,4,1,0)), dim=4).cpu().numpy(), dest_name, vs.get_frames_per_second(), args.verbose)
+                else:
+                    dest_name = os.path.join(out_dir, base + "_heatmap.png")
+                    logging.info("Writing heat map '" + dest_name + "' ...")
+                    np2img(torch.squeeze(stats["heatmap"].permute((2,3,4,1,0)), dim=4).cpu().numpy(), dest_name)
+
+            if args.distogram != -1 and not stats is None:
+                dest_name = os.path.join(out_dir, base + "_distogram.png")                    
+                logging.info("Writing distogram '" + dest_name + "' ...")
+                jod_max = args.distogram
+                mm.export_distogram( stats, dest_name, jod_max=jod_max )
+
+            del stats
+    return results
+
+def set_log_level(args):
+    if args.quiet:
+        log_level = logging.ERROR
+    else:        
+        log_level = logging.DEBUG if args.verbose else logging.INFO
+        
+    logging.basicConfig(format='[%(levelname)s] %(message)s', level=log_level)
 
-    logging.info("Running on device: " + str(device))
+# State of a worker process when running with --jobs
+_worker = None
+
+def _init_worker(args, slot_q, N_test, N_ref):
+    import torch
+    global _worker
+    set_log_level(args)
+    slot = slot_q.get()  # Index of this worker, 0..jobs-1
+    device = get_device(args)
+    if device.type == 'cuda':
+        # Distribute workers across all GPUs
+        device = torch.device('cuda', slot % torch.cuda.device_count())
+    elif hasattr(os, 'sched_setaffinity'):
+        # Pin each worker to its own subset of CPU cores
+        cores = sorted(os.sched_getaffinity(0))
+        # With more workers than cores, the workers share the cores, one core per worker
+        my_cores = cores[slot % len(cores)::args.jobs]
+        os.sched_setaffinity(0, my_cores)
+        torch.set_num_threads(len(my_cores))
+    logging.debug( f"Worker {slot} running on device {device}" )
+
+    display_photometry, display_geometry = get_display_models(args)
+    ref_cache = create_reference_cache(args, N_test, N_ref, mem_fraction=1/args.jobs)
+    metrics = create_metrics(args, device, display_photometry, display_geometry, ref_cache)
+    out_dir = "." if args.output_dir is None else args.output_dir
+    _worker = (args, metrics, display_photometry, display_geometry, get_frame_range(args), out_dir)
+
+def _process_pair_in_worker(pair):
+    args, metrics, display_photometry, display_geometry, frame_range, out_dir = _worker
+    return process_pair(args, metrics, pair[0], pair[1], display_photometry, display_geometry, frame_range, out_dir)
+
+# Process the pairs in args.jobs worker processes, each holding its own instance of the metrics. 
+# The results are returned in the order of the pairs. 
+def process_pairs_in_parallel(args, pairs, N_test, N_ref):
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn') # CUDA cannot be used with forked processes
+    slot_q = ctx.Queue()
+    for slot in range(args.jobs):
+        slot_q.put(slot)
+    with ctx.Pool(processes=args.jobs, initializer=_init_worker, initargs=(args, slot_q, N_test, N_ref)) as pool:
+        for res in pool.imap(_process_pair_in_worker, pairs, chunksize=1):
+            yield res
+
+# pool - if a metric_pool is passed, the display models and metrics are reused between the calls
+def run_on_args(args, pool=None):
+    set_log_level(args)
+
+    if args.verbose:
+        import platform
+        logging.debug( f'Platform: {platform.platform()}' )
+
+    if args.display == "?":
+        pycvvdp.vvdp_display_photometry.list_displays(args.config_paths)
+        return
+
+    if args.calibrate_memory:
+        device = get_device(args)
+        display_photometry, display_geometry = get_display_models(args)
+        for mm in create_metrics(args, device, display_photometry, display_geometry):
+            if isinstance(mm, pycvvdp.cvvdp):
+                mm.calibrate_memory_model()
+        return
+
+    if args.test is None or args.ref is None:
+        logging.error( "Paths to both test and reference content needs to be specified.")
+        return
+
+    # Range of frames to process
+    frame_range = get_frame_range(args)
 
     heatmap_types = ["raw", "threshold", "supra-threshold"]
 
@@ -176,10 +442,6 @@ def run_on_args(args):
             logging.error( 'The recognized heatmap types are: "none", "raw", "threshold" and "supra-threshold"' )
             sys.exit()
 
-        do_heatmap = True
-    else:
-        do_heatmap = False
-        
     # Check for valid resizing methods
     #if args.gpu_decode:
         # Doc: https://pytorch.org/docs/stable/generated/torch.nn.functional.interpolate.html
@@ -209,126 +471,53 @@ def run_on_args(args):
         logging.error( "Pass the same number of reference and test sources, or a single reference (to be used with all test sources), or a single test (to be used with all reference sources)." )
         sys.exit()
 
-    metrics = []
-    display_photometry = pycvvdp.vvdp_display_photometry.load(args.display, config_paths=args.config_paths)
-    if args.pix_per_deg is None:
-        display_geometry = pycvvdp.vvdp_display_geometry.load(args.display, config_paths=args.config_paths)
-    else:
-        display_geometry = pycvvdp.vvdp_display_geometry( [1024, 1024], ppd=args.pix_per_deg )
-
     out_dir = "." if args.output_dir is None else args.output_dir
     os.makedirs(out_dir, exist_ok=True)
 
-    if args.dump_channels:
-        dump_channels = DumpChannels( dump_temp_ch=("temporal" in args.dump_channels), dump_lpyr=("lpyr" in args.dump_channels), dump_diff=("difference" in args.dump_channels), output_dir=args.output_dir )
-    else:
-        dump_channels = None
-
-    for mm in args.metric:
-        if mm == 'cvvdp':
-            fv = pycvvdp.cvvdp( display_photometry=display_photometry,
-                                display_geometry=display_geometry,
-                                heatmap=args.heatmap, 
-                                device=device,
-                                temp_padding=args.temp_padding,
-                                config_paths=args.config_paths,
-                                quiet=args.quiet,
-                                gpu_mem=args.gpu_mem,
-                                dump_channels=dump_channels )
-            metrics.append( fv )
-        elif mm == 'pu-psnr-rgb':
-            if args.heatmap:
-                logging.warning( f'Skipping heatmap as it is not supported by {mm}' )
-            metrics.append( pycvvdp.pu_psnr_rgb2020(device=device) )
-        elif mm == 'pu-psnr-y':
-            if args.heatmap:
-                logging.warning( f'Skipping heatmap as it is not supported by {mm}' )
-            metrics.append( pycvvdp.pu_psnr_y(device=device) )
-        elif mm == 'ssim':
-            if args.heatmap:
-                logging.warning( f'Skipping heatmap as it is not supported by {mm}' )
-            metrics.append( ssim_metric(device=device) )
-        elif mm.startswith( 'dm-preview' ):
-            metrics.append( dm_preview_metric(output_exr=("exr" in mm), side_by_side=("sbs" in mm), device=device) )
-        else:
-            raise RuntimeError( f"Unknown metric {mm}")
+    pairs = [ (args.test[min(kk,N_test-1)], args.ref[min(kk,N_ref-1)]) for kk in range( max(N_test, N_ref) ) ] # Test and reference pairs
 
-        info_str = metrics[-1].get_info_string()
-        if not info_str is None:
-            logging.info( 'When reporting metric results, please include the following information:' )
-            logging.info( info_str )
+    if not args.shard_devices is None and (args.jobs > 1 or not args.temporal_sampling is None or args.heatmap):
+        logging.error( "--shard-devices cannot be used with --jobs, --temporal-sampling or --heatmap" )
+        sys.exit()
 
-    if not args.result is None:
-        res_fh = open( args.result, "w" )
-        res_fh.write( 'test, reference' )
-        for mm in metrics:
-            res_fh.write( ', ' + mm.short_name() )
-        res_fh.write( '\n' )
+    if args.jobs > 1 and len(pairs) > 1:
+        if args.dump_channels:
+            logging.error( "--dump-channels cannot be used with --jobs" )
+            sys.exit()
+        logging.info( f"Running {args.jobs} worker processes" )
+        results = process_pairs_in_parallel(args, pairs, N_test, N_ref)
     else:
-        res_fh = None
-        
+        device = get_device(args)
+        logging.info("Running on device: " + str(device))
+
+        ref_cache = create_reference_cache(args, N_test, N_ref)
+        if pool is None:
+            display_photometry, display_geometry = get_display_models(args)
+            metrics = create_metrics(args, device, display_photometry, display_geometry, ref_cache)
+        else:
+            display_photometry, display_geometry = pool.get_display_models(args)
+            metrics = pool.get_metrics(args, device, display_photometry, display_geometry, ref_cache)
+        results = (process_pair(args, metrics, test_file, ref_file, display_photometry, display_geometry, frame_range, out_dir) for test_file, ref_file in pairs)
+
+    res_fh = None
+    for (test_file, ref_file), pair_res in zip(pairs, results):
+        if not args.result is None and res_fh is None:
+            res_fh = open( args.result, "w" )
+            res_fh.write( 'test, reference' )
+            for met_name, units, Q_pred in pair_res:
+                res_fh.write( ', ' + met_name )
+            res_fh.write( '\n' )
 
-    for kk in range( max(N_test, N_ref) ): # For each test and reference pair
-        test_file = args.test[min(kk,N_test-1)]
-        ref_file = args.ref[min(kk,N_ref-1)]
         if not res_fh is None:
             res_fh.write( f"{test_file}, {ref_file}" )
-        logging.info(f"Predicting the quality of '{test_file}' compared to '{ref_file}'")
-        for mm in metrics:
-            preload = False if args.temp_padding == 'replicate' else True
-            with torch.no_grad():
-                vs = pycvvdp.video_source_file( test_file, ref_file, 
-                                                display_photometry=display_photometry, 
-                                                config_paths=args.config_paths,
-                                                full_screen_resize=args.full_screen_resize, 
-                                                resize_resolution=display_geometry.resolution, 
-                                                frames=args.nframes,
-                                                fps=args.fps,
-                                                frame_range=frame_range,
-                                                preload=preload,
-                                                ffmpeg_cc=args.ffmpeg_cc,
-                                                verbose=args.verbose )
-
-                base, ext = os.path.splitext(os.path.basename(test_file))            
-                base_fname = os.path.join(out_dir, base)
-                mm.set_base_fname(base_fname)
-
-                Q_pred, stats = mm.predict_video_source(vs)
-                if args.quiet:
-                    print( "{Q:0.4f}".format(Q=Q_pred) )
-                else:
-                    units_str = f" [{mm.quality_unit()}]"
-                    print( "{met_name}={Q:0.4f}{units}".format(met_name=mm.short_name(), Q=Q_pred, units=units_str) )
-                if not res_fh is None:
-                    res_fh.write( f", {Q_pred}" )
-
-
-                if args.features and not stats is None:
-                    if mm == 'pu-psnr':
-                        logging.warning( f'Skipping features as it is not supported by {mm}' )
-                        break
-                    dest_name = os.path.join(out_dir, base + "_fmap.json")
-                    logging.info("Writing feature map '" + dest_name + "' ...")
-                    mm.write_features_to_json(stats, dest_name)
-
-                if do_heatmap and not stats is None:
-                    if stats["heatmap"].shape[2]>1: # if it is a video
-                        dest_name = os.path.join(out_dir, base + "_heatmap.mp4")
-                        logging.info("Writing heat map '" + dest_name + "' ...")
-                        np2vid(torch.squeeze(stats["heatmap"].permute((2,3,4,1,0)), dim=4).cpu().numpy(), dest_name, vs.get_frames_per_second(), args.verbose)
-                    else:
-                        dest_name = os.path.join(out_dir, base + "_heatmap.png")
-                        logging.info("Writing heat map '" + dest_name + "' ...")
-                        np2img(torch.squeeze(stats["heatmap"].permute((2,3,4,1,0)), dim=4).cpu().numpy(), dest_name)
-
-                if args.distogram != -1 and not stats is None:
-                    dest_name = os.path.join(out_dir, base + "_distogram.png")                    
-                    logging.info("Writing distogram '" + dest_name + "' ...")
-                    jod_max = args.distogram
-                    mm.export_distogram( stats, dest_name, jod_max=jod_max )
-
-                del stats
-
+        for met_name, units, Q_pred in pair_res:
+            if args.quiet:
+                print( "{Q:0.4f}".format(Q=Q_pred) )
+            else:
+                units_str = f" [{units}]"
+                print( "{met_name}={Q:0.4f}{units}".format(met_name=met_name, Q=Q_pred, units=units_str) )
+            if not res_fh is None:
+                res_fh.write( f", {Q_pred}" )
         if not res_fh is None:
             res_fh.write( "\n" )
 
@@ -338,11 +527,121 @@ def run_on_args(args):
     #     del test_vid
     #     torch.cuda.empty_cache()
 
+'''
+Run as a server listening on a UNIX socket (address is a path) or a TCP socket (address is host:port). Each request 
+is a single line with the command line arguments, as in the interactive mode. The response contains the lines that
+would be printed to the standard output, followed by a line with "OK" or "ERROR: <message>". A client can send 
+many requests over the same connection. The requests are processed one at a time, reusing the metrics from the pool.
+'''
+def run_server(address, pool):
+    import socketserver
+    import threading
+    import io
+    import contextlib
+
+    lock = threading.Lock()
+
+    class request_handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                out = io.StringIO()
+                err = io.StringIO()
+                # The logging handlers write to the stderr of the server, so the errors logged by run_on_args
+                # (e.g. failed checks of the arguments) are captured with a separate handler
+                err_handler = logging.StreamHandler(err)
+                err_handler.setLevel(logging.ERROR)
+                with lock, contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                    logging.getLogger().addHandler(err_handler)
+                    try:
+                        req_argv = shlex.split(line)
+                        is_help = '-h' in req_argv or '--help' in req_argv
+                        run_on_args(parse_args(req_argv), pool)
+                        status = "OK"
+                    except SystemExit as e:
+                        if e.code in (None, 0) and is_help:
+                            status = "OK"
+                        else: # argparse error or failed checks in run_on_args
+                            err_lines = err.getvalue().strip().splitlines()
+                            status = "ERROR: " + (err_lines[-1] if err_lines else "invalid request")
+                    except Exception as e:
+                        logging.exception( f"Failed to process the request '{line}'" )
+                        status = f"ERROR: {e}"
+                    finally:
+                        logging.getLogger().removeHandler(err_handler)
+                self.wfile.write( (out.getvalue() + status + "\n").encode('utf-8') )
+                self.wfile.flush()
+
+    host, sep, port = address.rpartition(':')
+    is_tcp = sep and port.isnumeric()
+    if is_tcp:
+        server = socketserver.ThreadingTCPServer( (host or 'localhost', int(port)), request_handler )
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = socketserver.ThreadingUnixStreamServer( address, request_handler )
+    server.daemon_threads = True
+
+    logging.info( f"Listening on '{address}'" )
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    if not is_tcp and os.path.exists(address):
+        os.remove(address)
+
+'''
+Report how much time is spent on importing the modules and initializing the metrics. If test and reference 
+files are passed, the time of the first comparison is also reported. 
+'''
+def startup_profile(args):
+    import importlib
+    set_log_level(args)
+
+    timings = []
+    def measure(label, fn):
+        t_start = time.perf_counter()
+        res = fn()
+        timings.append( (label, time.perf_counter()-t_start) )
+        return res
+
+    t_start = time.perf_counter()
+    for module in ['numpy', 'torch', 'pycvvdp.display_model', 'pycvvdp.cvvdp_metric', 'pycvvdp.video_source_file']:
+        measure( f"import {module}", lambda: importlib.import_module(module) )
+    device = measure( "select device", lambda: get_device(args) )
+    display_photometry, display_geometry = measure( "load display models", lambda: get_display_models(args) )
+    metrics = measure( "initialize metrics", lambda: create_metrics(args, device, display_photometry, display_geometry) )
+
+    if not args.test is None and not args.ref is None:
+        if args.heatmap == "none":
+            args.heatmap = None
+        test_file = expand_wildcards(args.test)[0]
+        ref_file = expand_wildcards(args.ref)[0]
+        out_dir = "." if args.output_dir is None else args.output_dir
+        measure( "first comparison", lambda: process_pair(args, metrics, test_file, ref_file, display_photometry, display_geometry, get_frame_range(args), out_dir) )
+    t_total = time.perf_counter()-t_start
+
+    print( "Start-up profile:" )
+    for label, t in timings:
+        print( f"  {label:<35s} {t*1000:8.1f} ms" )
+    print( f"  {'total':<35s} {t_total*1000:8.1f} ms" )
+    optional = [mm for mm in ['torchvision', 'matplotlib', 'scipy', 'imageio', 'ffmpeg', 'pyexr', 'pynvml'] if mm in sys.modules]
+    print( f"Optional modules loaded: {', '.join(optional) if optional else 'none'}" )
+
 def main():
     args = parse_args()
 
-    if args.interactive:
+    if args.startup_profile:
+        startup_profile(args)
+    elif not args.serve is None:
+        set_log_level(args)
+        run_server(args.serve, metric_pool())
+    elif args.interactive:
         #print( "Running in an interactive mode" )
+        pool = metric_pool()
         while True:
             line = sys.stdin.readline()
             if not line:
@@ -350,7 +649,7 @@ def main():
 
             #print( shlex.split(line) )
             args = parse_args(shlex.split(line))
-            run_on_args(args)
+            run_on_args(args, pool)
     else:
         run_on_args(args)
 
@@ -0,0 +1,66 @@
+# Selection of the segments of a video that are evaluated in the temporal sampling mode
+import math
+import numpy as np
+
+'''
+Describes which segments of a video are evaluated when only a part of a long video is scored (see
+cvvdp.predict_video_source). The video is divided into strata of every_nth*segment_duration seconds and a single
+segment of segment_duration seconds is evaluated in each stratum. The quality of the segment stands for the quality
+of the whole stratum. The segments are placed:
+  'uniform' - in the middle of each stratum (every Nth segment)
+  'random'  - at a random position in each stratum (stratified random sampling), controlled by seed
+  'scene'   - the strata are the scenes (shots) given by scene_cuts (the first frame of each scene). Scenes longer
+              than every_nth segments are split into several strata. The segment is placed in the middle of the stratum.
+
+Each segment is preceded by the frames needed to fill the temporal filters, so the evaluated frames get the same
+values as when the whole video is processed. The cost of scoring a video is reduced approximately by the factor of
+every_nth * segment_frames / (segment_frames + filter_len - 1).
+'''
+class temporal_sampling:
+
+    def __init__(self, mode='uniform', every_nth=10, segment_duration=1.0, seed=0, scene_cuts=None):
+        if not mode in ('uniform', 'random', 'scene'):
+            raise RuntimeError( f'Unknown temporal sampling mode "{mode}"' )
+        if mode == 'scene' and scene_cuts is None:
+            raise RuntimeError( 'The "scene" temporal sampling needs the list of scene cuts (scene_cuts)' )
+        if every_nth < 1:
+            raise RuntimeError( 'every_nth must be at least 1' )
+        self.mode = mode
+        self.every_nth = every_nth
+        self.segment_duration = segment_duration
+        self.seed = seed
+        self.scene_cuts = scene_cuts
+
+    def get_segment_frames(self, fps):
+        return max(1, int(math.ceil(self.segment_duration*fps)))
+
+    '''
+    Returns a list of (stratum_start, stratum_end, segment_start, segment_end) tuples (the end frames are exclusive),
+    ordered by frames. The strata cover all N_frames frames.
+    '''
+    def get_strata(self, N_frames, fps):
+        seg_len = self.get_segment_frames(fps)
+        stratum_len = seg_len*self.every_nth
+
+        if self.mode == 'scene':
+            cuts = sorted(set([0] + [int(cc) for cc in self.scene_cuts if 0 < cc < N_frames]))
+            scenes = list(zip(cuts, cuts[1:] + [N_frames]))
+        else:
+            scenes = [(0, N_frames)]
+
+        bounds = []
+        for s0, s1 in scenes:
+            N_strata = max(1, int(round((s1-s0)/stratum_len)))
+            edges = np.linspace(s0, s1, N_strata+1).round().astype(int)
+            bounds += [(int(e0), int(e1)) for e0, e1 in zip(edges[:-1], edges[1:]) if e1 > e0]
+
+        rng = np.random.default_rng(self.seed)
+        strata = []
+        for t0, t1 in bounds:
+            L = min(seg_len, t1-t0)
+            if self.mode == 'random':
+                p0 = t0 + int(rng.integers(0, t1-t0-L+1))
+            else:
+                p0 = t0 + (t1-t0-L)//2
+            strata.append( (t0, t1, p0, p0+L) )
+        return strata
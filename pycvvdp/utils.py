@@ -4,12 +4,12 @@ import numpy as np
 import json
 import torch.nn.functional as Func
 import math
+import warnings
 from functools import cache
 
 from pycvvdp.interp import interp1, interp1q
 #from PIL import Image
 
-from pycvvdp.third_party.loadmat import loadmat
 
 def torch_gpu_mem_info():
     t = torch.cuda.get_device_properties(0).total_memory
@@ -40,6 +40,110 @@ def srgb2linear_torch(srgb):
 def img2np(img):
     return np.array(img, dtype="float32") * 1.0/255.0
 
+'''
+Wrap a numpy array as a tensor without copying it (the tensor shares the memory with the array). PyTorch does not
+support uint16 (before 2.3), so uint16 arrays are viewed as int16 - the bits are unchanged and the values are unpacked
+by unpack_to_fp32. Read-only arrays (e.g. memory-mapped files) are wrapped too - the tensor must not be written to.
+'''
+def np_as_tensor(X):
+    if X.dtype == np.uint16:
+        X = X.view(np.int16)
+    if any(st < 0 for st in X.strides): # torch.from_numpy does not support negative strides
+        X = np.ascontiguousarray(X)
+    if not X.flags.writeable:
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+            return torch.from_numpy(X)
+    return torch.from_numpy(X)
+
+'''
+Transfer integer pixel values to the device and convert them to float32, divided by max_value (if not None). X is a
+numpy array or a tensor, int16 tensors hold packed uint16 values (see np_as_tensor). The values are transferred in
+their original type (half or quarter of the size of float32) and converted on the device. When PyTorch supports
+uint16, the int16 values are unpacked and converted in a single step, otherwise they are expanded to int32 and masked.
+'''
+def unpack_to_fp32(X, device, max_value=None):
+    if isinstance(X, np.ndarray):
+        X = np_as_tensor(X)
+    X = X.to(device)
+    if X.dtype == torch.int16:
+        if hasattr(torch, 'uint16'):
+            X_fp32 = X.view(torch.uint16).to(torch.float32)
+        else:
+            X_fp32 = (X.to(torch.int32) & (2**16-1)).to(torch.float32)
+    else:
+        X_fp32 = X.to(torch.float32)
+    if not max_value is None:
+        # In-place, unless X_fp32 is the (float32) input tensor
+        X_fp32 = X_fp32.div_(max_value) if X.dtype != torch.float32 else X_fp32/max_value
+    return X_fp32
+
+# Sub-sampling factors (vertical, horizontal) of the chroma planes, named as in ffmpeg pixel formats (yuv420p, yuv422p10le, ...)
+chroma_subsampling = { '444': (1, 1), '422': (1, 2), '420': (2, 2), '411': (1, 4), '440': (2, 1) }
+
+# The position of a chroma sample within the block of luma samples it covers (vertical, horizontal): 0 - co-sited
+# with the first (top or left) luma sample, 0.5 - in the centre, 1 - co-sited with the last luma sample. The names
+# are the same as the chroma_location reported by ffprobe.
+chroma_siting = { 'left': (0.5, 0.), 'center': (0.5, 0.5), 'topleft': (0., 0.), 'top': (0., 0.5), 'bottomleft': (1., 0.), 'bottom': (1., 0.5) }
+
+# The resolution (height, width) of the chroma planes. ffmpeg rounds up for odd sizes.
+def get_chroma_shape(height, width, chroma_ss):
+    if not chroma_ss in chroma_subsampling:
+        raise RuntimeError( f"Unrecognized chroma subsampling {chroma_ss}" )
+    fv, fh = chroma_subsampling[chroma_ss]
+    return (-(-height//fv), -(-width//fh))
+
+# Linear interpolation of the last dimension of X by the integer factor f. The chroma sample k is at the luma
+# position f*k + s. The samples beyond the edges are replicated.
+def _upsample_linear_last_dim(X, f, s):
+    if f == 1:
+        return X
+    X_prev = torch.cat((X[...,:1], X[...,:-1]), dim=-1)
+    X_next = torch.cat((X[...,1:], X[...,-1:]), dim=-1)
+    phases = []
+    for r in range(f): # The output samples f*k + r
+        d = (r - s)/f  # Distance to the chroma sample k (in chroma samples)
+        phases.append( torch.lerp(X, X_next, d) if d >= 0 else torch.lerp(X, X_prev, -d) )
+    return torch.stack(phases, dim=-1).flatten(start_dim=-2)
+
+'''
+Upsample the chroma planes uv ([..., height, width] tensor, e.g. [frames, 2, height, width]) to the luma resolution
+size=(height, width), taking into account the position of the chroma samples (siting, see chroma_siting). The
+separable linear filter is applied to all frames and planes at once. With the 'center' siting, the result is the
+same as bilinear interpolation.
+'''
+def upsample_chroma(uv, chroma_ss, size, siting='center'):
+    fv, fh = chroma_subsampling[chroma_ss]
+    av, ah = chroma_siting[siting]
+    uv = _upsample_linear_last_dim(uv, fh, ah*(fh-1))
+    uv = _upsample_linear_last_dim(uv.transpose(-1, -2), fv, av*(fv-1)).transpose(-1, -2)
+    return uv[...,:size[0],:size[1]]
+
+'''
+Convert a batch of frames in a planar YUV format (Y, u and v planes stored one after another, as in ffmpeg's rawvideo),
+given as a [frames, frame_pixels] float32 tensor of integer code values, into a [frames, height, width, 3] tensor
+with Y in the range 0..1 and u, v in the range -0.5..0.5 (limited range is assumed). The chroma is upsampled to the
+full resolution.
+'''
+def fixed2float_yuv(frames, height, width, bit_depth, chroma_ss, siting='center'):
+    B = frames.shape[0]
+    y_pixels = height*width
+    uv_shape = get_chroma_shape(height, width, chroma_ss)
+    uv_pixels = uv_shape[0]*uv_shape[1]
+
+    Yuv = torch.empty(B, height, width, 3, device=frames.device)
+
+    offset = 16/219
+    weight = 1/(2**(bit_depth-8)*219)
+    Yuv[..., 0] = torch.clip(weight*frames[:, :y_pixels] - offset, 0, 1).reshape(B, height, width)
+
+    offset = 128/224
+    weight = 1/(2**(bit_depth-8)*224)
+    uv = torch.clip(weight*frames[:, y_pixels:(y_pixels+2*uv_pixels)] - offset, -0.5, 0.5).reshape(B, 2, uv_shape[0], uv_shape[1])
+
+    Yuv[..., 1:] = upsample_chroma(uv, chroma_ss, (height, width), siting).permute(0, 2, 3, 1)
+    return Yuv
+
 # def np2img(nparr):
 #     return Image.fromarray(np.clip(nparr * 255.0, 0.0, 255.0).astype('uint8'))
 
@@ -60,6 +164,7 @@ def load_mat_dict(filepath, data_label, device):
     if not os.path.isfile(filepath):
         return None
     else:
+        from pycvvdp.third_party.loadmat import loadmat # scipy is slow to import
         v = loadmat(filepath)
         if data_label in v:
             return v[data_label]
@@ -74,6 +179,7 @@ def load_mat_tensor(filepath, data_label, device):
     if not os.path.isfile(filepath):
         return None
     else:
+        from pycvvdp.third_party.loadmat import loadmat # scipy is slow to import
         v = loadmat(filepath)
         if data_label in v:
             return torch.tensor(v[data_label], device=device)
@@ -130,6 +236,32 @@ class ImGaussFilt():
         return Func.conv2d(img_4d, self.K)[0,0]
 
 
+'''
+Gaussian blur over the last two dimensions of a [N,C,H,W] tensor with reflect padding. It gives the same results as 
+torchvision.transforms.GaussianBlur(kernel_size, sigma), but avoids importing torchvision, which is slow.
+'''
+class GaussianBlur():
+    def __init__(self, kernel_size, sigma):
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.K = None
+
+    def get_kernel(self, dtype, device):
+        if self.K is None or self.K.dtype != dtype or self.K.device != device:
+            ksize_half = (self.kernel_size - 1) * 0.5
+            x = torch.linspace(-ksize_half, ksize_half, steps=self.kernel_size, dtype=dtype, device=device)
+            pdf = torch.exp(-0.5 * (x / self.sigma).pow(2))
+            k1d = pdf / pdf.sum()
+            self.K = torch.mm(k1d[:, None], k1d[None, :])
+        return self.K
+
+    def forward(self, img):
+        K = self.get_kernel(img.dtype, img.device)
+        pad = self.kernel_size // 2
+        img = Func.pad(img, (pad, pad, pad, pad), mode='reflect')
+        return Func.conv2d(img, K.expand(img.shape[-3], 1, -1, -1), groups=img.shape[-3])
+
+
 class config_files:
     # fvvdp_config_dir = None
     
@@ -44,6 +44,21 @@ class video_source:
     def get_reference_frame( self, frame, device, colorspace ) -> Tensor:
         pass
 
+    # Get count test frames, starting from the frame start, as a single [1,C,count,H,W] tensor (the same as 
+    # concatenating the results of get_test_frame). The video sources that can read or convert several frames at once
+    # override these methods, the default implementation reads the frames one by one. 
+    def get_test_frames( self, start, count, device, colorspace ) -> Tensor:
+        return torch.cat( [self.get_test_frame(start+ff, device, colorspace) for ff in range(count)], dim=2 )
+
+    def get_reference_frames( self, start, count, device, colorspace ) -> Tensor:
+        return torch.cat( [self.get_reference_frame(start+ff, device, colorspace) for ff in range(count)], dim=2 )
+
+    # Return an object (hashable) that identifies the reference content, including the range of frames and any resizing. 
+    # It is used to cache the reference features when the same reference is compared with many test videos. 
+    # None means that the reference cannot be identified and should not be cached. 
+    def get_reference_id(self):
+        return None
+
     # Check whether pixel values are valid, display warning if it is not the case
     def check_if_valid( self, frame, target_colorspace ):
 
@@ -73,6 +88,47 @@ class video_source:
 
 
 
+"""
+A view of the frames first .. first+count-1 of another video source. Used to evaluate only selected segments 
+of a video (see pycvvdp.temporal_sampling). Note that the video files can be read only forward, so the segments 
+must be requested in the increasing order of frames.
+"""
+class video_source_segment( video_source ):
+
+    def __init__( self, vid_source, first, count ):
+        self.vid_source = vid_source
+        self.first = first
+        self.count = count
+
+    def get_video_size(self):
+        height, width, _ = self.vid_source.get_video_size()
+        return (height, width, self.count)
+
+    def get_frames_per_second(self):
+        return self.vid_source.get_frames_per_second()
+
+    def get_test_frame( self, frame, device, colorspace ) -> Tensor:
+        return self.vid_source.get_test_frame( self.first+frame, device, colorspace )
+
+    def get_reference_frame( self, frame, device, colorspace ) -> Tensor:
+        return self.vid_source.get_reference_frame( self.first+frame, device, colorspace )
+
+    def get_test_frames( self, start, count, device, colorspace ) -> Tensor:
+        return self.vid_source.get_test_frames( self.first+start, count, device, colorspace )
+
+    def get_reference_frames( self, start, count, device, colorspace ) -> Tensor:
+        return self.vid_source.get_reference_frames( self.first+start, count, device, colorspace )
+
+    def get_reference_id(self):
+        ref_id = self.vid_source.get_reference_id()
+        return None if ref_id is None else (ref_id, self.first, self.count)
+
+# Identify a file by its absolute path, size and modification time (used as a key for caching)
+def file_id(fname):
+    st = os.stat(fname)
+    return (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+
+
 """
 Function for changing the order of dimensions, for example, from "WHC" (width, height, colour) to "BCHW" (batch, colour, height, width)
 If a dimension is missing in in_dims, it will be added as a singleton dimension
@@ -125,34 +181,26 @@ def reshuffle_dims( T: Tensor, in_dims: str, out_dims: str ) -> Tensor:
 def numpy2torch_frame(np_array, frame, device, dim_order="HWC" ):
 
     if isinstance( np_array, np.ndarray ):
-        if np_array.dtype == np.uint16:
-            # Torch does not natively support uint16. A workaround is to pack uint16 values into int16.
-            # This will be efficiently transferred and unpacked on the GPU.
-            # logging.info('Test has datatype uint16, packing into int16')
-            np_array = np_array.astype(np.int16)
-        torch_array = torch.tensor(np_array)
+        torch_array = utils.np_as_tensor(np_array) # No copy, uint16 is viewed as int16
     else:
         torch_array = np_array # If it is already a tensor
 
     from_array = reshuffle_dims( torch_array, in_dims=dim_order, out_dims="BCFHW" )
+    return unpack_frames(from_array, frame, 1, device)
 
+# Return the frames start .. start+count-1 of a BCFHW tensor as float32 on the device. Integer values are divided by 
+# the maximum value of the type.
+def unpack_frames(from_array, start, count, device):
+    frame_t = from_array[:,:,start:(start+count),:,:]
     if from_array.dtype is torch.float32:
-        frame = from_array[:,:,frame:(frame+1),:,:].to(device)
+        frame = frame_t.to(device)
     elif from_array.dtype is torch.float16:
-        frame = from_array[:,:,frame:(frame+1),:,:].to(device=device, dtype=torch.float32)
+        frame = frame_t.to(device=device, dtype=torch.float32)
     elif from_array.dtype is torch.int16:
-        # Use int16 to losslessly pack uint16 values
-        # Unpack from int16 by bit masking as described in this thread:
-        # https://stackoverflow.com/a/20766900
-        # logging.info('Found int16 datatype, unpack into uint16')
-        max_value = 2**16 - 1
-        # Cast to int32 to store values >= 2**15
-        frame_int32 = from_array[:,:,frame:(frame+1),:,:].to(device).to(torch.int32)
-        frame_uint16 = frame_int32 & max_value
-        # Finally convert to float in the range [0,1]
-        frame = frame_uint16.to(torch.float32) / max_value
+        # int16 losslessly packs uint16 values, see utils.np_as_tensor
+        frame = utils.unpack_to_fp32(frame_t, device, 2**16 - 1)
     elif from_array.dtype is torch.uint8:
-        frame = from_array[:,:,frame:(frame+1),:,:].to(device).to(torch.float32)/255
+        frame = utils.unpack_to_fp32(frame_t, device, 2**8 - 1)
     else:
         raise RuntimeError( f"Only uint8, uint16 and float32 is currently supported. {from_array.dtype} encountered." )
     return frame
@@ -210,21 +258,11 @@ class video_source_array( video_source_dm ):
         if len(dim_order) != len(test_video.shape):
             raise RuntimeError( 'Input tensor much have exactly as many dimensions as there are characters in the "dims" parameter' )
 
-        # Convert numpy arrays to tensors. Note that we do not upload to device or change dtype at this point (to save GPU memory)
+        # Convert numpy arrays to tensors (without copying). Note that we do not upload to device or change dtype at this point (to save GPU memory)
         if isinstance( test_video, np.ndarray ):
-            if test_video.dtype == np.uint16:
-                # Torch does not natively support uint16. A workaround is to pack uint16 values into int16.
-                # This will be efficiently transferred and unpacked on the GPU.
-                # logging.info('Test has datatype uint16, packing into int16')
-                test_video = test_video.astype(np.int16)
-            test_video = torch.tensor(test_video)
+            test_video = utils.np_as_tensor(test_video)
         if isinstance( reference_video, np.ndarray ):
-            if reference_video.dtype == np.uint16:
-                # Torch does not natively support uint16. A workaround is to pack uint16 values into int16.
-                # This will be efficiently transferred and unpacked on the GPU.
-                # logging.info('Reference has datatype uint16, packing into int16')
-                reference_video = reference_video.astype(np.int16)
-            reference_video = torch.tensor(reference_video)
+            reference_video = utils.np_as_tensor(reference_video)
 
         # Change the order of dimension to match BFCHW - batch, frame, colour, height, width
         test_video = reshuffle_dims( test_video, in_dims=dim_order, out_dims="BCFHW" )
@@ -270,29 +308,17 @@ class video_source_array( video_source_dm ):
     def get_reference_frame( self, frame, device, colorspace ):
         return self._get_frame(self.reference_video, frame, device, colorspace )
 
+    def get_test_frames( self, start, count, device, colorspace ):
+        return self._get_frames(self.test_video, start, count, device, colorspace )
+
+    def get_reference_frames( self, start, count, device, colorspace ):
+        return self._get_frames(self.reference_video, start, count, device, colorspace )
+
     def _get_frame( self, from_array, frame, device, colorspace ):        
-        # Determine the maximum value of the data type storing the
-        # image/video
-
-        if from_array.dtype is torch.float32:
-            frame = from_array[:,:,frame:(frame+1),:,:].to(device)
-        elif from_array.dtype is torch.float16:
-            frame = from_array[:,:,frame:(frame+1),:,:].to(device=device, dtype=torch.float32)
-        elif from_array.dtype is torch.int16:
-            # Use int16 to losslessly pack uint16 values
-            # Unpack from int16 by bit masking as described in this thread:
-            # https://stackoverflow.com/a/20766900
-            # logging.info('Found int16 datatype, unpack into uint16')
-            max_value = 2**16 - 1
-            # Cast to int32 to store values >= 2**15
-            frame_int32 = from_array[:,:,frame:(frame+1),:,:].to(device).to(torch.int32)
-            frame_uint16 = frame_int32 & max_value
-            # Finally convert to float in the range [0,1]
-            frame = frame_uint16.to(torch.float32) / max_value
-        elif from_array.dtype is torch.uint8:
-            frame = from_array[:,:,frame:(frame+1),:,:].to(device).to(torch.float32)/255
-        else:
-            raise RuntimeError( f"Only uint8, uint16 and float32 is currently supported. {from_array.dtype} encountered." )
+        return self._get_frames(from_array, frame, 1, device, colorspace)
+
+    def _get_frames( self, from_array, start, count, device, colorspace ):        
+        frame = unpack_frames(from_array, start, count, device)
 
         I = self.apply_dm_and_colour_transform(frame, colorspace)
         
@@ -331,15 +357,12 @@ class video_source_packed_array( video_source_dm ):
         if self.yuv:
             y_pixels = h*w
             chroma_ss = str(chroma_ss)
-            uv_shape = (h//2, w//2) if chroma_ss == '420' else (h, w)
+            uv_shape = utils.get_chroma_shape(h, w, chroma_ss)
             uv_pixels = uv_shape[0]*uv_shape[1]
             frame_pixels = y_pixels + 2*uv_pixels
 
-            Y = from_array[7 + idx*frame_pixels                        : 7 + idx*frame_pixels + y_pixels]
-            u = from_array[7 + idx*frame_pixels + y_pixels             : 7 + idx*frame_pixels + y_pixels + uv_pixels]
-            v = from_array[7 + idx*frame_pixels + y_pixels + uv_pixels : 7 + idx*frame_pixels + y_pixels + 2*uv_pixels]
-
-            Yuv_float = utils.fixed2float_upscale(Y, u, v, (h, w), uv_shape, bit_depth, chroma_ss, device)
+            frame = utils.unpack_to_fp32(from_array[7 + idx*frame_pixels : 7 + (idx+1)*frame_pixels], device)
+            Yuv_float = utils.fixed2float_yuv(frame[None], h, w, bit_depth, chroma_ss)[0]
             if self.color_space=='bt2020nc':
                 # display-encoded (PQ) BT.2020 RGB image
                 ycbcr2rgb = torch.tensor([[1, 0, 1.47460],
@@ -362,16 +385,11 @@ class video_source_packed_array( video_source_dm ):
             frame = RGB.unsqueeze(2)
         else:
             frame_pixels = resize_h*resize_w*3
-            if from_array.dtype == np.uint8:
-                frame = torch.tensor(from_array[7 + idx*frame_pixels : 7 + (idx+1)*frame_pixels], dtype=torch.uint8)
-                frame = frame.to(device).to(torch.float32)
-                max_value = 2**8 - 1
-            elif from_array.dtype == np.uint16:
-                frame = utils.npuint16_to_torchfp32(from_array[7 + idx*frame_pixels : 7 + (idx+1)*frame_pixels], device)
-                max_value = 2**16 - 1
+            max_value = 2**8 - 1 if from_array.dtype == np.uint8 else 2**16 - 1
+            frame = utils.unpack_to_fp32(from_array[7 + idx*frame_pixels : 7 + (idx+1)*frame_pixels], device, max_value)
 
             # fvvdp required dims -> (B,C,N,H,W)
-            frame = frame.reshape(resize_h, resize_w, 3) / max_value
+            frame = frame.reshape(resize_h, resize_w, 3)
             frame = frame.permute(2,0,1).reshape(1, -1, 1, resize_h, resize_w)
 
         L = self.dm_photometry.forward( frame )
@@ -1,35 +1,26 @@
 # Classes for reading images or videos from files so that they can be passed to FovVideoVDP frame-by-frame
 
-from asyncio.log import logger
-from functools import cache
 import os
-import imageio.v2 as io
 import numpy as np
 from torch.functional import Tensor
 import torch
-import ffmpeg
 import re
-
-import scipy.io as sio
+import threading
+import queue
 
 import logging
-from video_source import *
+from pycvvdp.video_source import *
+from pycvvdp.video_source_yuv import video_source_yuv_file
+import pycvvdp.utils as utils
+
+# imageio, ffmpeg-python, scipy.io and pyexr are imported on the first use to make `import pycvvdp` faster
+
+logger = logging.getLogger(__name__)
 
 # for debugging only
 # from gfxdisp.pfs import pfs
 # from gfxdisp.pfs.pfs_torch import pfs_torch
 
-try:
-    # This may fail if OpenEXR is not installed. To install,
-    # ubuntu: sudo apt install libopenexr-dev
-    # mac: brew install openexr
-    import pyexr
-    pyexr_imported = True
-except ImportError as e:
-    # Imageio's imread is unreliable for OpenEXR images
-    # See https://github.com/imageio/imageio/issues/517
-    pyexr_imported = False
-
 # Load an image (SDR or HDR) into Numpy array
 def load_image_as_array(imgfile):
     if not os.path.isfile(imgfile):
@@ -39,13 +30,21 @@ def load_image_as_array(imgfile):
 
     ext = os.path.splitext(imgfile)[1].lower()
     if ext == '.exr':
-        if not pyexr_imported:
+        try:
+            # This may fail if OpenEXR is not installed. To install,
+            # ubuntu: sudo apt install libopenexr-dev
+            # mac: brew install openexr
+            import pyexr
+        except ImportError as e:
+            # Imageio's imread is unreliable for OpenEXR images
+            # See https://github.com/imageio/imageio/issues/517
             logging.error( "pyexr is needed to read OpenEXR files. Please follow the instriction in README.md to install it." )
             raise RuntimeError( "pyexr missing" )
         precisions = pyexr.open(imgfile).precisions
         assert precisions.count(precisions[0]) == len(precisions), 'All channels must have same precision'
         img = pyexr.read(imgfile, precision=precisions[0])
     else:
+        import imageio.v2 as io
         # 16-bit PNG not supported by default
         lib = 'PNG-FI' if ext == '.png' else None
         try:
@@ -70,6 +69,7 @@ def load_image_as_array(imgfile):
 class video_reader:
 
     def __init__(self, vidfile, frames=-1, resize_fn=None, resize_height=-1, resize_width=-1, verbose=False):
+        import ffmpeg
         try:
             if vidfile.lower().endswith('.y4m'):
                 probe = ffmpeg.probe(vidfile, count_frames=None)
@@ -88,6 +88,7 @@ class video_reader:
         self.color_space = video_stream['color_space'] if ('color_space' in video_stream) else 'unknown'
         self.color_transfer = video_stream['color_transfer'] if ('color_transfer' in video_stream) else 'unknown'
         self.in_pix_fmt = video_stream['pix_fmt']
+        self.chroma_location = video_stream['chroma_location'] if ('chroma_location' in video_stream) else 'unspecified'
         if 'nb_read_frames' in video_stream:
             num_frames = int(video_stream['nb_read_frames'])
         else:
@@ -108,6 +109,7 @@ class video_reader:
         self.curr_frame = -1
 
     def _setup_ffmpeg(self, vidfile, resize_fn, resize_height, resize_width, verbose):
+        import ffmpeg
         if any(f'p{bit_depth}' in self.in_pix_fmt for bit_depth in [10, 12, 14, 16]): # >8 bit
             out_pix_fmt = 'rgb48le'
             self.bpp = 6 # bytes per pixel
@@ -139,31 +141,34 @@ class video_reader:
         self.curr_frame += 1
         return in_frame       
 
+    # Read the next frame into a preallocated buffer (a writable array or memoryview of frame_bytes bytes), 
+    # avoiding a new allocation for each frame. Returns False if there are no more frames.
+    def read_frame_into(self, buf):
+        if self.curr_frame == self.frames:
+            return False
+        buf = memoryview(buf).cast('B')
+        bytes_read = 0
+        while bytes_read < self.frame_bytes:
+            n = self.process.stdout.readinto(buf[bytes_read:])
+            if not n:
+                return False
+            bytes_read += n
+        self.curr_frame += 1
+        return True
+
+    # The frame can be a numpy array, or a tensor from frame_prefetcher (uint16 values are stored as int16)
     def unpack(self, frame_np, device):
+        return self.unpack_batch(frame_np[None], device)[0]
+
+    # Unpack a batch of frames, x is a [frames, frame_pixels] array or tensor. Returns a [frames, height, width, 3] tensor.
+    def unpack_batch(self, x, device):
         if self.dtype == np.uint8:
-            assert frame_np.dtype == np.uint8
-            frame_t_hwc = torch.tensor(frame_np, dtype=torch.uint8)
             max_value = 2**8 - 1
-            frame_fp32 = frame_t_hwc.to(device).to(torch.float32)
         elif self.dtype == np.uint16:
             max_value = 2**16 - 1
-            frame_fp32 = self._npuint16_to_torchfp32(frame_np, device)
-
-        RGB = frame_fp32.reshape(self.height, self.width, 3) / max_value
+        RGB = utils.unpack_to_fp32(x, device, max_value).reshape(-1, self.height, self.width, 3)
         return RGB
 
-    # Torch does not natively support uint16. A workaround is to pack uint16 values into int16.
-    # This will be efficiently transferred and unpacked on the GPU.
-    # logging.info('Test has datatype uint16, packing into int16')
-    def _npuint16_to_torchfp32(self, np_x_uint16, device):
-        max_value = 2**16 - 1
-        assert np_x_uint16.dtype == np.uint16
-        np_x_int16 = torch.tensor(np_x_uint16.astype(np.int16), dtype=torch.int16)
-        torch_x_int32 = np_x_int16.to(device).to(torch.int32)
-        torch_x_uint16 = torch_x_int32 & max_value
-        torch_x_fp32 = torch_x_uint16.to(torch.float32)
-        return torch_x_fp32
-
     # Delete or close if program was interrupted
     def __del__(self):
         self.close()
@@ -188,25 +193,16 @@ class video_reader_yuv_pytorch(video_reader):
     def __init__(self, vidfile, frames=-1, resize_fn=None, resize_height=-1, resize_width=-1, verbose=False):
         super().__init__(vidfile, frames, resize_fn, resize_height, resize_width, verbose)
 
-        y_channel_pixels = int(self.width*self.height)
-        self.y_pixels = y_channel_pixels
+        self.y_pixels = int(self.width*self.height)
         self.y_shape = (self.height, self.width)
-
-        if self.chroma_ss == "444":
-            self.frame_bytes = y_channel_pixels*3
-            self.uv_pixels = y_channel_pixels
-            self.uv_shape = self.y_shape
-        elif self.chroma_ss == "420":
-            self.frame_bytes = y_channel_pixels*3//2
-            self.uv_pixels = int(y_channel_pixels/4)
-            self.uv_shape = (int(self.y_shape[0]/2), int(self.y_shape[1]/2))
-        else:
-            raise RuntimeError("Unrecognized chroma subsampling.")
-
+        self.uv_shape = utils.get_chroma_shape(self.height, self.width, self.chroma_ss)
+        self.uv_pixels = self.uv_shape[0]*self.uv_shape[1]
+        self.frame_bytes = self.y_pixels + 2*self.uv_pixels
         if self.bit_depth > 8:
             self.frame_bytes *= 2
 
     def _setup_ffmpeg(self, vidfile, resize_fn, resize_height, resize_width, verbose):
+        import ffmpeg
 
         # if not any(f'p{bit_depth}' in self.in_pix_fmt for bit_depth in [10, 12, 14, 16]): # 8 bit
         #     raise RuntimeError('GPU decoding not implemented for bit-depth 8')
@@ -216,8 +212,10 @@ class video_reader_yuv_pytorch(video_reader):
 
 
         self.chroma_ss = self.in_pix_fmt[3:6]
-        if not self.chroma_ss in ['444', '420']: # TODO: implement and test 422
+        if not self.chroma_ss in utils.chroma_subsampling:
             raise RuntimeError(f"Unrecognized chroma subsampling {self.chroma_ss}")
+        # Unspecified siting is treated as 'center', the same as bilinear interpolation
+        self.chroma_siting = self.chroma_location if self.chroma_location in utils.chroma_siting else 'center'
 
         if self.bit_depth>8: 
             self.dtype = np.uint16
@@ -238,11 +236,11 @@ class video_reader_yuv_pytorch(video_reader):
         self.process = ffmpeg.run_async(stream, pipe_stdout=True)
 
     def unpack(self, x, device):
-        Y = x[:self.y_pixels]
-        u = x[self.y_pixels:self.y_pixels+self.uv_pixels]
-        v = x[self.y_pixels+self.uv_pixels:]
+        return self.unpack_batch(x[None], device)[0]
 
-        Yuv_float = self._fixed2float_upscale(Y, u, v, device)
+    # Unpack a batch of frames, x is a [frames, frame_pixels] array or tensor. Returns a [frames, height, width, 3] tensor.
+    def unpack_batch(self, x, device):
+        Yuv_float = utils.fixed2float_yuv(utils.unpack_to_fp32(x, device), self.height, self.width, self.bit_depth, self.chroma_ss, self.chroma_siting)
 
         if self.color_space=='bt2020nc':
             # display-encoded (PQ) BT.2020 RGB image
@@ -258,55 +256,128 @@ class video_reader_yuv_pytorch(video_reader):
         RGB = Yuv_float @ ycbcr2rgb.transpose(1, 0)
         if (hasattr(self, 'resize_fn')) and (self.resize_fn is not None) \
             and (self.height != self.resize_height or self.width != self.resize_width):
-            RGB = torch.nn.functional.interpolate(RGB.permute(2,0,1)[None],
+            RGB = torch.nn.functional.interpolate(RGB.permute(0,3,1,2),
                                                   size=(self.resize_height, self.resize_width),
                                                   mode=self.resize_fn)
-            RGB = RGB.squeeze().permute(1,2,0)
+            RGB = RGB.permute(0,2,3,1)
 
         return RGB.clip(0, 1)
 
-    def _np_to_torchfp32(self, X, device):
-        if X.dtype == np.uint8:
-            return torch.tensor(X, dtype=torch.uint8).to(device).to(torch.float32)
-        elif X.dtype == np.uint16:
-            return self._npuint16_to_torchfp32(X, device)
 
+# Runs in a background thread of frame_prefetcher. It does not hold a reference to the frame_prefetcher so that
+# the prefetcher can be garbage-collected (and stopped) when the video source is deleted.
+def _prefetch_frames(vid_reader, device, frame_q, free_q, stop_event, stream):
+
+    def put(q, item):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        while not stop_event.is_set():
+            try:
+                buf, copy_done = free_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if not copy_done is None:
+                copy_done.synchronize() # Do not overwrite the buffer before it has been copied to the GPU
+
+            if not vid_reader.read_frame_into(buf.numpy()):
+                put(frame_q, None) # No more frames
+                return
+
+            if stream is None:
+                frame_t = buf
+                copy_done = None
+            else:
+                with torch.cuda.stream(stream):
+                    frame_t = buf.to(device, non_blocking=True)
+                    copy_done = torch.cuda.Event()
+                    copy_done.record(stream)
+
+            if not put(frame_q, (frame_t, buf, copy_done)):
+                return
+    except Exception as e:
+        put(frame_q, e)
 
-    def _fixed2float_upscale(self, Y, u, v, device):
-        offset = 16/219
-        weight = 1/(2**(self.bit_depth-8)*219)
-        Yuv = torch.empty(self.height, self.width, 3, device=device)
 
-        Y = self._np_to_torchfp32(Y, device)
-        Yuv[..., 0] = torch.clip(weight*Y - offset, 0, 1).reshape(self.height, self.width)
+'''
+Reads frames of a video_reader in a background thread so that decoding (ffmpeg) overlaps with the metric computation. 
+Up to queue_size frames are kept in a bounded queue of (pinned, if the device is a GPU) host buffers. On the GPU, the
+buffers are copied to the device asynchronously on a side stream. get_frame() blocks only when the queue is empty. 
 
-        offset = 128/224
-        weight = 1/(2**(self.bit_depth-8)*224)
+The frames are returned as tensors (uint16 stored as int16) that can be passed to the unpack() method of the reader. 
+release() must be called once the frame is no longer needed so that its buffer can be reused.
+'''
+class frame_prefetcher:
 
-        uv = np.stack((u, v))
-        uv = self._np_to_torchfp32(uv, device)
-        uv = torch.clip(weight*uv - offset, -0.5, 0.5).reshape(1, 2, self.uv_shape[0], self.uv_shape[1])
+    def __init__(self, vid_reader, device, queue_size=4):
+        self.vid_reader = vid_reader
+        self.device = device
+        self.curr_frame = -1
+        self.frame_q = queue.Queue(maxsize=queue_size)
+        self.free_q = queue.Queue()
 
-        if self.chroma_ss=="420":
-            # TODO: Replace with a proper filter.
-            uv_upscaled = torch.nn.functional.interpolate(uv, scale_factor=2, mode='bilinear')
-        else:
-            uv_upscaled = uv
+        use_cuda = device.type == 'cuda'
+        self.stream = torch.cuda.Stream(device=device) if use_cuda else None
+        dtype = torch.int16 if vid_reader.dtype == np.uint16 else torch.uint8
+        N = vid_reader.frame_bytes // (2 if dtype == torch.int16 else 1)
+        for kk in range(queue_size+1): # One more buffer for the frame that is currently read
+            buf = torch.empty((N,), dtype=dtype, pin_memory=use_cuda)
+            self.free_q.put((buf, None))
 
-        Yuv[...,1:] = uv_upscaled.squeeze().permute(1,2,0)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=_prefetch_frames, args=(vid_reader, device, self.frame_q, self.free_q, self.stop_event, self.stream), daemon=True)
+        self.thread.start()
 
-        return Yuv
+    def get_frame(self):
+        item = self.frame_q.get()
+        if item is None:
+            self.frame_q.put(None) # So that the next call also returns None
+            return None
+        if isinstance(item, Exception):
+            raise item
+        frame_t, buf, copy_done = item
+        if not copy_done is None:
+            cur_stream = torch.cuda.current_stream(self.device)
+            cur_stream.wait_event(copy_done)
+            frame_t.record_stream(cur_stream)
+        self.curr_frame += 1
+        self.last_buf = (buf, copy_done)
+        return frame_t
+
+    # Return the buffer of the last frame to the pool
+    def release(self):
+        if hasattr(self, 'last_buf'):
+            self.free_q.put(self.last_buf)
+            del self.last_buf
+
+    def close(self):
+        self.stop_event.set()
+
+    def __del__(self):
+        self.close()
 
 
 '''
 Use ffmpeg to read video frames, one by one.
+
+prefetch_frames - if >0, frames are decoded in a background thread and up to prefetch_frames frames are queued (see frame_prefetcher)
 '''
 class video_source_video_file(video_source_dm):
 
-    def __init__( self, test_fname, reference_fname, display_photometry='sdr_4k_30', config_paths=[], fps=None, frames=-1, full_screen_resize=None, resize_resolution=None, ffmpeg_cc=False, verbose=False ):
+    def __init__( self, test_fname, reference_fname, display_photometry='sdr_4k_30', config_paths=[], fps=None, frames=-1, full_screen_resize=None, resize_resolution=None, ffmpeg_cc=False, prefetch_frames=0, verbose=False ):
+
+        self.prefetch_frames = prefetch_frames
+        self.prefetchers = {} # video_reader -> frame_prefetcher, created on the first frame (when the device is known)
 
         fs_width = -1 if full_screen_resize is None else resize_resolution[0]
         fs_height = -1 if full_screen_resize is None else resize_resolution[1]
+        self.reference_id = file_id(reference_fname) + (frames, full_screen_resize, fs_width, fs_height, ffmpeg_cc)
         self.reader = video_reader if ffmpeg_cc else video_reader_yuv_pytorch
         self.reference_vidr = self.reader(reference_fname, frames, resize_fn=full_screen_resize, resize_width=fs_width, resize_height=fs_height, verbose=verbose)
         self.test_vidr = self.reader(test_fname, frames, resize_fn=full_screen_resize, resize_width=fs_width, resize_height=fs_height, verbose=verbose)
@@ -359,6 +430,9 @@ class video_source_video_file(video_source_dm):
     # Return the frame rate of the video
     def get_frames_per_second(self) -> int:
         return self.fps
+
+    def get_reference_id(self):
+        return self.reference_id
     
     # Get a test (reference) video frames as a single-precision luminance map
     # scaled in absolute inits of cd/m^2. 'frame' is the frame index,
@@ -377,21 +451,65 @@ class video_source_video_file(video_source_dm):
         # self.reference_test_frame = (frame,L)
         return L
 
+    def get_test_frames( self, start, count, device, colorspace="Y" ) -> Tensor:
+        return self._get_frames( self.test_vidr, start, count, device, colorspace )
+
+    def get_reference_frames( self, start, count, device, colorspace="Y" ) -> Tensor:
+        return self._get_frames( self.reference_vidr, start, count, device, colorspace )
+
     def _get_frame( self, vid_reader, frame, device, colorspace ):        
+        return self._get_frames( vid_reader, frame, 1, device, colorspace )
+
+    # Read count frames and convert them as a single batch (one transfer to the device and one pass of the display model)
+    def _get_frames( self, vid_reader, start, count, device, colorspace ):
 
-        if frame != (vid_reader.curr_frame+1):
+        if self.prefetch_frames > 0:
+            if not vid_reader in self.prefetchers:
+                self.prefetchers[vid_reader] = frame_prefetcher(vid_reader, torch.device(device), self.prefetch_frames)
+            frame_src = self.prefetchers[vid_reader]
+        else:
+            frame_src = vid_reader
+
+        if start < (frame_src.curr_frame+1):
             raise RuntimeError( 'Video can be currently only read frame-by-frame. Random access not implemented.' )
 
-        frame_np = vid_reader.get_frame()
+        while start > (frame_src.curr_frame+1): # Skip frames (when only some segments of the video are evaluated)
+            if frame_src.get_frame() is None:
+                raise RuntimeError( 'Could not read frame {}'.format(frame_src.curr_frame+1) )
+            if self.prefetch_frames > 0:
+                frame_src.release()
+
+        frames = None
+        for ff in range(count):
+            frame_np = frame_src.get_frame()
 
-        if frame_np is None:
-            raise RuntimeError( 'Could not read frame {}'.format(frame) )
+            if frame_np is None:
+                raise RuntimeError( 'Could not read frame {}'.format(start+ff) )
 
-        return self._prepare_frame(frame_np, device, vid_reader.unpack, colorspace)
+            if count == 1:
+                frames = frame_np[None] # A single frame does not need to be copied
+            else:
+                if frames is None:
+                    if torch.is_tensor(frame_np):
+                        frames = torch.empty((count,)+frame_np.shape, dtype=frame_np.dtype, device=frame_np.device)
+                    else:
+                        frames = np.empty((count,)+frame_np.shape, dtype=frame_np.dtype)
+                frames[ff] = frame_np
+                if self.prefetch_frames > 0:
+                    frame_src.release()
+
+        I = self._prepare_frames(frames, device, vid_reader.unpack_batch, colorspace)
+        if self.prefetch_frames > 0 and count == 1:
+            frame_src.release()
+        return I
+
+    def __del__(self):
+        for pf in self.prefetchers.values():
+            pf.close()
 
-    def _prepare_frame( self, frame_np, device, unpack_fn, colorspace="Y" ):
-        frame_t_hwc = unpack_fn(frame_np, device)
-        frame_t = reshuffle_dims( frame_t_hwc, in_dims='HWC', out_dims="BCFHW" )
+    def _prepare_frames( self, frames_np, device, unpack_fn, colorspace="Y" ):
+        frame_t_fhwc = unpack_fn(frames_np, device)
+        frame_t = reshuffle_dims( frame_t_fhwc, in_dims='FHWC', out_dims="BCFHW" )
 
         I = self.apply_dm_and_colour_transform(frame_t, colorspace)
 
@@ -455,6 +573,11 @@ class video_source_image_frames(video_source_dm):
         self.img_cache = load_image_as_array(ff_name)
         self.video_size = (self.img_cache.shape[0], self.img_cache.shape[1], self.N)
 
+        if fps==0:
+            self.reference_id = file_id(self.reference_fname)
+        else:
+            self.reference_id = (self.reference_fname,) + tuple(file_id(self.reference_fname.format(nn)) for nn in self.frame_range)
+
     def convert_c2python_format_str( self, str ):
         if not hasattr( self, 'format_re' ):
             self.format_re = re.compile( r"%(\d)*d" )
@@ -478,6 +601,9 @@ class video_source_image_frames(video_source_dm):
     def get_video_size(self):
         return self.video_size
 
+    def get_reference_id(self):
+        return self.reference_id
+
     def get_test_frame( self, frame, device, colorspace="Y" ) -> Tensor:
         if frame==0 and not self.img_cache is None: # Use cache to avoid loading the same image twice
             I = self._get_frame( self.test_fname, frame, device, colorspace, self.img_cache )
@@ -523,7 +649,7 @@ The same functionality as to fvvdp_video_source_video_file, but preloads all the
 '''
 class video_source_video_file_preload(video_source_video_file):
     
-    def _get_frame( self, vid_reader, frame, device, colorspace ):        
+    def _get_frames( self, vid_reader, start, count, device, colorspace ):        
 
         if not hasattr( self, "frame_array_tst" ):
 
@@ -544,14 +670,18 @@ class video_source_video_file_preload(video_source_video_file):
 
 
         if vid_reader is self.test_vidr:
-            frame_np = self.frame_array_tst[frame]
+            frames_np = self.frame_array_tst[start:(start+count)]
         else:
-            frame_np = self.frame_array_ref[frame]
+            frames_np = self.frame_array_ref[start:(start+count)]
 
-        if frame_np is None:
-            raise RuntimeError( 'Could not read frame {}'.format(frame) )
+        if len(frames_np) < count:
+            raise RuntimeError( 'Could not read frame {}'.format(start+len(frames_np)) )
+        for ff, frame_np in enumerate(frames_np):
+            if frame_np is None:
+                raise RuntimeError( 'Could not read frame {}'.format(start+ff) )
 
-        return self._prepare_frame(frame_np, device, vid_reader.unpack, colorspace)
+        frames_np = frames_np[0][None] if count == 1 else np.stack(frames_np)
+        return self._prepare_frames(frames_np, device, vid_reader.unpack_batch, colorspace)
 
 
 '''
@@ -569,6 +699,7 @@ class video_source_matlab( video_source_array ):
         raise RuntimeError( 'Cannot find image or video data in the .mat file' )
 
     def __init__( self, test_fname, reference_fname, fps=None, display_photometry='sdr_4k_30', config_paths=[] ):
+        import scipy.io as sio
         test_mat = sio.loadmat(test_fname)
         ref_mat = sio.loadmat(reference_fname)
 
@@ -607,7 +738,7 @@ Recognize whether the file is an image of video and wraps an appropriate video_s
 class video_source_file(video_source):
 
     # fps==None - auto-detect, fps==0 - image, video otherwise
-    def __init__( self, test_fname, reference_fname, display_photometry='sdr_4k_30', config_paths=[], frames=-1, frame_range=None, fps=None, full_screen_resize=None, resize_resolution=None, preload=False, ffmpeg_cc=False, verbose=False ):
+    def __init__( self, test_fname, reference_fname, display_photometry='sdr_4k_30', config_paths=[], frames=-1, frame_range=None, fps=None, full_screen_resize=None, resize_resolution=None, preload=False, ffmpeg_cc=False, prefetch_frames=0, verbose=False ):
         # these extensions switch mode to images instead
         image_extensions = [".png", ".jpg", ".gif", ".bmp", ".jpeg", ".ppm", ".tiff", ".tif", ".dds", ".exr", ".hdr"]
 
@@ -640,6 +771,10 @@ class video_source_file(video_source):
             #     if self.vs.dm_photometry.EOTF == "linear":
             #         logging.warning('A display model with linear colour space should not be used with display-encoded SDR images.')
 
+        elif extension == '.yuv':
+            # Raw .yuv files are memory-mapped, they allow random access and do not need preloading
+            assert os.path.splitext(reference_fname)[1].lower() == '.yuv', 'Test is a raw .yuv file, but reference is not'
+            self.vs = video_source_yuv_file(test_fname, reference_fname, display_photometry=display_photometry, config_paths=config_paths, frames=frames, frame_range=frame_range, fps=fps, full_screen_resize=full_screen_resize, resize_resolution=resize_resolution, verbose=verbose)
         else:
             assert os.path.splitext(reference_fname)[1].lower() not in image_extensions, 'Test is a video, but reference is an image'
             vs_class = video_source_video_file_preload if preload else video_source_video_file
@@ -651,6 +786,7 @@ class video_source_file(video_source):
                                 full_screen_resize=full_screen_resize, 
                                 resize_resolution=resize_resolution, 
                                 ffmpeg_cc=ffmpeg_cc, 
+                                prefetch_frames=0 if preload else prefetch_frames,
                                 verbose=verbose )
 
     # Return (height, width, frames) touple with the resolution and
@@ -661,6 +797,9 @@ class video_source_file(video_source):
     # Return the frame rate of the video
     def get_frames_per_second(self) -> int:
         return self.vs.get_frames_per_second()
+
+    def get_reference_id(self):
+        return self.vs.get_reference_id()
     
     # Get a pair of test and reference video frames as a single-precision luminance map
     # scaled in absolute inits of cd/m^2. 'frame' is the frame index,
@@ -670,3 +809,9 @@ class video_source_file(video_source):
 
     def get_reference_frame( self, frame, device, colorspace="Y" ) -> Tensor:
         return self.vs.get_reference_frame( frame, device, colorspace )
+
+    def get_test_frames( self, start, count, device, colorspace="Y" ) -> Tensor:
+        return self.vs.get_test_frames( start, count, device, colorspace )
+
+    def get_reference_frames( self, start, count, device, colorspace="Y" ) -> Tensor:
+        return self.vs.get_reference_frames( start, count, device, colorspace )
@@ -1,4 +1,5 @@
-from video_source import *
+from pycvvdp.video_source import *
+import pycvvdp.utils as utils
 import re
 
 import logging
@@ -31,7 +32,7 @@ def decode_video_props( fname ):
         if field.endswith("fps"):
             vprops["fps"] = float(field[:-3])
 
-        if field=="444" or field=="420":
+        if field in utils.chroma_subsampling:
             vprops["chroma_ss"]=field
 
         if field=="10" or field=="10b":
@@ -81,18 +82,11 @@ class YUVReader:
         self.chroma_ss = vprops["chroma_ss"]
 
         self.bit_depth = vprops["bit_depth"]
-        self.frame_bytes = int(self.width*self.height)
-        self.y_pixels = int(self.frame_bytes)
+        self.y_pixels = int(self.width*self.height)
         self.y_shape = (vprops["height"], vprops["width"])
-
-        if vprops["chroma_ss"]=="444":
-            self.frame_bytes *= 3
-            self.uv_pixels = self.y_pixels
-            self.uv_shape = self.y_shape
-        else: # Chroma sub-sampling
-            self.frame_bytes = self.frame_bytes*3/2
-            self.uv_pixels = int(self.y_pixels/4)
-            self.uv_shape = (int(self.y_shape[0]/2), int(self.y_shape[1]/2))
+        self.uv_shape = utils.get_chroma_shape(self.height, self.width, self.chroma_ss)
+        self.uv_pixels = self.uv_shape[0]*self.uv_shape[1]
+        self.frame_bytes = self.y_pixels + 2*self.uv_pixels
 
         self.frame_pixels = self.frame_bytes
         if vprops["bit_depth"]>8:
@@ -108,6 +102,8 @@ class YUVReader:
         self.frame_count = int(self.frame_count)
 
         self.mm = None
+        self.pinned_buf = None
+        self.copy_done = None
 
     def get_frame_count(self):
         return int(self.frame_count)
@@ -155,19 +151,12 @@ class YUVReader:
 
     # Return RGB PyTorch tensor
     def get_frame_rgb_tensor( self, frame_index, device ):
+        return self.get_frames_rgb_tensor( [frame_index], device )[0]
 
-        if frame_index<0 or frame_index>=self.frame_count:
-            raise RuntimeError( "The frame index is outside the range of available frames")
-
-        if self.mm is None: # Mem-map as needed
-            self.mm = np.memmap( self.file_name, self.dtype, mode="r")
-
-        offset = int(frame_index*self.frame_pixels)
-        Y = self.mm[offset:offset+self.y_pixels]
-        u = self.mm[offset+self.y_pixels:offset+self.y_pixels+self.uv_pixels]
-        v = self.mm[offset+self.y_pixels+self.uv_pixels:offset+self.y_pixels+2*self.uv_pixels]
+    # Return a [frames, height, width, 3] RGB PyTorch tensor with the frames of the given indices
+    def get_frames_rgb_tensor( self, frame_indices, device ):
 
-        Yuv_float = self._fixed2float_upscale(Y, u, v, device)
+        Yuv_float = utils.fixed2float_yuv(self.get_frames_tensor(frame_indices, device), self.height, self.width, self.bit_depth, self.chroma_ss)
 
         if self.color_space=='2020':
             # display-encoded (PQ) BT.2020 RGB image
@@ -183,49 +172,49 @@ class YUVReader:
         RGB = Yuv_float @ ycbcr2rgb.transpose(1, 0)
         return RGB.clip(0, 1)
 
+    def get_frame_tensor( self, frame_index, device ):
+        return self.get_frames_tensor( [frame_index], device )[0]
 
-    def _np_to_torchfp32(self, X, device):
-        if X.dtype == np.uint8:
-            return torch.tensor(X, dtype=torch.uint8).to(device).to(torch.float32)
-        elif X.dtype == np.uint16:
-            return self._npuint16_to_torchfp32(X, device)
-
-    # Torch does not natively support uint16. A workaround is to pack uint16 values into int16.
-    # This will be efficiently transferred and unpacked on the GPU.
-    # logging.info('Test has datatype uint16, packing into int16')
-    def _npuint16_to_torchfp32(self, np_x_uint16, device):
-        max_value = 2**16 - 1
-        assert np_x_uint16.dtype == np.uint16
-        np_x_int16 = torch.tensor(np_x_uint16.astype(np.int16), dtype=torch.int16)
-        torch_x_int32 = np_x_int16.to(device).to(torch.int32)
-        torch_x_uint16 = torch_x_int32 & max_value
-        torch_x_fp32 = torch_x_uint16.to(torch.float32)
-        return torch_x_fp32
-
-    def _fixed2float_upscale(self, Y, u, v, device):
-        offset = 16/219
-        weight = 1/(2**(self.bit_depth-8)*219)
-        Yuv = torch.empty(self.height, self.width, 3, device=device)
-
-        Y = self._np_to_torchfp32(Y, device)
-        Yuv[..., 0] = torch.clip(weight*Y - offset, 0, 1).reshape(self.height, self.width)
-
-        offset = 128/224
-        weight = 1/(2**(self.bit_depth-8)*224)
-
-        uv = np.stack((u, v))
-        uv = self._np_to_torchfp32(uv, device)
-        uv = torch.clip(weight*uv - offset, -0.5, 0.5).reshape(1, 2, self.uv_shape[0], self.uv_shape[1])
-
-        if self.chroma_ss=="420":
-            # TODO: Replace with a proper filter.
-            uv_upscaled = torch.nn.functional.interpolate(uv, scale_factor=2, mode='bilinear')
-        else:
-            uv_upscaled = uv
+    '''
+    Return the Y, u and v planes of the frames as a [frames, frame_pixels] float32 tensor on the device (the planes are 
+    in the order they are stored in the file). Consecutive frames are not copied on the host: the slice of the 
+    memory-mapped file is wrapped by torch.from_numpy (uint16 values are viewed as int16, as PyTorch does not support 
+    uint16). For CUDA, the frames are copied into a pinned buffer so that the transfer to the GPU is asynchronous. The 
+    int16 values are unpacked back to uint16 on the device.
+    '''
+    def get_frames_tensor( self, frame_indices, device ):
 
-        Yuv[...,1:] = uv_upscaled.squeeze().permute(1,2,0)
+        if min(frame_indices)<0 or max(frame_indices)>=self.frame_count:
+            raise RuntimeError( "The frame index is outside the range of available frames")
 
-        return Yuv
+        if self.mm is None: # Mem-map as needed
+            self.mm = np.memmap( self.file_name, self.dtype, mode="r")
+
+        frame_pixels = int(self.frame_pixels)
+        first = frame_indices[0]
+        if list(frame_indices) == list(range(first, first+len(frame_indices))):
+            frames_np = self.mm[(first*frame_pixels):((first+len(frame_indices))*frame_pixels)].reshape(len(frame_indices), frame_pixels)
+        else:
+            frames_np = np.stack( [self.mm[(ff*frame_pixels):((ff+1)*frame_pixels)] for ff in frame_indices] )
+        frames_t = utils.np_as_tensor(frames_np) # Shares the memory with the memory-mapped file
+
+        device = torch.device(device)
+        if device.type == 'cuda':
+            frames_t = self._to_cuda_pinned(frames_t, device)
+        return utils.unpack_to_fp32(frames_t, device)
+
+    # Copy the frame into the pinned buffer and start an asynchronous transfer to the GPU
+    def _to_cuda_pinned(self, frame_t, device):
+        if not self.copy_done is None:
+            self.copy_done.synchronize() # Wait until the previous frames have been transferred from the buffer
+        if self.pinned_buf is None or self.pinned_buf.numel() < frame_t.numel():
+            self.pinned_buf = torch.empty((frame_t.numel(),), dtype=frame_t.dtype, pin_memory=True)
+        buf = self.pinned_buf[:frame_t.numel()].view(frame_t.shape)
+        buf.copy_(frame_t)
+        frame_dev = buf.to(device, non_blocking=True)
+        self.copy_done = torch.cuda.Event()
+        self.copy_done.record(torch.cuda.current_stream(device))
+        return frame_dev
 
     def __enter__(self):
         return self
@@ -235,15 +224,37 @@ class YUVReader:
 
 
 
+'''
+Reads raw .yuv files (the resolution, bit-depth, chroma sub-sampling, colour space and frame rate are decoded from the
+file name, see decode_video_props). The files are memory-mapped, so the frames can be accessed in any order and
+without decoding with ffmpeg.
+
+fps - if not None, overrides the frame rate decoded from the file name
+frame_range - a range of the frames to read (e.g. range(10,100,2)), the frames are numbered from 0
+'''
 class video_source_yuv_file(video_source_dm):
 
-    def __init__( self, test_fname, reference_fname, display_photometry='standard_4k', frames=-1, full_screen_resize=None, resize_resolution=None, retain_aspect_ratio=False, verbose=False ):
+    def __init__( self, test_fname, reference_fname, display_photometry='standard_4k', config_paths=[], frames=-1, frame_range=None, fps=None, full_screen_resize=None, resize_resolution=None, retain_aspect_ratio=False, verbose=False ):
 
         self.reference_vidr = YUVReader(reference_fname)
         self.test_vidr = YUVReader(test_fname)
         self.total_frames = self.test_vidr.frame_count
+        if not frame_range is None:
+            self.frame_map = [ff for ff in frame_range if ff < self.total_frames]
+            self.total_frames = len(self.frame_map)
+        else:
+            self.frame_map = None
         self.frames = self.total_frames if frames==-1 else min(self.total_frames, frames)
         self.offset = 0     # Offset for random access of a shorter subsequence
+        self.fps = self.test_vidr.fps if not fps else fps
+
+        if self.test_vidr.fps != self.reference_vidr.fps and not fps:
+            logging.error(f"Test and reference videos have different frame rates: test is {self.test_vidr.fps} fps, reference is {self.reference_vidr.fps} fps." )
+            raise RuntimeError( "Inconsistent frame rates" )
+
+        fs_width = -1 if full_screen_resize is None else resize_resolution[0]
+        fs_height = -1 if full_screen_resize is None else resize_resolution[1]
+        self.reference_id = file_id(reference_fname) + (frames, None if frame_range is None else tuple(frame_range), full_screen_resize, fs_width, fs_height, retain_aspect_ratio)
 
         self.full_screen_resize = full_screen_resize
         if retain_aspect_ratio:
@@ -263,7 +274,7 @@ class video_source_yuv_file(video_source_dm):
         #     else:
         #         color_space_name="sRGB"
 
-        super().__init__(display_photometry=display_photometry)        
+        super().__init__(display_photometry=display_photometry, config_paths=config_paths)
 
         for vr in [self.test_vidr, self.reference_vidr]:
             if vr == self.test_vidr:
@@ -274,7 +285,7 @@ class video_source_yuv_file(video_source_dm):
                 rs_str = ""
             else:
                 rs_str = f"->[{resize_resolution[0]}x{resize_resolution[1]}]"
-            logging.debug(f"  [{vr.width}x{vr.height}]{rs_str}, colorspace: {vr.color_space}, EOTF: {self.dm_photometry.EOTF}, fps: {vr.fps}, frames: {self.frames}" )
+            logging.debug(f"  [{vr.width}x{vr.height}]{rs_str}, {vr.bit_depth}-bit {vr.chroma_ss}, colorspace: {vr.color_space}, EOTF: {self.dm_photometry.EOTF}, fps: {self.fps}, frames: {self.frames}" )
 
         
     # Return (height, width, frames) touple with the resolution and
@@ -287,8 +298,11 @@ class video_source_yuv_file(video_source_dm):
 
     # Return the frame rate of the video
     def get_frames_per_second(self) -> int:
-        return self.test_vidr.fps
-    
+        return self.fps
+
+    def get_reference_id(self):
+        return self.reference_id + (self.offset,)
+
     # Get a pair of test and reference video frames as a single-precision luminance map
     # scaled in absolute inits of cd/m^2. 'frame' is the frame index,
     # starting from 0. 
@@ -300,14 +314,27 @@ class video_source_yuv_file(video_source_dm):
         L = self._get_frame( self.reference_vidr, frame, device, colorspace )
         return L
 
+    def get_test_frames( self, start, count, device, colorspace="Y" ) -> Tensor:
+        return self._get_frames( self.test_vidr, start, count, device, colorspace )
+
+    def get_reference_frames( self, start, count, device, colorspace="Y" ) -> Tensor:
+        return self._get_frames( self.reference_vidr, start, count, device, colorspace )
+
     def _get_frame( self, vid_reader, frame, device, colorspace="Y" ):
-        RGB = vid_reader.get_frame_rgb_tensor(self.offset + frame, device)
-        RGB_bcfhw = reshuffle_dims( RGB, in_dims='HWC', out_dims="BCFHW" )
+        return self._get_frames( vid_reader, frame, 1, device, colorspace )
+
+    def _get_frames( self, vid_reader, start, count, device, colorspace="Y" ):
+        frames = [self.offset + ff for ff in range(start, start+count)]
+        if not self.frame_map is None:
+            frames = [self.frame_map[ff] for ff in frames]
+        RGB = vid_reader.get_frames_rgb_tensor(frames, device)
+        RGB_bcfhw = reshuffle_dims( RGB, in_dims='FHWC', out_dims="BCFHW" )
 
         if not self.full_screen_resize is None and (vid_reader.height != self.resize_resolution[1] or vid_reader.width != self.resize_resolution[0]):
-            RGB_bcfhw = torch.nn.functional.interpolate(RGB_bcfhw.view(1,RGB_bcfhw.shape[1],RGB_bcfhw.shape[3],RGB_bcfhw.shape[4]),
+            RGB_fchw = torch.nn.functional.interpolate(RGB.permute(0,3,1,2),
                                                 size=(self.resize_resolution[1], self.resize_resolution[0]),
-                                                mode=self.full_screen_resize).view(1,RGB_bcfhw.shape[1],1,self.resize_resolution[1],self.resize_resolution[0]).clip(0.,1.)
+                                                mode=self.full_screen_resize).clip(0.,1.)
+            RGB_bcfhw = RGB_fchw.permute(1,0,2,3).unsqueeze(0)
 
         I = self.apply_dm_and_colour_transform(RGB_bcfhw, colorspace)
         return I
@@ -1,5 +1,4 @@
 import numpy as np
-import ffmpeg
 
 class VideoWriter:
 
@@ -7,8 +6,10 @@ class VideoWriter:
     fps - frames per second
     hdr_mode - encode HDR moview
     codec - 'vp9' (works with Chrome) or 'h265' (everything else) - currently used only in the HDR mode
+    sdr_codec - ffmpeg encoder used in the SDR mode: 'mpeg4' (always bundled with ffmpeg), or any other encoder, such as
+                'libx264' or a hardware encoder, e.g. 'h264_nvenc'
     """
-    def __init__(self, fname, fps=24, hdr_mode=False, codec='h265', verbose=False):
+    def __init__(self, fname, fps=24, hdr_mode=False, codec='h265', sdr_codec='mpeg4', verbose=False):
         self.fname = fname
         self.fps = fps
         self.verbose = verbose
@@ -16,6 +17,7 @@ class VideoWriter:
         self.process = None
         #self.bit_depth = 10
         self.codec = codec
+        self.sdr_codec = sdr_codec
 
 
     """
@@ -29,6 +31,40 @@ class VideoWriter:
             rgb = np.concatenate([rgb]*3, -1)
 
         if self.process is None:
+            self.open(W, H)
+
+        #ffmpeg.compile(self.process)
+
+        if self.hdr_mode:
+            self.process.stdin.write(
+                (rgb * (2**16-1)).astype(np.uint16).tobytes()
+                )            
+        else:
+            if rgb.dtype == np.uint8:
+                self.process.stdin.write( rgb.tobytes() )
+            else:
+                self.process.stdin.write(
+                    (rgb * 255.0)
+                    .astype(np.uint8)
+                    .tobytes()
+                )
+
+    """
+    Write several 8-bit SDR frames, stored as a contiguous numpy uint8 array [N,H,W,3], to the video file in a single 
+    write to the encoder pipe (without copying the frames).
+    """
+    def write_frames_uint8(self, frames):
+        if self.hdr_mode:
+            raise RuntimeError( '8-bit frames cannot be written in the HDR mode' )
+        N, H, W, C = frames.shape
+        if self.process is None:
+            self.open(W, H)
+        self.process.stdin.write( memoryview(np.ascontiguousarray(frames)).cast('B') )
+
+    # Start the encoder for the frames of the resolution W x H. It stays open until close() is called.
+    def open(self, W, H):
+        if self.process is None:
+            import ffmpeg # imported on the first use to make `import pycvvdp` faster
             if self.hdr_mode:
                 if self.codec == 'h265':
                     self.process = (ffmpeg
@@ -53,31 +89,15 @@ class VideoWriter:
                 else:
                     raise RuntimeError( 'Unknown codec' )
             else:
+                codec_args = { "c:v": "mpeg4", "qscale:v": "3" } if self.sdr_codec == 'mpeg4' else { "c:v": self.sdr_codec }
                 self.process = (ffmpeg
                         .input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(W, H), r=self.fps)
-                        .output(self.fname, pix_fmt='yuv420p', **{ "c:v": "mpeg4", "qscale:v": "3" } ) #format='mp4', crf=10                        
+                        .output(self.fname, pix_fmt='yuv420p', **codec_args ) #format='mp4', crf=10                        
                         .overwrite_output()
                         .global_args( '-hide_banner')
                         .global_args( '-loglevel', 'info' if self.verbose else 'quiet')
                         .run_async(pipe_stdin=True)
                 )
-        
-
-        #ffmpeg.compile(self.process)
-
-        if self.hdr_mode:
-            self.process.stdin.write(
-                (rgb * (2**16-1)).astype(np.uint16).tobytes()
-                )            
-        else:
-            if rgb.dtype == np.uint8:
-                self.process.stdin.write( rgb.tobytes() )
-            else:
-                self.process.stdin.write(
-                    (rgb * 255.0)
-                    .astype(np.uint8)
-                    .tobytes()
-                )
 
     # Delete or close if program was interrupted
     def __del__(self):
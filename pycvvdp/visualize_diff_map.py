@@ -1,7 +1,6 @@
 # Visualization of difference maps.
 
 import torch
-from pycvvdp.interp import interp1
 
 # For debugging only
 # from gfxdisp.pfs.pfs_torch import *
@@ -23,18 +22,21 @@ def log_luminance(x):
     return torch.log(torch.clamp(y, min=clampval))
 
 
+# Tone-maps log-luminance b so that the histogram of the result is equalized (with the slope limited by t) into 
+# the range of dr. The histogram has uniformly spaced bins, so both the histogram and the tone-curve look-up 
+# are computed from the same normalized values (no searching in the look-up table).
 def vis_tonemap(b, dr):
     t = 3.0
+    N_bins = 1024
     
-    b_min = torch.min(b)
-    b_max = torch.max(b)
+    b_min, b_max = torch.aminmax(b)
     
     if b_max-b_min < dr: # No tone-mapping needed
         tmo_img = (b/(b_max-b_min+1e03)-b_min)*dr + (1-dr)/2
         return tmo_img
 
-    b_scale = torch.linspace( b_min, b_max, 1024, device=b.device)
-    b_p = torch.histc( b, 1024, b_min, b_max )
+    b_n = (b - b_min) / (b_max - b_min) # 0-1
+    b_p = torch.bincount( (b_n*N_bins).to(torch.int64).clamp_(max=N_bins-1).flatten(), minlength=N_bins ).to(b.dtype)
     b_p = b_p / torch.sum(b_p)
     
     sum_b_p = torch.sum(torch.pow(b_p, 1.0/t))
@@ -42,23 +44,17 @@ def vis_tonemap(b, dr):
     dy = torch.pow(b_p, 1.0/t) / sum_b_p
     
     v = torch.cumsum(dy, 0)*dr + (1.0-dr)/2.0
-    
-    tmo_img = interp1(b_scale, v, b)
-
-    return tmo_img
 
-# returns sRGB image/frames
-def visualize_diff_map(diff_map, context_image=None, colormap_type="supra-threshold", use_cpu=False):
-    diff_map = torch.clamp(diff_map, 0.0, 1.0)
-    if use_cpu:
-        diff_map = diff_map.cpu()
-        context_image = context_image.cpu()
+    # Linear interpolation of v, sampled at N_bins points between b_min and b_max
+    ind = b_n*(N_bins-1)
+    imin = ind.to(torch.int64).clamp_(max=N_bins-2)
+    tmo_img = torch.lerp(v[imin], v[imin+1], ind - imin)
 
-    if context_image is None:
-        tmo_img = torch.ones_like(diff_map) * 0.5
-    else:
-        tmo_img = vis_tonemap(log_luminance(context_image), 0.6)
+    return tmo_img
 
+# Returns the colours of the colour map [K,3] (normalized by their luminance) and the difference value 
+# of the last colour. The colours are uniformly spaced between 0 and that value.
+def get_color_map(colormap_type, device):
     if colormap_type == 'threshold':
         # Visualize up to 1 JOD (>=1 JOD will be all red)
 
@@ -68,8 +64,8 @@ def visualize_diff_map(diff_map, context_image=None, colormap_type="supra-thresh
             [0.2, 1.0, 0.2],
             [1.0, 1.0, 0.2],
             [1.0, 0.2, 0.2],
-        ], device=diff_map.device)
-        color_map_in = torch.tensor([0.00, 0.25, 0.50, 0.75, 1.00], device=diff_map.device)*0.1
+        ], device=device)
+        color_map_max = 0.1
 
     elif colormap_type == 'supra-threshold':
         # Visualize up to 3 JOD (>=3 JOD will be all yellow)
@@ -78,33 +74,71 @@ def visualize_diff_map(diff_map, context_image=None, colormap_type="supra-thresh
             [0.2, 1.0, 1.0],
             [1.0, 1.0, 1.0],
             [1.0, 1.0, 0.2],
-        ], device=diff_map.device)
-        color_map_in = torch.tensor([0.0, 0.5, 1.0], device=diff_map.device)*0.3
+        ], device=device)
+        color_map_max = 0.3
 
     elif colormap_type == 'monochromatic':
         
         color_map = torch.tensor([
             [1.0, 1.0, 1.0],
             [1.0, 1.0, 1.0],
-        ], device=diff_map.device)
-        
-        color_map_in = torch.tensor([0.0, 1.0], device=diff_map.device)
+        ], device=device)
+        color_map_max = 1.0
+
     else:
-        print("Unknown colormap: %s" % colormap_type)
+        raise RuntimeError( f"Unknown colormap: {colormap_type}" )
+
+    color_map_l = color_map[:,0:1] * 0.212656 + color_map[:,1:2] * 0.715158 + color_map[:,2:3] * 0.072186
+    color_map_ch = color_map / (color_map_l + 0.0001)
+
+    return color_map_ch, color_map_max
+
+# Colour-coded difference map multiplied by the tone-mapped context image, as [frames,height,width,3] float32 tensor. 
+# The colour of each pixel is looked up in one step for all three colour channels.
+def color_map_frames(diff_map, context_image=None, colormap_type="supra-threshold"):
+    color_map_ch, color_map_max = get_color_map(colormap_type, diff_map.device)
+    K = color_map_ch.shape[0]
 
-    # cmap = torch.zeros_like(diff_map)
-    # if cmap.shape[1] == 1:
-    #     cmap = torch.cat([cmap]*3, 1)
     frame_count, h, w = diff_map.shape[-3], diff_map.shape[-2], diff_map.shape[-1]
-    cmap = torch.empty( [3, frame_count, h, w], device=diff_map.device, dtype=torch.float16)
+    d = diff_map.reshape(frame_count, h, w, 1).float()
+    ind = (d*((K-1)/color_map_max)).clamp_(min=0.)
+    imin = ind.to(torch.int64).clamp_(max=K-2) # Extrapolated above color_map_max (clipped later)
+    cmap = torch.lerp(color_map_ch[imin[...,0]], color_map_ch[imin[...,0]+1], ind - imin) # [frames,height,width,3]
 
-    color_map_l = color_map[:,0:1] * 0.212656 + color_map[:,1:2] * 0.715158 + color_map[:,2:3] * 0.072186
-    color_map_ch = color_map / (torch.cat([color_map_l] * 3, 1) + 0.0001)
+    if context_image is None:
+        cmap.mul_(0.5)
+    else:
+        tmo_img = vis_tonemap(log_luminance(context_image.float()), 0.6)
+        cmap.mul_(tmo_img.reshape(-1, h, w, 1))
+
+    return cmap.clamp_(0., 1.)
+
+# returns sRGB image/frames
+def visualize_diff_map(diff_map, context_image=None, colormap_type="supra-threshold", use_cpu=False):
+    diff_map = torch.clamp(diff_map, 0.0, 1.0)
+    if use_cpu:
+        diff_map = diff_map.cpu()
+        context_image = None if context_image is None else context_image.cpu()
+
+    cmap = color_map_frames(diff_map, context_image, colormap_type).permute(3,0,1,2) # [3,frames,height,width]
 
-    cmap[0:1,...] = interp1(color_map_in, color_map_ch[:,0], diff_map).type(torch.float16)
-    cmap[1:2,...] = interp1(color_map_in, color_map_ch[:,1], diff_map).type(torch.float16)
-    cmap[2:3,...] = interp1(color_map_in, color_map_ch[:,2], diff_map).type(torch.float16)
+    # The same shape and type as in the previous versions: the channel dimension of diff_map (if present) is 
+    # replaced with 3 colour channels, float16 only for a float16 diff_map without the context image
+    dtype = torch.float32 if not context_image is None else torch.promote_types(torch.float16, diff_map.dtype)
+    return cmap.reshape(diff_map.shape[:-4] + cmap.shape).to(dtype)
+
+'''
+The same as visualize_diff_map, but the tone-mapping, colour mapping and quantization to 8 bits are done on the device of 
+diff_map, so that only 8-bit frames need to be copied to the host and passed to a video encoder. Returns a [1,3,frames,height,width] 
+uint8 tensor, which is a view of a contiguous [frames,height,width,3] (rgb24) tensor.
+'''
+def visualize_diff_map_uint8(diff_map, context_image=None, colormap_type="supra-threshold", use_cpu=False):
+    diff_map = torch.clamp(diff_map, 0.0, 1.0)
+    if use_cpu:
+        diff_map = diff_map.cpu()
+        context_image = None if context_image is None else context_image.cpu()
 
-    cmap = (cmap * tmo_img).clip(0.,1.)
+    cmap = color_map_frames(diff_map, context_image, colormap_type)
+    cmap = cmap.mul_(255.).to(torch.uint8) # Truncated, as when writing float frames with VideoWriter
 
-    return cmap
\ No newline at end of file
+    return cmap.permute(3,0,1,2).unsqueeze(0)
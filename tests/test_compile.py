@@ -0,0 +1,19 @@
+import pytest
+import torch
+import torch._dynamo
+import pycvvdp
+
+@pytest.mark.parametrize('precision', ['fp32', 'fp16', 'mixed'])
+def test_block_traces_without_graph_breaks(precision):
+    H, W, N = 64, 96, 4
+    metric = pycvvdp.cvvdp(display_name='standard_fhd', device=torch.device('cpu'), quiet=True, precision=precision)
+    lpyr = metric.create_contrast_pyramid(W, H)
+    R = (torch.rand((1,8,N,H,W), generator=torch.Generator().manual_seed(0))*50+1).to(metric.dtype)
+    if metric.contrast == 'log':
+        R = torch.log10(R)
+    rho_band = metric.get_csf_band_freqs(lpyr)
+    with torch.no_grad():
+        metric.process_block_of_frames(R, (H,W,N), 2, lpyr, False, rho_band=rho_band) # The kernels created on the first use
+        explanation = torch._dynamo.explain(metric.process_block_of_frames)(R, (H,W,N), 2, lpyr, False, rho_band=rho_band)
+    assert explanation.graph_break_count == 0, [br.reason for br in explanation.break_reasons]
+    assert explanation.graph_count == 1
@@ -0,0 +1,19 @@
+import numpy as np
+import torch
+import pycvvdp
+
+def test_memmap_stores_raw_heatmap(tmp_path):
+    gen = torch.Generator().manual_seed(0)
+    ref = (torch.rand((1,3,7,48,64), generator=gen)*255).to(torch.uint8)
+    tst = (ref.int() + torch.randint(-120, 120, ref.shape, generator=gen)).clamp(0,255).to(torch.uint8)
+    metric = pycvvdp.cvvdp(display_name='standard_4k', heatmap='raw', device=torch.device('cpu'), quiet=True)
+    metric.block_N_frames = 3 # Several blocks are written to the sink
+    fname = str(tmp_path / 'heatmap.npy')
+    with torch.no_grad():
+        Q_jod, stats = metric.predict(tst, ref, dim_order='BCFHW', frames_per_second=30)
+        Q_jod_sink, stats_sink = metric.predict(tst, ref, dim_order='BCFHW', frames_per_second=30, heatmap_sink=pycvvdp.heatmap_memmap(fname))
+
+    assert not 'heatmap' in stats_sink
+    assert float(Q_jod) == float(Q_jod_sink)
+    heatmap = stats['heatmap'][0].permute(1,2,3,0).numpy()
+    assert np.array_equal(np.load(fname, mmap_mode='r'), heatmap)
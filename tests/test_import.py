@@ -0,0 +1,20 @@
+import subprocess
+import sys
+import pytest
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+
+def test_submodules_are_attributes():
+    res = run_python("import pycvvdp; pycvvdp.utils.config_files; print(pycvvdp.display_model.__name__)")
+    assert res.returncode == 0, res.stderr
+    assert res.stdout.strip() == 'pycvvdp.display_model'
+
+def test_lazy_classes():
+    res = run_python("import pycvvdp, types; assert isinstance(pycvvdp.video_source_file, type); assert isinstance(pycvvdp.cvvdp, type)")
+    assert res.returncode == 0, res.stderr
+
+def test_missing_attribute():
+    import pycvvdp
+    with pytest.raises(AttributeError):
+        pycvvdp.no_such_module
@@ -0,0 +1,44 @@
+# The difference in JOD between the reduced precision modes and fp32 on the bundled example_media
+import os
+import numpy as np
+import pytest
+import torch
+import pycvvdp
+
+media_folder = os.path.join(os.path.dirname(__file__), '..', 'example_media')
+
+# The largest allowed difference from fp32 in JOD
+max_jod_error = { 'fp16': 0.01, 'mixed': 0.01, 'bf16': 0.01 }
+
+def add_noise(X, std, seed):
+    rng = np.random.default_rng(seed)
+    return np.clip(X.astype(np.float32) + rng.normal(0, std*255, X.shape), 0, 255).astype(np.uint8)
+
+def get_test_cases():
+    I = pycvvdp.load_image_as_array(os.path.join(media_folder, 'tree.jpg'))
+    I_ref = I[:180,:320,:]
+    V_pan = np.stack([I[:180, 8*ff:(8*ff+320), :] for ff in range(8)]) # A panning video [F,H,W,C]
+    V_noise = (np.random.default_rng(1).random((8,180,320,3))*255).astype(np.uint8)
+    return { 'image': (add_noise(I_ref, 20/255, 0), I_ref, 'HWC', 0),
+             'pan_video_small_noise': (add_noise(V_pan, 2/255, 2), V_pan, 'FHWC', 30),
+             'pan_video': (add_noise(V_pan, 20/255, 3), V_pan, 'FHWC', 30),
+             'noise_video': (add_noise(V_noise, 5/255, 4), V_noise, 'FHWC', 30) }
+
+def predict(precision, case):
+    metric = pycvvdp.cvvdp(display_name='standard_fhd', precision=precision, device=torch.device('cpu'), quiet=True)
+    test, ref, dim_order, fps = case
+    with torch.no_grad():
+        Q_jod, stats = metric.predict(test, ref, dim_order=dim_order, frames_per_second=fps)
+    return float(Q_jod)
+
+@pytest.fixture(scope='module')
+def cases():
+    cases = get_test_cases()
+    return { name: (case, predict('fp32', case)) for name, case in cases.items() }
+
+@pytest.mark.parametrize('precision', ['fp16', 'mixed', 'bf16'])
+@pytest.mark.parametrize('case_name', ['image', 'pan_video_small_noise', 'pan_video', 'noise_video'])
+def test_precision(cases, precision, case_name):
+    case, Q_fp32 = cases[case_name]
+    Q = predict(precision, case)
+    assert abs(Q-Q_fp32) <= max_jod_error[precision], f'{precision} differs from fp32 by {Q-Q_fp32:+.4f} JOD ({case_name})'
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+import torch
+import pycvvdp
+
+def test_tiled_same_as_full_frame():
+    rng = np.random.default_rng(0)
+    ref = (rng.random((4,180,320,3))*255).astype(np.uint8)
+    tst = np.clip(ref + rng.normal(0, 10, ref.shape), 0, 255).astype(np.uint8)
+    Q = {}
+    for tile_size in [None, 64]:
+        metric = pycvvdp.cvvdp(display_name='standard_fhd', device=torch.device('cpu'), quiet=True, tile_size=tile_size)
+        with torch.no_grad():
+            Q[tile_size] = float(metric.predict(tst, ref, dim_order='FHWC', frames_per_second=30)[0])
+    assert abs(Q[None]-Q[64]) < 1e-4
+
+def test_refuses_frames_that_do_not_fit(monkeypatch):
+    metric = pycvvdp.cvvdp(display_name='standard_fhd', device=torch.device('cpu'), quiet=True, tile_size=1024)
+    metric.F, _ = metric.get_temporal_filters(60)
+    metric.filter_len = torch.numel(metric.F[0])
+    monkeypatch.setattr(metric, 'get_memory_model', lambda: None)
+    tile_pix_cnt = (1024+2*metric.get_tile_margin())**2
+    monkeypatch.setattr(metric, 'get_available_memory', lambda: 10e9)
+    with pytest.raises(RuntimeError, match="full frame"):
+        metric.estimate_block_N(7680*4320, 60, tile_pix_cnt=tile_pix_cnt) # The sliding window alone needs 13.5 GB
+    monkeypatch.setattr(metric, 'get_available_memory', lambda: 40e9)
+    assert metric.estimate_block_N(7680*4320, 60, tile_pix_cnt=tile_pix_cnt) >= 1
@@ -0,0 +1,23 @@
+import pytest
+import torch
+from pycvvdp.visualize_diff_map import visualize_diff_map, visualize_diff_map_uint8
+
+@pytest.mark.parametrize('shape, out_shape', [ ((1,1,4,16,20), (1,3,4,16,20)), ((1,4,16,20), (3,4,16,20)) ])
+def test_shape_and_type(shape, out_shape):
+    gen = torch.Generator().manual_seed(0)
+    diff_map = torch.rand(shape, generator=gen)
+    context = torch.rand(shape, generator=gen)*100 + 0.1
+    cmap = visualize_diff_map(diff_map, context_image=context)
+    assert cmap.shape == out_shape and cmap.dtype == torch.float32
+    cmap_nc = visualize_diff_map(diff_map.half())
+    assert cmap_nc.shape == out_shape and cmap_nc.dtype == torch.float16
+
+def test_uint8_matches_float():
+    gen = torch.Generator().manual_seed(0)
+    diff_map = torch.rand((1,1,4,16,20), generator=gen)
+    context = torch.rand((1,1,4,16,20), generator=gen)*100 + 0.1
+    for colormap_type in ['threshold', 'supra-threshold']:
+        cmap = visualize_diff_map(diff_map, context_image=context, colormap_type=colormap_type)
+        cmap_u8 = visualize_diff_map_uint8(diff_map, context_image=context, colormap_type=colormap_type)
+        assert cmap_u8.dtype == torch.uint8 and cmap_u8.shape == cmap.shape
+        assert torch.equal(cmap_u8, (cmap*255.).to(torch.uint8))